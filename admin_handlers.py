@@ -10,7 +10,13 @@ from keyboards import (
     partners_management_keyboard,
     back_to_menu_keyboard
 )
-from data_manager import data_manager
+from data_manager import async_data_manager
+from movie_records import parse_episodes
+from deep_links import start_link
+from user_registry import user_registry
+from analytics import analytics, format_statistics
+import broadcast
+import link_checker
 
 router = Router()
 
@@ -101,10 +107,14 @@ async def process_movie_poster(message: Message, state: FSMContext):
     if not is_admin(message):
         return
     
-    if not message.text:
+    if message.photo:
+        # Uploaded photo is stored by its file_id, Telegram serves it directly
+        poster = message.photo[-1].file_id
+    elif message.text:
+        poster = message.text.strip()
+    else:
         return
-        
-    poster = message.text.strip()
+    
     await state.update_data(poster=poster)
     await state.set_state(AdminStates.waiting_for_movie_episodes)
     
@@ -119,8 +129,12 @@ async def process_movie_episodes(message: Message, state: FSMContext):
     if not message.text:
         return
         
-    episodes_text = message.text.strip()
-    episodes = [ep.strip() for ep in episodes_text.split(',') if ep.strip()]
+    try:
+        # Ranges like episode-{1..24}.html stay compressed, they are not expanded here
+        episodes = parse_episodes(message.text)
+    except ValueError as e:
+        await message.answer(MESSAGES["invalid_episodes"].format(error=e))
+        return
     
     # Get saved data
     data = await state.get_data()
@@ -129,7 +143,7 @@ async def process_movie_episodes(message: Message, state: FSMContext):
     poster = data['poster']
     
     # Save movie
-    data_manager.add_movie(code, title, poster, episodes)
+    await async_data_manager.add_movie(code, title, poster, episodes)
     
     await state.clear()
     
@@ -163,7 +177,7 @@ async def process_delete_code(message: Message, state: FSMContext):
         
     code = message.text.strip()
     
-    if data_manager.delete_movie(code):
+    if await async_data_manager.delete_movie(code):
         text = MESSAGES["movie_deleted"]
     else:
         text = MESSAGES["movie_not_found_delete"]
@@ -173,6 +187,46 @@ async def process_delete_code(message: Message, state: FSMContext):
     keyboard = admin_menu_keyboard()
     await message.answer(text, reply_markup=keyboard)
 
+@router.callback_query(F.data == "admin_movie_link")
+async def admin_movie_link(callback: CallbackQuery, state: FSMContext):
+    """Start deep link generation"""
+    if not is_admin(callback):
+        await callback.answer("❌ У вас нет доступа к админ-панели.", show_alert=True)
+        return
+    
+    await state.set_state(AdminStates.waiting_for_link_code)
+    
+    text = MESSAGES["enter_link_code"]
+    if callback.message:
+        await callback.message.edit_text(text)
+    await callback.answer()
+
+@router.message(AdminStates.waiting_for_link_code)
+async def process_link_code(message: Message, state: FSMContext):
+    """Reply with the t.me link opening the code"""
+    if not is_admin(message):
+        return
+    
+    if not message.text:
+        return
+    
+    code = message.text.strip()
+    movie = await async_data_manager.get_movie(code)
+    
+    if movie is None:
+        text = MESSAGES["movie_not_found_delete"]
+    else:
+        link = await start_link(message.bot, code)
+        if link is None:
+            text = MESSAGES["movie_link_too_long"]
+        else:
+            text = MESSAGES["movie_link"].format(title=movie["title"], link=link)
+    
+    await state.clear()
+    
+    keyboard = admin_menu_keyboard()
+    await message.answer(text, reply_markup=keyboard)
+
 @router.callback_query(F.data == "admin_manage_partners")
 async def admin_manage_partners(callback: CallbackQuery):
     """Show partners management"""
@@ -180,7 +234,7 @@ async def admin_manage_partners(callback: CallbackQuery):
         await callback.answer("❌ У вас нет доступа к админ-панели.", show_alert=True)
         return
     
-    partners = data_manager.get_partners()
+    partners = await async_data_manager.get_partners()
     
     text = "🤝 <b>Управление партнёрами</b>\n\nТекущие партнёры:"
     if partners:
@@ -205,12 +259,12 @@ async def delete_partner(callback: CallbackQuery):
         return
         
     partner = callback.data.split(":", 1)[1]
-    data_manager.delete_partner(partner)
+    await async_data_manager.delete_partner(partner)
     
     await callback.answer(MESSAGES["partner_deleted"])
     
     # Refresh partners list
-    partners = data_manager.get_partners()
+    partners = await async_data_manager.get_partners()
     
     text = "🤝 <b>Управление партнёрами</b>\n\nТекущие партнёры:"
     if partners:
@@ -251,7 +305,7 @@ async def process_partner_link(message: Message, state: FSMContext):
     if not partner.startswith("@"):
         partner = "@" + partner
     
-    data_manager.add_partner(partner)
+    await async_data_manager.add_partner(partner)
     
     await state.clear()
     
@@ -260,6 +314,57 @@ async def process_partner_link(message: Message, state: FSMContext):
     
     await message.answer(text, reply_markup=keyboard)
 
+@router.callback_query(F.data == "admin_broadcast")
+async def admin_broadcast(callback: CallbackQuery, state: FSMContext):
+    """Start broadcast process"""
+    if not is_admin(callback):
+        await callback.answer("❌ У вас нет доступа к админ-панели.", show_alert=True)
+        return
+    
+    if broadcast.is_running():
+        await callback.answer(MESSAGES["broadcast_running"], show_alert=True)
+        return
+    
+    await state.set_state(AdminStates.waiting_for_broadcast_message)
+    
+    text = MESSAGES["enter_broadcast_message"]
+    if callback.message:
+        await callback.message.edit_text(text)
+    await callback.answer()
+
+@router.message(AdminStates.waiting_for_broadcast_message)
+async def process_broadcast_message(message: Message, state: FSMContext):
+    """Send received message to all users"""
+    if not is_admin(message):
+        return
+    
+    await state.clear()
+    
+    if broadcast.start_broadcast(message.bot, message.chat.id, message.message_id):
+        text = MESSAGES["broadcast_started"].format(users_count=user_registry.count())
+    else:
+        text = MESSAGES["broadcast_running"]
+    
+    keyboard = admin_menu_keyboard()
+    await message.answer(text, reply_markup=keyboard)
+
+@router.callback_query(F.data == "admin_check_links")
+async def admin_check_links(callback: CallbackQuery):
+    """Check episode links in the background, report comes when done"""
+    if not is_admin(callback):
+        await callback.answer("❌ У вас нет доступа к админ-панели.", show_alert=True)
+        return
+    
+    if link_checker.is_running():
+        done, total = link_checker.link_checker.progress
+        await callback.answer(MESSAGES["links_check_running"].format(done=done, total=total), show_alert=True)
+        return
+    
+    if callback.message:
+        link_checker.start_check(callback.bot, callback.message.chat.id)
+        await callback.message.edit_text(MESSAGES["links_check_started"], reply_markup=admin_menu_keyboard())
+    await callback.answer()
+
 @router.callback_query(F.data == "admin_statistics")
 async def admin_statistics(callback: CallbackQuery):
     """Show statistics"""
@@ -267,13 +372,15 @@ async def admin_statistics(callback: CallbackQuery):
         await callback.answer("❌ У вас нет доступа к админ-панели.", show_alert=True)
         return
     
-    movies_count = data_manager.get_movies_count()
-    partners_count = data_manager.get_partners_count()
+    movies_count = await async_data_manager.get_movies_count()
+    partners_count = await async_data_manager.get_partners_count()
     
     text = MESSAGES["statistics"].format(
         movies_count=movies_count,
-        partners_count=partners_count
+        partners_count=partners_count,
+        users_count=user_registry.count()
     )
+    text += format_statistics(await analytics.combined())
     
     keyboard = admin_menu_keyboard()
     
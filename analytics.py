@@ -0,0 +1,438 @@
+"""Popularity analytics in fixed memory.
+
+Code lookups and misses are counted in count-min sketches, each with the
+heaviest codes kept in a top-k heap; unique users are counted per day in
+HyperLogLogs. Every update costs a few hash lookups and memory depends only
+on the configured sizes. Sketch counters are halved at midnight, so the top
+follows what is popular now. Worker processes keep files of their own, the
+statistics screen merges them.
+"""
+import array
+import asyncio
+import base64
+import datetime
+import hashlib
+import heapq
+import html
+import json
+import logging
+import math
+import os
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+from config import (
+    MESSAGES,
+    ANALYTICS_FILE,
+    ANALYTICS_FLUSH_INTERVAL,
+    ANALYTICS_SKETCH_WIDTH,
+    ANALYTICS_SKETCH_DEPTH,
+    ANALYTICS_TOP_SIZE,
+    ANALYTICS_DAYS,
+    ANALYTICS_WARM_CODES
+)
+from render_cache import render_cache, movie_screen
+
+logger = logging.getLogger(__name__)
+
+# Longer codes are cut, the top must not hold arbitrary user input in full
+MAX_KEY_LENGTH = 64
+HLL_PRECISION = 14
+STATE_VERSION = 1
+
+def _hash(data: bytes) -> int:
+    """64-bit hash, stable between runs unlike hash()"""
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+def _pack(values: array.array) -> str:
+    if sys.byteorder != "little":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode()
+
+def _unpack(typecode: str, text: str) -> array.array:
+    values = array.array(typecode)
+    values.frombytes(base64.b64decode(text))
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+def _midnight_after(day: datetime.date) -> float:
+    return datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()).timestamp()
+
+class CountMinSketch:
+    """Approximate counts of keys in depth rows of width counters, never below the true count"""
+
+    def __init__(self, width: int, depth: int):
+        self.width = width
+        self.depth = depth
+        self.counters = array.array("Q", bytes(8 * width * depth))
+
+    def _cells(self, key: str) -> List[int]:
+        # Double hashing gives each row its own column from one 64-bit hash
+        h = _hash(key.encode())
+        first, step = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [row * self.width + (first + row * step) % self.width for row in range(self.depth)]
+
+    def add(self, key: str) -> int:
+        """Count key once, returns its new estimate"""
+        cells = self._cells(key)
+        counters = self.counters
+        estimate = min(counters[cell] for cell in cells) + 1
+        # Conservative update: counters already above the estimate belong to other keys
+        for cell in cells:
+            if counters[cell] < estimate:
+                counters[cell] = estimate
+        return estimate
+
+    def estimate(self, key: str) -> int:
+        return min(self.counters[cell] for cell in self._cells(key))
+
+    def decay(self, shift: int):
+        """Divide all counts by 2 ** shift"""
+        self.counters = array.array("Q", (count >> shift for count in self.counters))
+
+    def merge(self, other: "CountMinSketch"):
+        counters = self.counters
+        for cell, count in enumerate(other.counters):
+            counters[cell] += count
+
+class TopK:
+    """Keys with the largest estimates, at most size of them.
+
+    Every key has one heap entry; an entry may lag behind the key's count
+    and is refreshed only when it reaches the top of the heap.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.counts: Dict[str, int] = {}
+        self._heap: List[Tuple[int, str]] = []
+
+    def offer(self, key: str, estimate: int):
+        """Update key with its current estimate"""
+        if key in self.counts:
+            self.counts[key] = estimate
+            return
+        if len(self.counts) < self.size:
+            self.counts[key] = estimate
+            heapq.heappush(self._heap, (estimate, key))
+            return
+        if self.size <= 0:
+            return
+        while True:
+            count, smallest = self._heap[0]
+            current = self.counts[smallest]
+            if current == count:
+                break
+            heapq.heapreplace(self._heap, (current, smallest))
+        if estimate > count:
+            del self.counts[smallest]
+            self.counts[key] = estimate
+            heapq.heapreplace(self._heap, (estimate, key))
+
+    def items(self) -> List[Tuple[str, int]]:
+        """Keys with counts, largest first"""
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+
+    def reset(self, counts: Dict[str, int]):
+        """Replace contents, keeping the largest counts"""
+        self.counts = dict(sorted(counts.items(), key=lambda item: -item[1])[:self.size])
+        self._heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self._heap)
+
+class HyperLogLog:
+    """Approximate number of distinct user ids, 2 ** precision one-byte registers"""
+
+    def __init__(self, precision: int = HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value: int):
+        h = _hash(value.to_bytes(8, "little", signed=True))
+        bits = 64 - self.precision
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        index = h >> bits
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        # Small range correction: linear counting while many registers are empty
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+class Analytics:
+    """Lookups and misses per code and unique users per day, persisted as JSON"""
+
+    def __init__(self, path: Optional[str], flush_interval: float = 60.0, width: int = 4096,
+                 depth: int = 4, top_size: int = 50, days: int = 7, warm_codes: int = 20):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.width = width
+        self.depth = depth
+        self.top_size = top_size
+        self.days = max(days, 1)
+        self.warm_codes = warm_codes
+        # Files of the other worker processes, merged into the statistics screen
+        self.siblings: List[str] = []
+        self.dirty = False
+        self._flush_task: Optional[asyncio.Task] = None
+        self._reset()
+        if path is not None:
+            self._load()
+
+    def _reset(self):
+        self.lookups = CountMinSketch(self.width, self.depth)
+        self.misses = CountMinSketch(self.width, self.depth)
+        self.top_lookups = TopK(self.top_size)
+        self.top_misses = TopK(self.top_size)
+        # ISO day -> unique users of that day, oldest first
+        self.users: "OrderedDict[str, HyperLogLog]" = OrderedDict()
+        self.day = datetime.date.today()
+        self._next_day = _midnight_after(self.day)
+        self._today = self.users[self.day.isoformat()] = HyperLogLog()
+
+    def _tick(self):
+        if time.time() >= self._next_day:
+            self._roll_to(datetime.date.today())
+
+    def _roll_to(self, day: datetime.date):
+        """Start a new day: halve counts once per elapsed day, open a new users counter"""
+        elapsed = (day - self.day).days
+        self._next_day = _midnight_after(max(day, self.day))
+        if elapsed <= 0:
+            return
+        shift = min(elapsed, 63)
+        for sketch, top in ((self.lookups, self.top_lookups), (self.misses, self.top_misses)):
+            sketch.decay(shift)
+            top.reset({key: count >> shift for key, count in top.counts.items() if count >> shift})
+        self.day = day
+        self._today = self.users.setdefault(day.isoformat(), HyperLogLog())
+        while len(self.users) > self.days:
+            self.users.popitem(last=False)
+        self.dirty = True
+
+    def record_lookup(self, code: str):
+        """Count a delivered code"""
+        self._tick()
+        code = code[:MAX_KEY_LENGTH]
+        self.top_lookups.offer(code, self.lookups.add(code))
+        self.dirty = True
+
+    def record_miss(self, code: str):
+        """Count a searched code without a movie"""
+        self._tick()
+        code = code[:MAX_KEY_LENGTH]
+        self.top_misses.offer(code, self.misses.add(code))
+        self.dirty = True
+
+    def record_user(self, user_id: int):
+        """Count user as active today"""
+        self._tick()
+        self._today.add(user_id)
+        self.dirty = True
+
+    def top_codes(self, limit: int) -> List[Tuple[str, int]]:
+        return self.top_lookups.items()[:limit]
+
+    def top_missing_codes(self, limit: int) -> List[Tuple[str, int]]:
+        return self.top_misses.items()[:limit]
+
+    def daily_users(self) -> List[Tuple[str, int]]:
+        """Unique users per day, newest first"""
+        return [(day, users.count()) for day, users in reversed(self.users.items())]
+
+    def period_users(self) -> int:
+        """Unique users over all kept days"""
+        union = HyperLogLog()
+        for users in self.users.values():
+            union.merge(users)
+        return union.count()
+
+    def merge(self, other: "Analytics"):
+        """Add counts of another instance covering the same day"""
+        if (other.width, other.depth) == (self.width, self.depth):
+            for sketch, top, other_sketch, other_top in (
+                (self.lookups, self.top_lookups, other.lookups, other.top_lookups),
+                (self.misses, self.top_misses, other.misses, other.top_misses)
+            ):
+                sketch.merge(other_sketch)
+                top.reset({key: sketch.estimate(key) for key in {**top.counts, **other_top.counts}})
+        for day, users in other.users.items():
+            self.users.setdefault(day, HyperLogLog()).merge(users)
+        self.users = OrderedDict(sorted(self.users.items())[-self.days:])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "version": STATE_VERSION,
+            "day": self.day.isoformat(),
+            "width": self.width,
+            "depth": self.depth,
+            "lookups": _pack(self.lookups.counters),
+            "misses": _pack(self.misses.counters),
+            "top_lookups": self.top_lookups.items(),
+            "top_misses": self.top_misses.items(),
+            "users": {day: base64.b64encode(users.registers).decode() for day, users in self.users.items()}
+        }
+
+    def _load(self):
+        """Restore saved state, rolled forward to today"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("version") != STATE_VERSION:
+                raise ValueError(f"unknown version {state.get('version')}")
+            saved_day = datetime.date.fromisoformat(state["day"])
+            users = OrderedDict()
+            for day, registers in sorted(state["users"].items()):
+                counter = HyperLogLog()
+                counter.registers = bytearray(base64.b64decode(registers))
+                if len(counter.registers) == 1 << HLL_PRECISION:
+                    users[day] = counter
+            if (state["width"], state["depth"]) == (self.width, self.depth):
+                self.lookups.counters = _unpack("Q", state["lookups"])
+                self.misses.counters = _unpack("Q", state["misses"])
+                self.top_lookups.reset(dict(state["top_lookups"]))
+                self.top_misses.reset(dict(state["top_misses"]))
+            else:
+                logger.warning(f"Sketch size changed, dropping code counts from {self.path}")
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Failed to load analytics from {self.path}: {e}")
+            self._reset()
+            return
+        self.users = users
+        self.day = saved_day
+        self._today = self.users.setdefault(saved_day.isoformat(), HyperLogLog())
+        self._roll_to(datetime.date.today())
+
+    def _write(self, state: Dict[str, Any]):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def save(self):
+        """Write state to file if it changed"""
+        if not self.dirty or self.path is None:
+            return
+        self.dirty = False
+        self._write(self.to_dict())
+
+    def use_worker_files(self, index: int, workers: int):
+        """Keep state of worker index in a file of its own, read the others' for statistics"""
+        self.path = worker_file(index)
+        self.siblings = [worker_file(other) for other in range(workers) if other != index]
+        self._reset()
+        self._load()
+
+    async def combined(self) -> "Analytics":
+        """Statistics of all worker processes, this one as is"""
+        if not self.siblings:
+            return self
+        loop = asyncio.get_running_loop()
+        combined = self._empty(None)
+        combined.merge(self)
+        for path in self.siblings:
+            other = await loop.run_in_executor(None, self._empty, path)
+            combined.merge(other)
+        return combined
+
+    def _empty(self, path: Optional[str]) -> "Analytics":
+        return Analytics(path, self.flush_interval, self.width, self.depth, self.top_size, self.days)
+
+    async def warm_up(self):
+        """Render the most looked up codes the render cache does not hold"""
+        for code, _ in self.top_codes(self.warm_codes):
+            if not render_cache.has_movie(code):
+                await movie_screen(code)
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._tick()
+            if self.dirty:
+                self.dirty = False
+                try:
+                    # Encoding is quick, the JSON dump and write happen off the event loop
+                    await loop.run_in_executor(None, self._write, self.to_dict())
+                except OSError as e:
+                    logger.error(f"Failed to save analytics: {e}")
+            try:
+                await self.warm_up()
+            except Exception as e:
+                logger.error(f"Failed to warm up render cache: {e}")
+
+    async def start(self):
+        """Warm the render cache and start periodic saving (dispatcher startup hook)"""
+        if self._flush_task is None:
+            await self.warm_up()
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stop periodic saving and save the rest (dispatcher shutdown hook)"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        try:
+            self.save()
+        except OSError as e:
+            logger.error(f"Failed to save analytics: {e}")
+
+def worker_file(index: int) -> str:
+    """Analytics file of a worker process"""
+    root, ext = os.path.splitext(ANALYTICS_FILE)
+    return f"{root}-{index}{ext}"
+
+def format_statistics(stats: Analytics, shown: int = 10) -> str:
+    """Statistics screen part with unique users and top codes"""
+    days = "\n".join(
+        MESSAGES["statistics_day"].format(day=datetime.date.fromisoformat(day).strftime("%d.%m"), users=users)
+        for day, users in stats.daily_users()
+    )
+    text = MESSAGES["statistics_users"].format(days=days, days_count=len(stats.users), total=stats.period_users())
+    for key, codes in (("statistics_top", stats.top_codes(shown)), ("statistics_top_misses", stats.top_missing_codes(shown))):
+        if codes:
+            lines = "\n".join(
+                MESSAGES["statistics_code"].format(place=place, code=html.escape(code), count=count)
+                for place, (code, count) in enumerate(codes, 1)
+            )
+            text += MESSAGES[key].format(codes=lines)
+    return text
+
+class AnalyticsMiddleware(BaseMiddleware):
+    """Dispatcher update middleware counting daily unique users"""
+
+    def __init__(self, stats: Analytics):
+        self.stats = stats
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user: User = data.get("event_from_user")
+        if user is not None:
+            self.stats.record_user(user.id)
+        return await handler(event, data)
+
+analytics = Analytics(
+    ANALYTICS_FILE, ANALYTICS_FLUSH_INTERVAL, ANALYTICS_SKETCH_WIDTH, ANALYTICS_SKETCH_DEPTH,
+    ANALYTICS_TOP_SIZE, ANALYTICS_DAYS, ANALYTICS_WARM_CODES
+)
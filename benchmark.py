@@ -0,0 +1,263 @@
+"""Microbenchmarks for catalog storage and keyboard builders.
+
+Usage:
+    python benchmark.py --output results.json
+    python benchmark.py --sizes 1000,10000 --baseline baseline.json
+    python benchmark.py --save-baseline baseline.json
+
+Synthetic catalogs are generated with a fixed seed, so runs on the same
+machine are comparable. Every benchmark is repeated --runs times and the
+median is reported with its relative spread. Every metric is "lower is
+better"; with --baseline the run exits with status 1 when a median or
+mean latency got worse than --threshold plus the spread of both runs.
+Tail latencies, load times and memory are reported but not gated, they
+are too noisy on a shared machine. The 1M catalog needs several GB of
+RAM with the JSON backend.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+from data_manager import DataManager, JsonStorage
+from keyboards import movie_episodes_keyboard, partners_subscription_keyboard
+from sqlite_storage import SqliteStorage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = "1000,10000,100000,1000000"
+KEYBOARD_SIZES = (1, 10, 50, 100, 250, 500)
+# Only these are stable enough to fail a comparison
+GATED_SUFFIXES = (".p50_us", ".mean_us")
+HOSTS = ("jut.su", "animego.org", "doramy.club", "kinogo.biz")
+WORDS = ("naruto", "ван", "пис", "атака", "титанов", "love", "story", "школа", "демонов", "клинок",
+         "тайна", "город", "night", "dragon", "сердце", "king", "море", "весна", "академия", "герой")
+
+def generate_catalog(size: int, seed: int = 42) -> Dict[str, Dict[str, Any]]:
+    """Catalog of size movies shaped like the real one.
+
+    Most entries are films or short seasons, a few are long running shows
+    with hundreds of episodes.
+    """
+    rng = random.Random(seed)
+    movies = {}
+    for code in range(1, size + 1):
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title()
+        slug = f"{title.lower().replace(' ', '-')}-{code}"
+        roll = rng.random()
+        if roll < 0.4:
+            count = 1
+        elif roll < 0.95:
+            count = rng.randint(8, 26)
+        else:
+            count = rng.randint(100, 500)
+        host = rng.choice(HOSTS)
+        movies[str(code)] = {
+            "title": title,
+            "poster": f"https://{host}/posters/{slug}.jpg",
+            "episodes": [f"https://{host}/{slug}/episode-{n}.html" for n in range(1, count + 1)]
+        }
+    return movies
+
+def generate_partners(count: int) -> List[str]:
+    return [f"@partner_channel_{n}" for n in range(1, count + 1)]
+
+def summarize(samples_ns: List[int]) -> Dict[str, float]:
+    """Latency statistics in microseconds"""
+    samples = sorted(samples_ns)
+    return {
+        "mean_us": statistics.fmean(samples) / 1000,
+        "p50_us": samples[len(samples) // 2] / 1000,
+        "p95_us": samples[min(len(samples) - 1, int(len(samples) * 0.95))] / 1000,
+        "max_us": samples[-1] / 1000
+    }
+
+def time_calls(func: Callable, args_list: List[Tuple]) -> Dict[str, float]:
+    """Call func once per args tuple and summarize latencies"""
+    samples = []
+    for args in args_list:
+        started = time.perf_counter_ns()
+        func(*args)
+        samples.append(time.perf_counter_ns() - started)
+    return summarize(samples)
+
+def create_backend(backend: str, directory: str, operations: int = 0):
+    if backend == "json":
+        # Timed adds and deletes journal 2 * operations records; compaction must not
+        # start in the background, overlap the timings and outlive the directory
+        return JsonStorage(
+            os.path.join(directory, "movies.json"), os.path.join(directory, "partners.json"),
+            compact_threshold=2 * operations + 1
+        )
+    return SqliteStorage(os.path.join(directory, "catalog.db"))
+
+def bench_storage(backend: str, catalog: Dict[str, Dict[str, Any]], operations: int,
+                  seed: int = 42) -> Dict[str, Dict[str, float]]:
+    """Latency of DataManager operations and memory of a loaded catalog"""
+    rng = random.Random(seed)
+    size = len(catalog)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        create_backend(backend, directory).import_catalog(catalog, generate_partners(5))
+
+        # Cold start: a fresh process reading the catalog for the first time.
+        # tracemalloc sees Python objects only, not SQLite's own page cache
+        tracemalloc.start()
+        started = time.perf_counter_ns()
+        manager = DataManager(create_backend(backend, directory, operations))
+        manager.get_movies_count()
+        load_ns = time.perf_counter_ns() - started
+        resident, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results["load"] = {"load_ms": load_ns / 1e6, "resident_bytes": resident, "peak_bytes": peak}
+
+        codes = [str(rng.randint(1, size)) for _ in range(operations)]
+        results["get_movie"] = time_calls(manager.get_movie, [(code,) for code in codes])
+        results["get_movie_missing"] = time_calls(
+            manager.get_movie, [(f"missing-{n}",) for n in range(operations)]
+        )
+        results["get_movies_count"] = time_calls(manager.get_movies_count, [()] * operations)
+
+        new_codes = [f"bench-{n}" for n in range(operations)]
+        template = catalog[codes[0]]
+        results["add_movie"] = time_calls(
+            manager.add_movie,
+            [(code, template["title"], template["poster"], template["episodes"]) for code in new_codes]
+        )
+        results["delete_movie"] = time_calls(manager.delete_movie, [(code,) for code in new_codes])
+    return results
+
+def bench_keyboards(repeat: int) -> Dict[str, Dict[str, float]]:
+    """Build time of keyboards with 1..500 buttons"""
+    results = {}
+    for count in KEYBOARD_SIZES:
+        episodes = [f"https://jut.su/bench/episode-{n}.html" for n in range(1, count + 1)]
+        partners = generate_partners(count)
+        results[f"movie_episodes_keyboard.{count}"] = time_calls(movie_episodes_keyboard, [(episodes,)] * repeat)
+        results[f"partners_subscription_keyboard.{count}"] = time_calls(
+            partners_subscription_keyboard, [(partners,)] * repeat
+        )
+    return results
+
+def run(sizes: List[int], backends: List[str], operations: int, repeat: int, runs: int = 3) -> Dict[str, Any]:
+    """Run every benchmark runs times, medians and relative spreads keyed by flat dotted names"""
+    samples: Dict[str, List[float]] = {}
+    for size in sizes:
+        logger.info(f"Generating catalog of {size} movies")
+        catalog = generate_catalog(size)
+        for backend in backends:
+            for attempt in range(runs):
+                logger.info(f"Benchmarking {backend} storage with {size} movies, run {attempt + 1}/{runs}")
+                for operation, values in bench_storage(backend, catalog, operations).items():
+                    for name, value in values.items():
+                        samples.setdefault(f"storage.{backend}.{size}.{operation}.{name}", []).append(value)
+    for attempt in range(runs):
+        logger.info(f"Benchmarking keyboards, run {attempt + 1}/{runs}")
+        for builder, values in bench_keyboards(repeat).items():
+            for name, value in values.items():
+                samples.setdefault(f"keyboard.{builder}.{name}", []).append(value)
+
+    metrics = {name: statistics.median(values) for name, values in samples.items()}
+    # (max - min) / median of the runs, how far a metric moves on identical code
+    spread = {
+        name: (max(values) - min(values)) / metrics[name] if metrics[name] else 0.0
+        for name, values in samples.items()
+    }
+    return {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": sizes,
+            "backends": backends,
+            "operations": operations,
+            "repeat": repeat,
+            "runs": runs
+        },
+        "metrics": metrics,
+        "spread": spread
+    }
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[Dict[str, Any]]:
+    """Changes of metrics present in both results.
+
+    Median and mean latencies are flagged when worse than threshold plus the
+    spread both runs saw between their repetitions. Baselines without
+    spreads count as noiseless.
+    """
+    changes = []
+    for name in sorted(current["metrics"].keys() & baseline["metrics"].keys()):
+        before, after = baseline["metrics"][name], current["metrics"][name]
+        ratio = after / before if before else (1.0 if not after else float("inf"))
+        allowed = threshold + baseline.get("spread", {}).get(name, 0.0) + current.get("spread", {}).get(name, 0.0)
+        gated = name.endswith(GATED_SUFFIXES)
+        changes.append({
+            "metric": name,
+            "baseline": before,
+            "current": after,
+            "ratio": ratio,
+            "allowed": allowed,
+            "gated": gated,
+            "regression": gated and ratio > 1 + allowed
+        })
+    return changes
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark catalog storage and keyboard builders")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma separated catalog sizes")
+    parser.add_argument("--backends", default="json,sqlite", help="comma separated storage backends")
+    parser.add_argument("--operations", type=int, default=1000, help="calls per storage operation")
+    parser.add_argument("--repeat", type=int, default=200, help="builds per keyboard size")
+    parser.add_argument("--runs", type=int, default=3, help="repetitions of every benchmark, medians are compared")
+    parser.add_argument("--output", help="write results JSON here instead of stdout")
+    parser.add_argument("--baseline", help="compare with results JSON of an earlier run")
+    parser.add_argument("--save-baseline", help="also write results JSON here for later comparison")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown, 0.10 = 10%%")
+    args = parser.parse_args()
+
+    results = run(
+        [int(size) for size in args.sizes.split(",")],
+        args.backends.split(","),
+        args.operations,
+        args.repeat,
+        args.runs
+    )
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        results["comparison"] = compare(results, baseline, args.threshold)
+        regressions = [change for change in results["comparison"] if change["regression"]]
+        for change in regressions:
+            logger.warning(
+                f"{change['metric']}: {change['baseline']:.3f} -> {change['current']:.3f} "
+                f"({(change['ratio'] - 1) * 100:+.1f}%)"
+            )
+        gated = sum(change["gated"] for change in results["comparison"])
+        logger.info(f"{len(regressions)} of {gated} gated metrics regressed")
+
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from config import BROADCAST_FILE, BROADCAST_CONCURRENCY, BROADCAST_CHUNK_SIZE, MESSAGES
+from flood_control import bulk_sending
+from user_registry import user_registry
+
+logger = logging.getLogger(__name__)
+
+_task: Optional[asyncio.Task] = None
+
+def is_running() -> bool:
+    """Check whether a broadcast is in progress"""
+    return _task is not None and not _task.done()
+
+def _save_checkpoint(checkpoint: Dict[str, Any]):
+    """Atomically store broadcast progress"""
+    tmp_path = BROADCAST_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, BROADCAST_FILE)
+
+def _load_checkpoint() -> Optional[Dict[str, Any]]:
+    """Get progress of an interrupted broadcast"""
+    try:
+        with open(BROADCAST_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+async def _send(bot: Bot, user_id: int, checkpoint: Dict[str, Any], semaphore: asyncio.Semaphore):
+    """Copy broadcast message to one user"""
+    async with semaphore:
+        try:
+            await bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=checkpoint["from_chat_id"],
+                message_id=checkpoint["message_id"]
+            )
+            checkpoint["sent"] += 1
+        except TelegramForbiddenError:
+            # Bot was blocked or the account deleted
+            user_registry.remove(user_id)
+            checkpoint["blocked"] += 1
+        except TelegramBadRequest as e:
+            if "chat not found" in e.message.lower():
+                user_registry.remove(user_id)
+                checkpoint["blocked"] += 1
+            else:
+                checkpoint["failed"] += 1
+        except Exception as e:
+            logger.warning(f"Broadcast to {user_id} failed: {e}")
+            checkpoint["failed"] += 1
+
+async def _run(bot: Bot, checkpoint: Dict[str, Any]):
+    """Send to registered users after checkpoint cursor, chunk by chunk.
+
+    A restart repeats at most the chunk that was in progress.
+    """
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    user_ids: List[int] = user_registry.sorted_ids(after=checkpoint["cursor"])
+    with bulk_sending():
+        for start in range(0, len(user_ids), BROADCAST_CHUNK_SIZE):
+            chunk = user_ids[start:start + BROADCAST_CHUNK_SIZE]
+            await asyncio.gather(*[_send(bot, user_id, checkpoint, semaphore) for user_id in chunk])
+            checkpoint["cursor"] = chunk[-1]
+            _save_checkpoint(checkpoint)
+            user_registry.flush()
+
+    os.remove(BROADCAST_FILE)
+    logger.info(f"Broadcast finished: {checkpoint}")
+    try:
+        await bot.send_message(checkpoint["admin_chat_id"], MESSAGES["broadcast_finished"].format(**checkpoint))
+    except Exception as e:
+        logger.warning(f"Cannot report broadcast result: {e}")
+
+def start_broadcast(bot: Bot, from_chat_id: int, message_id: int) -> bool:
+    """Start sending message to every registered user in the background"""
+    global _task
+    if is_running():
+        return False
+    checkpoint = {
+        "admin_chat_id": from_chat_id,
+        "from_chat_id": from_chat_id,
+        "message_id": message_id,
+        "cursor": -1,
+        "sent": 0,
+        "blocked": 0,
+        "failed": 0
+    }
+    _save_checkpoint(checkpoint)
+    _task = asyncio.create_task(_run(bot, checkpoint))
+    return True
+
+async def resume_broadcast(bot: Bot):
+    """Continue broadcast interrupted by a restart (dispatcher startup hook)"""
+    global _task
+    checkpoint = _load_checkpoint()
+    if checkpoint is not None and not is_running():
+        logger.info(f"Resuming broadcast after user {checkpoint['cursor']}")
+        _task = asyncio.create_task(_run(bot, checkpoint))
@@ -1,13 +1,143 @@
 import os
+import secrets
 
 # Bot configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8324176530:AAHUQ0Eze7_5Jhbe3yTtIUDogHVFCFiFNeU")
 ADMIN_USERNAME = "Vladco34vlad"
 
+# Bot API server base URL, e.g. a local telegram-bot-api instance; empty for api.telegram.org
+TELEGRAM_API_SERVER = os.getenv("TELEGRAM_API_SERVER", "")
+
+# Update delivery: "polling" or "webhook"
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+
+# Webhook mode: public base URL Telegram posts to and the local server behind it
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Secret token Telegram sends with every update; random per start when unset,
+# set_webhook registers it again on every start
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+# Updates processed at once and queued before answering 503 to Telegram
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "64"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+# Worker processes; above 1 a supervisor receives updates and shards them by chat id.
+# Workers share the catalog, so this needs STORAGE_BACKEND=sqlite
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Seconds a stopping worker gets to finish queued updates before it is killed
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", "40"))
+
 # File paths
 MOVIES_FILE = "movies.json"
 PARTNERS_FILE = "partners.json"
 
+# Catalog storage backend: "json" (MOVIES_FILE/PARTNERS_FILE) or "sqlite"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+SQLITE_FILE = os.getenv("SQLITE_FILE", "catalog.db")
+
+# Number of journaled movie edits after which movies.json is rewritten
+MOVIES_COMPACT_THRESHOLD = int(os.getenv("MOVIES_COMPACT_THRESHOLD", "1000"))
+
+# Threads used by AsyncDataManager for blocking storage work
+DATA_MANAGER_WORKERS = int(os.getenv("DATA_MANAGER_WORKERS", "4"))
+
+# Partner subscription verification through getChatMember
+SUBSCRIPTION_CHECK_ENABLED = os.getenv("SUBSCRIPTION_CHECK_ENABLED", "0") == "1"
+SUBSCRIPTION_CHECK_TIMEOUT = float(os.getenv("SUBSCRIPTION_CHECK_TIMEOUT", "3"))
+SUBSCRIPTION_POSITIVE_TTL = float(os.getenv("SUBSCRIPTION_POSITIVE_TTL", "300"))
+SUBSCRIPTION_NEGATIVE_TTL = float(os.getenv("SUBSCRIPTION_NEGATIVE_TTL", "15"))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "100000"))
+
+# Number of rendered code lookup responses kept in memory
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "1000"))
+# Codes known to be missing, repeated lookups skip storage and the title search
+MISSING_CACHE_SIZE = int(os.getenv("MISSING_CACHE_SIZE", "10000"))
+
+# Signs /start deep link payloads when set, unsigned or forged links then open the plain menu
+DEEP_LINK_SECRET = os.getenv("DEEP_LINK_SECRET", "")
+
+# Similar titles offered when a code is not found, and the minimal similarity (0..1)
+SEARCH_SUGGESTIONS = int(os.getenv("SEARCH_SUGGESTIONS", "5"))
+SEARCH_MIN_SCORE = float(os.getenv("SEARCH_MIN_SCORE", "0.3"))
+
+# Inline mode (@bot query): results per page, total results, Telegram side cache seconds, cached pages
+INLINE_PAGE_SIZE = int(os.getenv("INLINE_PAGE_SIZE", "20"))
+INLINE_MAX_RESULTS = int(os.getenv("INLINE_MAX_RESULTS", "100"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "1000"))
+
+# Send poster, caption and episodes keyboard of a found code as one message
+SINGLE_MESSAGE_DELIVERY = os.getenv("SINGLE_MESSAGE_DELIVERY", "1") == "1"
+
+# Episode keyboard grid: buttons per page (Telegram allows 100 per message) and per row
+EPISODES_PER_PAGE = int(os.getenv("EPISODES_PER_PAGE", "24"))
+EPISODES_PER_ROW = int(os.getenv("EPISODES_PER_ROW", "4"))
+
+# FSM storage: "sqlite" (persistent, FSM_DB_FILE) or "memory"
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_DB_FILE = os.getenv("FSM_DB_FILE", "fsm.db")
+# States kept in memory, idle time after which a state is dropped, write batching period
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "100000"))
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))
+
+# Registry of bot users (append-only file of ids) and admin broadcasts to them
+USERS_FILE = os.getenv("USERS_FILE", "users.bin")
+USERS_FLUSH_INTERVAL = float(os.getenv("USERS_FLUSH_INTERVAL", "5"))
+BROADCAST_FILE = os.getenv("BROADCAST_FILE", "broadcast.json")
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "500"))
+
+# Episode link health checks: results database, HTTP connections overall and per host,
+# request timeout, how long ok and broken results are trusted, hours between scheduled runs (0 disables)
+LINK_CHECK_DB_FILE = os.getenv("LINK_CHECK_DB_FILE", "link_checks.db")
+LINK_CHECK_CONCURRENCY = int(os.getenv("LINK_CHECK_CONCURRENCY", "100"))
+LINK_CHECK_PER_HOST = int(os.getenv("LINK_CHECK_PER_HOST", "4"))
+LINK_CHECK_TIMEOUT = float(os.getenv("LINK_CHECK_TIMEOUT", "15"))
+LINK_CHECK_OK_TTL = float(os.getenv("LINK_CHECK_OK_TTL", str(3 * 86400)))
+LINK_CHECK_BROKEN_TTL = float(os.getenv("LINK_CHECK_BROKEN_TTL", "3600"))
+LINK_CHECK_INTERVAL = float(os.getenv("LINK_CHECK_INTERVAL", "24"))
+
+# Outgoing Bot API limits: messages per second overall, per private chat (with burst) and per group
+FLOOD_GLOBAL_RATE = float(os.getenv("FLOOD_GLOBAL_RATE", "30"))
+FLOOD_CHAT_RATE = float(os.getenv("FLOOD_CHAT_RATE", "1"))
+FLOOD_CHAT_BURST = float(os.getenv("FLOOD_CHAT_BURST", "3"))
+FLOOD_GROUP_RATE = float(os.getenv("FLOOD_GROUP_RATE", str(20 / 60)))
+FLOOD_MAX_RETRIES = int(os.getenv("FLOOD_MAX_RETRIES", "3"))
+
+# Incoming limit per user: messages and button presses per second after a burst, the rest
+# is dropped unanswered; THROTTLE_RATE=0 disables it. Idle users are forgotten every interval
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "2"))
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", "10"))
+THROTTLE_EVICT_INTERVAL = float(os.getenv("THROTTLE_EVICT_INTERVAL", "60"))
+
+# Prometheus metrics served on http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Popularity analytics in fixed memory: count-min sketches of code lookups and misses
+# (width x depth counters, halved every day) with the top codes, unique users per day for
+# ANALYTICS_DAYS days; saved every flush interval, the top ANALYTICS_WARM_CODES stay rendered
+ANALYTICS_FILE = os.getenv("ANALYTICS_FILE", "analytics.json")
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "60"))
+ANALYTICS_SKETCH_WIDTH = int(os.getenv("ANALYTICS_SKETCH_WIDTH", "4096"))
+ANALYTICS_SKETCH_DEPTH = int(os.getenv("ANALYTICS_SKETCH_DEPTH", "4"))
+ANALYTICS_TOP_SIZE = int(os.getenv("ANALYTICS_TOP_SIZE", "50"))
+ANALYTICS_DAYS = int(os.getenv("ANALYTICS_DAYS", "7"))
+ANALYTICS_WARM_CODES = int(os.getenv("ANALYTICS_WARM_CODES", "20"))
+
+# Update tracing: share of updates written to TRACE_FILE as JSON lines, plus every update
+# slower than TRACE_SLOW_MS (0 disables each); the file rotates at TRACE_FILE_MAX_BYTES
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1000"))
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", str(50 * 2 ** 20)))
+TRACE_FILE_BACKUPS = int(os.getenv("TRACE_FILE_BACKUPS", "3"))
+
 # Messages
 MESSAGES = {
     "start_with_partners": """📢 Чтобы пользоваться ботом, подпишись на всех партнёров:
@@ -16,11 +146,26 @@ MESSAGES = {
 
 После подписки нажми кнопку "✅ Проверить подписку\"""",
     
+    "subscribe_first": """📢 Сначала подпишись на всех партнёров:
+
+{partners}
+
+После подписки нажми кнопку "✅ Проверить подписку\"""",
+    
+    "not_subscribed": "❌ Вы ещё не подписались на всех партнёров.",
+    "inline_subscribe": "📢 Подпишись на партнёров, чтобы искать",
+    
+    "main_menu": "🎬 Главное меню. Выберите действие:",
+    "welcome": "🎬 Добро пожаловать! Выберите действие из меню:",
+    
     "enter_code": "✏️ Введи код фильма, аниме или дорамы:",
     
     "code_not_found": """❌ По этому коду ничего не найдено.
 Попробуйте ещё раз или нажмите "🔙 Назад" для возврата в меню.""",
     
+    "code_suggestions": """❌ По этому коду ничего не найдено.
+Возможно, вы искали одно из этого:""",
+    
     "no_partners": "🤷‍♂️ Партнёров пока нет.",
     
     "help_message": """ℹ️ <b>Помощь по использованию бота</b>
@@ -42,18 +187,42 @@ MESSAGES = {
     
     "enter_movie_code": "1️⃣ Введите уникальный код:",
     "enter_movie_title": "2️⃣ Введите название:",
-    "enter_movie_poster": "3️⃣ Введите ссылку на постер:",
-    "enter_movie_episodes": "4️⃣ Введите ссылки на эпизоды через запятую:",
+    "enter_movie_poster": "3️⃣ Введите ссылку на постер или отправьте фото:",
+    "enter_movie_episodes": """4️⃣ Введите ссылки на эпизоды через запятую.
+
+Диапазон серий можно задать одной ссылкой:
+<code>https://jut.su/atelier-meister/episode-{1..24}.html</code>""",
+    "invalid_episodes": "❌ Неверный диапазон эпизодов: {error}. Попробуйте ещё раз:",
     
     "movie_added": "✅ Запись успешно добавлена!",
     "movie_deleted": "✅ Запись успешно удалена!",
     "movie_not_found_delete": "❌ Запись с таким кодом не найдена.",
     
+    "enter_link_code": "🔗 Введите код записи, для которой нужна ссылка:",
+    "movie_link": "🔗 Ссылка на «{title}»:\n<code>{link}</code>",
+    "movie_link_too_long": "❌ Код слишком длинный для ссылки, Telegram допускает до 64 символов.",
+    
     "enter_delete_code": "Введите код записи для удаления:",
     
     "partner_added": "✅ Партнёр успешно добавлен!",
     "partner_deleted": "✅ Партнёр успешно удалён!",
     "enter_partner_link": "Введите ссылку на партнёрский канал (например: @channelname):",
     
-    "statistics": "📊 <b>Статистика</b>\n\n🎬 Всего записей: {movies_count}\n👥 Партнёров: {partners_count}"
+    "statistics": "📊 <b>Статистика</b>\n\n🎬 Всего записей: {movies_count}\n👥 Партнёров: {partners_count}\n🙋 Пользователей: {users_count}",
+    "statistics_users": "\n\n📈 <b>Уникальные пользователи</b>\n{days}\nЗа {days_count} дн.: ~{total}",
+    "statistics_day": "{day}: ~{users}",
+    "statistics_top": "\n\n🔥 <b>Популярные коды</b>\n{codes}",
+    "statistics_top_misses": "\n\n❓ <b>Частые ненайденные коды</b>\n{codes}",
+    "statistics_code": "{place}. <code>{code}</code> — {count}",
+    
+    "enter_broadcast_message": "📢 Отправьте сообщение для рассылки (текст, фото или видео):",
+    "broadcast_started": "✅ Рассылка запущена для {users_count} пользователей. Отчёт придёт по завершении.",
+    "broadcast_running": "⏳ Рассылка уже идёт, дождитесь её завершения.",
+    "broadcast_finished": "📢 <b>Рассылка завершена</b>\n\n✅ Доставлено: {sent}\n🚫 Заблокировали бота: {blocked}\n❌ Ошибок: {failed}",
+    
+    "links_check_started": "🩺 Проверка ссылок на эпизоды запущена. Отчёт придёт по завершении.",
+    "links_check_running": "⏳ Проверка ссылок уже идёт: {done} из {total}.",
+    "links_report": "🩺 <b>Проверка ссылок завершена</b>\n\n🔗 Ссылок: {urls}\n🌐 Проверено: {checked} (без изменений: {not_modified})\n💾 Из кэша: {cached}\n❌ Битых: {broken_links} в {broken_codes} записях",
+    "links_report_line": "• <code>{code}</code> {title}: {episodes}",
+    "links_report_more": "…и ещё {count} записей"
 }
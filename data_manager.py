@@ -1,13 +1,31 @@
+import asyncio
 import json
+import logging
 import os
-from typing import Dict, List, Any, Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Any, Optional, Sequence, Tuple
 
-class DataManager:
-    """Manages data storage and retrieval for movies and partners"""
+from movie_records import EpisodeList, MovieRecord
+
+logger = logging.getLogger(__name__)
+
+class JsonStorage:
+    """Storage backend keeping movies and partners in JSON files"""
     
-    def __init__(self, movies_file: str, partners_file: str):
+    def __init__(self, movies_file: str, partners_file: str, compact_threshold: int = 1000):
         self.movies_file = movies_file
         self.partners_file = partners_file
+        # Movie mutations are appended here and folded into movies_file by compaction
+        self.journal_file = movies_file + ".journal"
+        self.compact_threshold = compact_threshold
+        # Resident copies of the JSON files: path -> (file signature, parsed data)
+        self._cache: Dict[str, Tuple[Any, Any]] = {}
+        self.cache_stats = {"hits": 0, "misses": 0, "reloads": 0}
+        self._lock = threading.RLock()
+        self._journal_records = 0
+        self._compacting = False
         self._initialize_files()
     
     def _initialize_files(self):
@@ -18,49 +36,250 @@ class DataManager:
         if not os.path.exists(self.partners_file):
             self._save_json(self.partners_file, [])
     
-    def _load_json(self, file_path: str) -> Any:
-        """Load data from JSON file"""
+    def _file_signature(self, file_path: str) -> Optional[Tuple[int, int, int]]:
+        """Get (mtime, size, inode) of a file, used to detect external changes"""
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    
+    def _movies_signature(self) -> Tuple[Any, ...]:
+        """Signature of the snapshot together with its journals"""
+        return (
+            self._file_signature(self.movies_file),
+            self._file_signature(self.journal_file + ".old"),
+            self._file_signature(self.journal_file)
+        )
+    
+    def _read_json(self, file_path: str) -> Any:
+        """Read and parse a JSON file from disk"""
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
                 return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {} if file_path == self.movies_file else []
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError:
+            logger.error(f"Failed to parse {file_path}, using empty data")
+        return {} if file_path == self.movies_file else []
+    
+    def _load_json(self, file_path: str) -> Any:
+        """Load data from JSON file, served from memory while the file is unchanged"""
+        if file_path == self.movies_file:
+            return self._load_movies()
+        
+        with self._lock:
+            signature = self._file_signature(file_path)
+            cached = self._cache.get(file_path)
+            if cached is not None and signature is not None and cached[0] == signature:
+                self.cache_stats["hits"] += 1
+                return cached[1]
+            
+            self._count_load(cached)
+            data = self._read_json(file_path)
+            self._cache[file_path] = (signature, data)
+            return data
+    
+    def _load_movies(self) -> Dict[str, MovieRecord]:
+        """Load the movies snapshot and replay the journal on top of it"""
+        with self._lock:
+            signature = self._movies_signature()
+            cached = self._cache.get(self.movies_file)
+            if cached is not None and cached[0] == signature:
+                self.cache_stats["hits"] += 1
+                return cached[1]
+            
+            self._count_load(cached)
+            movies = {
+                code: MovieRecord.from_dict(movie) for code, movie in self._read_json(self.movies_file).items()
+            }
+            self._journal_records = 0
+            for journal in (self.journal_file + ".old", self.journal_file):
+                self._journal_records += self._replay_journal(journal, movies)
+            
+            self._cache[self.movies_file] = (signature, movies)
+        
+        if self._journal_records >= self.compact_threshold:
+            self._start_compaction()
+        return movies
+    
+    def _count_load(self, cached: Any):
+        """Account a cache miss or a reload after an external change"""
+        if cached is None:
+            self.cache_stats["misses"] += 1
+        else:
+            self.cache_stats["reloads"] += 1
+    
+    def _replay_journal(self, journal: str, movies: Dict[str, MovieRecord]) -> int:
+        """Apply journal records to movies, returns number of applied records.
+
+        Only the final line may be torn by an interrupted append, it is cut
+        off. A damaged record followed by others is corruption: it is logged
+        and skipped, the records after it are still applied.
+        """
+        applied = 0
+        size = 0
+        # (line number, line) of the last record that failed to parse
+        damaged: Optional[Tuple[int, bytes]] = None
+        try:
+            with open(journal, 'rb') as f:
+                for number, line in enumerate(f, 1):
+                    if damaged is not None:
+                        logger.error(
+                            f"Skipping corrupted record on line {damaged[0]} of {journal}: {damaged[1][:200]!r}"
+                        )
+                        damaged = None
+                    size += len(line)
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("incomplete record")
+                        self._apply_record(movies, json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        damaged = (number, line)
+                        continue
+                    applied += 1
+        except FileNotFoundError:
+            return 0
+        
+        if damaged is not None:
+            # Torn tail of an interrupted append, cut so the next append starts on a clean line
+            logger.warning(f"Dropping damaged record at the end of {journal}")
+            os.truncate(journal, size - len(damaged[1]))
+        return applied
+    
+    def _apply_record(self, movies: Dict[str, MovieRecord], record: Dict[str, Any]):
+        """Apply one journal record to movies"""
+        if record["op"] == "set":
+            movies[record["code"]] = MovieRecord.from_dict(record["movie"])
+        elif record["op"] == "delete":
+            movies.pop(record["code"], None)
+    
+    def _append_journal(self, record: Dict[str, Any]):
+        """Durably append a mutation record and apply it to the resident catalog"""
+        with self._lock:
+            movies = self._load_movies()
+            line = json.dumps(record, ensure_ascii=False) + "\n"
+            with open(self.journal_file, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._apply_record(movies, record)
+            self._journal_records += 1
+            self._cache[self.movies_file] = (self._movies_signature(), movies)
+            need_compaction = self._journal_records >= self.compact_threshold
+        
+        if need_compaction:
+            self._start_compaction()
+    
+    def _start_compaction(self):
+        """Fold the journal into a new snapshot in a background thread"""
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+        threading.Thread(target=self.compact, name="movies-compaction", daemon=True).start()
+    
+    def compact(self):
+        """Write the current catalog as a new snapshot and drop the folded journal"""
+        old_journal = self.journal_file + ".old"
+        try:
+            with self._lock:
+                movies = dict(self._load_movies())
+                # New appends go to a fresh journal while the snapshot is written
+                if os.path.exists(self.journal_file):
+                    if os.path.exists(old_journal):
+                        with open(self.journal_file, 'r', encoding='utf-8') as src, \
+                                open(old_journal, 'a', encoding='utf-8') as dst:
+                            dst.write(src.read())
+                        os.remove(self.journal_file)
+                    else:
+                        os.replace(self.journal_file, old_journal)
+                self._journal_records = 0
+                self._cache[self.movies_file] = (self._movies_signature(), self._cache[self.movies_file][1])
+            
+            self._write_atomic(self.movies_file, self._encode_movies(movies))
+            
+            with self._lock:
+                if os.path.exists(old_journal):
+                    os.remove(old_journal)
+                self._cache[self.movies_file] = (self._movies_signature(), self._cache[self.movies_file][1])
+        except OSError as e:
+            logger.error(f"Movies compaction failed: {e}")
+        finally:
+            self._compacting = False
+    
+    def _write_atomic(self, file_path: str, data: Any):
+        """Write JSON to a temporary file and rename it over the target"""
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    
+    @staticmethod
+    def _encode_movies(movies: Dict[str, MovieRecord]) -> Dict[str, Any]:
+        """Movies in the movies.json form"""
+        return {code: movie.to_json() for code, movie in movies.items()}
     
     def _save_json(self, file_path: str, data: Any):
         """Save data to JSON file"""
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with self._lock:
+            self._write_atomic(file_path, data)
+            # Our own write must not look like an external change
+            if file_path == self.movies_file:
+                self._cache[file_path] = (self._movies_signature(), data)
+            else:
+                self._cache[file_path] = (self._file_signature(file_path), data)
+    
+    def get_cache_stats(self) -> Dict[str, int]:
+        """Get catalog cache hit/miss/reload counters"""
+        return dict(self.cache_stats)
     
     # Movie methods
     def get_movie(self, code: str) -> Optional[Dict[str, Any]]:
         """Get movie by code"""
-        movies = self._load_json(self.movies_file)
-        return movies.get(code)
+        movie = self._load_movies().get(code)
+        return movie.to_dict() if movie is not None else None
     
-    def add_movie(self, code: str, title: str, poster: str, episodes: List[str]):
+    def add_movie(self, code: str, title: str, poster: str, episodes: Sequence[str]):
         """Add new movie"""
-        movies = self._load_json(self.movies_file)
-        movies[code] = {
-            "title": title,
-            "poster": poster,
-            "episodes": episodes
-        }
-        self._save_json(self.movies_file, movies)
+        movie = MovieRecord(title, poster, EpisodeList.from_urls(episodes))
+        with self._lock:
+            # Keep the uploaded poster file_id while the poster itself is unchanged
+            old_movie = self._load_movies().get(code)
+            if old_movie is not None and old_movie.poster == poster:
+                movie.poster_file_id = old_movie.poster_file_id
+            self._append_journal({"op": "set", "code": code, "movie": movie.to_json()})
+    
+    def set_poster_file_id(self, code: str, file_id: Optional[str]):
+        """Remember Telegram file_id of movie poster, None clears it"""
+        with self._lock:
+            movie = self._load_movies().get(code)
+            if movie is None or movie.poster_file_id == (file_id or None):
+                return
+            movie = MovieRecord(movie.title, movie.poster, movie.episodes, file_id or None)
+            self._append_journal({"op": "set", "code": code, "movie": movie.to_json()})
     
     def delete_movie(self, code: str) -> bool:
         """Delete movie by code"""
-        movies = self._load_json(self.movies_file)
-        if code in movies:
-            del movies[code]
-            self._save_json(self.movies_file, movies)
-            return True
-        return False
+        with self._lock:
+            movies = self._load_json(self.movies_file)
+            if code in movies:
+                self._append_journal({"op": "delete", "code": code})
+                return True
+            return False
     
     def get_movies_count(self) -> int:
         """Get total number of movies"""
         movies = self._load_json(self.movies_file)
         return len(movies)
     
+    def get_titles(self) -> Dict[str, str]:
+        """Get titles of all movies by code"""
+        movies = self._load_json(self.movies_file)
+        return {code: movie.title for code, movie in movies.items()}
+    
     # Partner methods
     def get_partners(self) -> List[str]:
         """Get all partners"""
@@ -68,25 +287,231 @@ class DataManager:
     
     def add_partner(self, partner: str):
         """Add new partner"""
-        partners = self._load_json(self.partners_file)
-        if partner not in partners:
-            partners.append(partner)
-            self._save_json(self.partners_file, partners)
+        with self._lock:
+            partners = list(self._load_json(self.partners_file))
+            if partner not in partners:
+                partners.append(partner)
+                self._save_json(self.partners_file, partners)
     
     def delete_partner(self, partner: str) -> bool:
         """Delete partner"""
-        partners = self._load_json(self.partners_file)
-        if partner in partners:
-            partners.remove(partner)
-            self._save_json(self.partners_file, partners)
-            return True
-        return False
+        with self._lock:
+            partners = list(self._load_json(self.partners_file))
+            if partner in partners:
+                partners.remove(partner)
+                self._save_json(self.partners_file, partners)
+                return True
+            return False
     
     def get_partners_count(self) -> int:
         """Get total number of partners"""
         partners = self._load_json(self.partners_file)
         return len(partners)
+    
+    # Migration methods
+    def export_catalog(self) -> Tuple[Dict[str, Any], List[str]]:
+        """Get full copies of movies and partners"""
+        with self._lock:
+            movies = {code: movie.to_dict() for code, movie in self._load_movies().items()}
+            return movies, list(self._load_json(self.partners_file))
+    
+    def import_catalog(self, movies: Dict[str, Any], partners: List[str]):
+        """Replace all stored movies and partners"""
+        with self._lock:
+            records = {code: MovieRecord.from_dict(movie) for code, movie in movies.items()}
+            self._write_atomic(self.movies_file, self._encode_movies(records))
+            for journal in (self.journal_file + ".old", self.journal_file):
+                if os.path.exists(journal):
+                    os.remove(journal)
+            self._journal_records = 0
+            self._cache[self.movies_file] = (self._movies_signature(), records)
+            self._save_json(self.partners_file, list(partners))
+
+class DataManager:
+    """Manages data storage and retrieval for movies and partners"""
+    
+    def __init__(self, storage):
+        self.storage = storage
+        # (callback, local_only) pairs
+        self._listeners: List[Tuple[Callable[[str, Optional[str]], None], bool]] = []
+    
+    def add_listener(self, callback: Callable[[str, Optional[str]], None], local_only: bool = False):
+        """Register callback(kind, key) called after every change.
+        
+        kind is "movie" (key is the movie code), "poster" (only the poster file_id
+        of movie key changed) or "partners" (key is None).
+        Callbacks may run in AsyncDataManager worker threads and must be quick.
+        local_only callbacks skip changes reported by notify_external.
+        """
+        self._listeners.append((callback, local_only))
+    
+    def _notify(self, kind: str, key: Optional[str] = None, external: bool = False):
+        """Tell listeners that stored data changed"""
+        for callback, local_only in self._listeners:
+            if external and local_only:
+                continue
+            try:
+                callback(kind, key)
+            except Exception as e:
+                logger.error(f"Change listener failed: {e}")
+    
+    def notify_external(self, kind: str, key: Optional[str] = None):
+        """Tell listeners about a change another process made to the shared storage"""
+        self._notify(kind, key, external=True)
+    
+    def get_cache_stats(self) -> Dict[str, int]:
+        """Get catalog cache hit/miss/reload counters"""
+        return self.storage.get_cache_stats()
+    
+    # Movie methods
+    def get_movie(self, code: str) -> Optional[Dict[str, Any]]:
+        """Get movie by code"""
+        return self.storage.get_movie(code)
+    
+    def add_movie(self, code: str, title: str, poster: str, episodes: Sequence[str]):
+        """Add new movie"""
+        self.storage.add_movie(code, title, poster, episodes)
+        self._notify("movie", code)
+    
+    def delete_movie(self, code: str) -> bool:
+        """Delete movie by code"""
+        deleted = self.storage.delete_movie(code)
+        if deleted:
+            self._notify("movie", code)
+        return deleted
+    
+    def set_poster_file_id(self, code: str, file_id: Optional[str]):
+        """Remember Telegram file_id of movie poster, None clears it"""
+        self.storage.set_poster_file_id(code, file_id)
+        self._notify("poster", code)
+    
+    def get_movies_count(self) -> int:
+        """Get total number of movies"""
+        return self.storage.get_movies_count()
+    
+    def get_titles(self) -> Dict[str, str]:
+        """Get titles of all movies by code"""
+        return self.storage.get_titles()
+    
+    # Partner methods
+    def get_partners(self) -> List[str]:
+        """Get all partners"""
+        return self.storage.get_partners()
+    
+    def add_partner(self, partner: str):
+        """Add new partner"""
+        self.storage.add_partner(partner)
+        self._notify("partners")
+    
+    def delete_partner(self, partner: str) -> bool:
+        """Delete partner"""
+        deleted = self.storage.delete_partner(partner)
+        if deleted:
+            self._notify("partners")
+        return deleted
+    
+    def get_partners_count(self) -> int:
+        """Get total number of partners"""
+        return self.storage.get_partners_count()
+
+class AsyncDataManager:
+    """Async DataManager API running blocking storage work in a bounded thread pool"""
+    
+    def __init__(self, manager: DataManager, max_workers: int = 4):
+        self.manager = manager
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="data-manager")
+        # Reads currently in flight: (method, args) -> future shared by all callers
+        self._inflight: Dict[Tuple[Any, ...], asyncio.Future] = {}
+        # Callbacks(method, seconds) timing every call, added by metrics and tracing
+        self.operation_observers: List[Callable[[str, float], None]] = []
+    
+    async def _run(self, method: str, *args):
+        """Run DataManager method in the thread pool"""
+        loop = asyncio.get_running_loop()
+        if not self.operation_observers:
+            return await loop.run_in_executor(self._executor, getattr(self.manager, method), *args)
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, getattr(self.manager, method), *args)
+        finally:
+            seconds = time.perf_counter() - started
+            for observer in self.operation_observers:
+                observer(method, seconds)
+    
+    async def _read(self, method: str, *args):
+        """Run read method, coalescing identical concurrent calls into one"""
+        key = (method, *args)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._run(method, *args))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so one cancelled caller does not cancel the load for the others
+        return await asyncio.shield(future)
+    
+    async def notify_external(self, kind: str, key: Optional[str] = None):
+        """Apply a change made by another process, listeners may read storage"""
+        await self._run("notify_external", kind, key)
+    
+    def shutdown(self):
+        """Stop the thread pool"""
+        self._executor.shutdown(wait=True)
+    
+    # Movie methods
+    async def get_movie(self, code: str) -> Optional[Dict[str, Any]]:
+        """Get movie by code"""
+        return await self._read("get_movie", code)
+    
+    async def add_movie(self, code: str, title: str, poster: str, episodes: Sequence[str]):
+        """Add new movie"""
+        await self._run("add_movie", code, title, poster, episodes)
+    
+    async def delete_movie(self, code: str) -> bool:
+        """Delete movie by code"""
+        return await self._run("delete_movie", code)
+    
+    async def set_poster_file_id(self, code: str, file_id: Optional[str]):
+        """Remember Telegram file_id of movie poster, None clears it"""
+        await self._run("set_poster_file_id", code, file_id)
+    
+    async def get_movies_count(self) -> int:
+        """Get total number of movies"""
+        return await self._read("get_movies_count")
+    
+    async def get_titles(self) -> Dict[str, str]:
+        """Get titles of all movies by code"""
+        return await self._read("get_titles")
+    
+    # Partner methods
+    async def get_partners(self) -> List[str]:
+        """Get all partners"""
+        return await self._read("get_partners")
+    
+    async def add_partner(self, partner: str):
+        """Add new partner"""
+        await self._run("add_partner", partner)
+    
+    async def delete_partner(self, partner: str) -> bool:
+        """Delete partner"""
+        return await self._run("delete_partner", partner)
+    
+    async def get_partners_count(self) -> int:
+        """Get total number of partners"""
+        return await self._read("get_partners_count")
+
+def create_storage(backend: str):
+    """Create storage backend by name from config"""
+    if backend == "json":
+        return JsonStorage(MOVIES_FILE, PARTNERS_FILE, MOVIES_COMPACT_THRESHOLD)
+    if backend == "sqlite":
+        from sqlite_storage import SqliteStorage
+        return SqliteStorage(SQLITE_FILE)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
 
 # Global instance
-from config import MOVIES_FILE, PARTNERS_FILE
-data_manager = DataManager(MOVIES_FILE, PARTNERS_FILE)
+from config import (
+    MOVIES_FILE, PARTNERS_FILE, MOVIES_COMPACT_THRESHOLD, SQLITE_FILE, STORAGE_BACKEND, DATA_MANAGER_WORKERS
+)
+data_manager = DataManager(create_storage(STORAGE_BACKEND))
+async_data_manager = AsyncDataManager(data_manager, DATA_MANAGER_WORKERS)
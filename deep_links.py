@@ -0,0 +1,59 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import re
+from typing import List, Optional
+
+from aiogram import Bot
+
+from config import DEEP_LINK_SECRET
+
+# Telegram accepts only these characters in /start payloads, at most 64 of them
+_PAYLOAD_CHARS = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+MAX_PAYLOAD_LENGTH = 64
+SIGNATURE_LENGTH = 8
+
+def _signature(body: str) -> str:
+    return hmac.new(DEEP_LINK_SECRET.encode(), body.encode(), hashlib.sha256).hexdigest()[:SIGNATURE_LENGTH]
+
+def _encode(code: str) -> str:
+    return base64.urlsafe_b64encode(code.encode()).decode().rstrip("=")
+
+def _decode(body: str) -> Optional[str]:
+    try:
+        return base64.urlsafe_b64decode(body + "=" * (-len(body) % 4)).decode()
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+def create_payload(code: str) -> Optional[str]:
+    """/start payload opening code, None if it does not fit into 64 characters.
+
+    Codes made of allowed characters are used as is, others are base64url
+    encoded. With DEEP_LINK_SECRET set the payload ends with -<hmac>.
+    """
+    body = code if _PAYLOAD_CHARS.match(code) else _encode(code)
+    if DEEP_LINK_SECRET:
+        body = f"{body}-{_signature(body)}"
+    return body if len(body) <= MAX_PAYLOAD_LENGTH else None
+
+def payload_codes(payload: str) -> List[str]:
+    """Codes a payload can stand for, most likely first; empty if the signature is wrong"""
+    if DEEP_LINK_SECRET:
+        body, _, signature = payload.rpartition("-")
+        if not body or not hmac.compare_digest(signature, _signature(body)):
+            return []
+        payload = body
+    codes = [payload]
+    decoded = _decode(payload)
+    if decoded and decoded != payload:
+        codes.append(decoded)
+    return codes
+
+async def start_link(bot: Bot, code: str) -> Optional[str]:
+    """t.me link that opens code in the bot"""
+    payload = create_payload(code)
+    if payload is None:
+        return None
+    me = await bot.me()
+    return f"https://t.me/{me.username}?start={payload}"
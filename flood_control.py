@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+from config import (
+    FLOOD_GLOBAL_RATE,
+    FLOOD_CHAT_RATE,
+    FLOOD_CHAT_BURST,
+    FLOOD_GROUP_RATE,
+    FLOOD_MAX_RETRIES,
+    WORKERS
+)
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# Priority of Bot API calls made by the current task
+outbound_priority: ContextVar[int] = ContextVar("outbound_priority", default=INTERACTIVE)
+
+@contextmanager
+def bulk_sending() -> Iterator[None]:
+    """Send Bot API calls made inside the block after all interactive ones"""
+    token = outbound_priority.set(BULK)
+    try:
+        yield
+    finally:
+        outbound_priority.reset(token)
+
+def is_rate_limited(method: TelegramMethod) -> bool:
+    """Only calls posting into chats count towards Telegram flood limits"""
+    name = method.__api_method__
+    return name.startswith(("send", "edit", "copy", "forward")) and hasattr(method, "chat_id")
+
+class FloodScheduler:
+    """Global token bucket with priority queues plus per-chat token buckets"""
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 group_rate: float = 20 / 60):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self._tokens = global_rate
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._queues: Dict[int, Deque[asyncio.Future]] = {INTERACTIVE: deque(), BULK: deque()}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # chat_id -> [tokens, updated]
+        self._chats: Dict[Any, List[float]] = {}
+        self.stats = {
+            name: {"requests": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for name in PRIORITY_NAMES.values()
+        }
+        self.stats["retries"] = 0
+
+    def queue_depth(self) -> Dict[str, int]:
+        """Number of calls waiting for the global limit by priority"""
+        return {PRIORITY_NAMES[p]: len(queue) for p, queue in self._queues.items()}
+
+    def pause(self, seconds: float):
+        """Stop all sending for a while, used after RetryAfter"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id: Any, priority: int = INTERACTIVE):
+        """Wait until a call into chat_id is allowed"""
+        started = time.monotonic()
+        # Inline message edits have no chat, only the global limit applies to them
+        chat_wait = self._reserve_chat(chat_id, started) if chat_id is not None else 0.0
+        if chat_wait > 0:
+            await asyncio.sleep(chat_wait)
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].append(future)
+        self._dispatch()
+        await future
+
+        waited = time.monotonic() - started
+        stats = self.stats[PRIORITY_NAMES[priority]]
+        stats["requests"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+
+    def _reserve_chat(self, chat_id: Any, now: float) -> float:
+        """Take a token from chat bucket, returns how long to wait for it"""
+        rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 10_000:
+                self._forget_idle_chats(now)
+            bucket = self._chats[chat_id] = [self.chat_burst, now]
+        bucket[0] = min(self.chat_burst, bucket[0] + (now - bucket[1]) * rate) - 1
+        bucket[1] = now
+        return -bucket[0] / rate if bucket[0] < 0 else 0.0
+
+    def _forget_idle_chats(self, now: float):
+        """Drop buckets that have refilled completely"""
+        full_after = self.chat_burst / min(self.chat_rate, self.group_rate)
+        for chat_id in [c for c, (_, updated) in self._chats.items() if now - updated > full_after]:
+            del self._chats[chat_id]
+
+    def _dispatch(self):
+        """Release waiting calls while global tokens last, interactive first"""
+        now = time.monotonic()
+        self._tokens = min(self.global_rate, self._tokens + (now - self._updated) * self.global_rate)
+        self._updated = now
+
+        if now >= self._paused_until:
+            for priority in (INTERACTIVE, BULK):
+                queue = self._queues[priority]
+                while queue and self._tokens >= 1:
+                    future = queue.popleft()
+                    if not future.done():
+                        future.set_result(None)
+                        self._tokens -= 1
+                if queue:
+                    break
+
+        if any(self._queues.values()) and self._timer is None:
+            delay = max((1 - self._tokens) / self.global_rate, self._paused_until - now, 0.001)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+class FloodControlMiddleware(BaseRequestMiddleware):
+    """Bot session middleware scheduling outgoing calls under Telegram flood limits"""
+
+    def __init__(self, scheduler: FloodScheduler, max_retries: int = FLOOD_MAX_RETRIES):
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        if not is_rate_limited(method):
+            return await make_request(bot, method)
+
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(method.chat_id, outbound_priority.get())
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                self.scheduler.stats["retries"] += 1
+                logger.warning(f"Flood limit hit on {method.__api_method__}, retrying in {e.retry_after}s")
+                self.scheduler.pause(e.retry_after)
+
+# Worker processes share the bot's global limit, chats stay on one worker
+flood_scheduler = FloodScheduler(FLOOD_GLOBAL_RATE / WORKERS, FLOOD_CHAT_RATE, FLOOD_CHAT_BURST, FLOOD_GROUP_RATE)
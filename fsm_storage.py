@@ -0,0 +1,226 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS fsm_updated_at ON fsm (updated_at);
+"""
+
+class _Record:
+    """Cached FSM record of one storage key"""
+    __slots__ = ("state", "data", "updated_at")
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], updated_at: float):
+        self.state = state
+        self.data = data
+        self.updated_at = updated_at
+
+    def is_empty(self) -> bool:
+        return self.state is None and not self.data
+
+class SqliteFSMStorage(BaseStorage):
+    """FSM storage persisted in SQLite with a bounded write-coalescing cache.
+
+    Changes are kept in memory and written in batches every flush_interval
+    seconds. Records idle for longer than state_ttl are evicted from the
+    cache and the database; at most max_entries records stay in memory.
+    """
+
+    def __init__(self, db_file: str, max_entries: int = 100_000, state_ttl: float = 86400.0,
+                 flush_interval: float = 1.0):
+        self.db_file = db_file
+        self.max_entries = max_entries
+        self.state_ttl = state_ttl
+        self.flush_interval = flush_interval
+        self._cache: "OrderedDict[str, _Record]" = OrderedDict()
+        self._dirty: Set[str] = set()
+        # All database work runs in this single thread, it owns the connection
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-storage")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._last_eviction = time.time()
+        self._closed = False
+        self.stats = {"hits": 0, "misses": 0, "flushes": 0, "evicted": 0}
+
+    # Database thread
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # Worker processes write to the same file
+            self._conn = sqlite3.connect(self.db_file, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def _db_load(self, key: str) -> Optional[Tuple[Optional[str], str, float]]:
+        return self._db().execute(
+            "SELECT state, data, updated_at FROM fsm WHERE key = ?", (key,)
+        ).fetchone()
+
+    def _db_write(self, upserts: List[Tuple[str, Optional[str], str, float]], deletes: List[str]):
+        with self._db() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)", upserts
+            )
+            conn.executemany("DELETE FROM fsm WHERE key = ?", [(key,) for key in deletes])
+
+    def _db_evict(self, deadline: float) -> int:
+        with self._db() as conn:
+            return conn.execute("DELETE FROM fsm WHERE updated_at < ?", (deadline,)).rowcount
+
+    def _db_count(self) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM fsm").fetchone()[0]
+
+    def _db_close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    # Cache
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    async def _get_record(self, key: StorageKey) -> _Record:
+        """Get cached record, loading it from the database on a miss"""
+        self._ensure_flushing()
+        str_key = self._key(key)
+        record = self._cache.get(str_key)
+        if record is not None:
+            self._cache.move_to_end(str_key)
+            self.stats["hits"] += 1
+            return record
+
+        self.stats["misses"] += 1
+        row = await self._run(self._db_load, str_key)
+        # Another coroutine could have cached the key while we were reading
+        record = self._cache.get(str_key)
+        if record is None:
+            if row is not None and row[2] >= time.time() - self.state_ttl:
+                record = _Record(row[0], json.loads(row[1]), row[2])
+            else:
+                record = _Record(None, {}, time.time())
+            self._cache[str_key] = record
+            # The caller is about to use the record, it must stay cached
+            self._shrink(keep=str_key)
+        return record
+
+    def _touch(self, key: StorageKey, record: _Record):
+        """Mark record changed, it is written on the next flush"""
+        str_key = self._key(key)
+        record.updated_at = time.time()
+        # Put back a record evicted while its caller was waiting, flush reads the cache
+        self._cache[str_key] = record
+        self._cache.move_to_end(str_key)
+        self._dirty.add(str_key)
+
+    def _shrink(self, keep: Optional[str] = None):
+        """Drop least recently used clean records above the memory cap, except keep"""
+        excess = len(self._cache) - self.max_entries
+        if excess <= 0:
+            return
+        for str_key in list(self._cache):
+            if str_key not in self._dirty and str_key != keep:
+                del self._cache[str_key]
+                excess -= 1
+                if excess <= 0:
+                    break
+
+    # Flushing
+    def _ensure_flushing(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.time() - self._last_eviction >= min(self.state_ttl, 60.0):
+                    await self.evict_idle()
+            except Exception as e:
+                logger.error(f"FSM storage flush failed: {e}")
+
+    async def flush(self):
+        """Write all changed records in one transaction"""
+        if not self._dirty:
+            return
+        upserts, deletes = [], []
+        for str_key in self._dirty:
+            record = self._cache.get(str_key)
+            if record is None:
+                # Nothing known about the key, the stored row is left as it is
+                continue
+            if record.is_empty():
+                deletes.append(str_key)
+            else:
+                upserts.append((str_key, record.state, json.dumps(record.data, ensure_ascii=False), record.updated_at))
+        self._dirty.clear()
+        await self._run(self._db_write, upserts, deletes)
+        self.stats["flushes"] += 1
+        self._shrink()
+
+    async def evict_idle(self):
+        """Forget records not touched for state_ttl seconds"""
+        self._last_eviction = time.time()
+        deadline = self._last_eviction - self.state_ttl
+        for str_key, record in list(self._cache.items()):
+            if record.updated_at < deadline and str_key not in self._dirty:
+                del self._cache[str_key]
+        self.stats["evicted"] += await self._run(self._db_evict, deadline)
+
+    async def size(self) -> Dict[str, int]:
+        """Number of cached and persisted records"""
+        return {"cached": len(self._cache), "dirty": len(self._dirty), "stored": await self._run(self._db_count)}
+
+    # BaseStorage API
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._touch(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get_record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        record = await self._get_record(key)
+        record.data = dict(data)
+        self._touch(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._get_record(key)).data)
+
+    async def close(self) -> None:
+        # Called by the dispatcher shutdown and again by main, only the first call counts
+        if self._closed:
+            return
+        self._closed = True
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        await self._run(self._db_close)
+        self._executor.shutdown(wait=True)
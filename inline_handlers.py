@@ -0,0 +1,173 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Union
+
+from aiogram import Router
+from aiogram.fsm.context import FSMContext
+from aiogram.types import (
+    InlineQuery,
+    InlineQueryResultArticle,
+    InlineQueryResultCachedPhoto,
+    InlineQueryResultsButton,
+    InputTextMessageContent
+)
+
+from config import MESSAGES, INLINE_PAGE_SIZE, INLINE_MAX_RESULTS, INLINE_CACHE_TIME, INLINE_CACHE_SIZE
+from keyboards import movie_episodes_keyboard
+from data_manager import data_manager, async_data_manager
+from search_index import find_similar
+from subscription import needs_subscription
+
+router = Router()
+
+InlineResult = Union[InlineQueryResultArticle, InlineQueryResultCachedPhoto]
+
+class InlineResultCache:
+    """LRUs of matched codes per query and of answered pages, cleared on any catalog change.
+
+    All pages of a query are cut from one cached code list, so paging does
+    not search again. Changes are reported from DataManager threads, the
+    lock guards the LRUs.
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        # query -> matching codes, best first
+        self._codes: "OrderedDict[str, List[str]]" = OrderedDict()
+        # (query, offset) -> (results, next_offset)
+        self._pages: "OrderedDict[Tuple[str, int], Tuple[List[InlineResult], str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def get_codes(self, query: str) -> Optional[List[str]]:
+        with self._lock:
+            codes = self._codes.get(query)
+            if codes is not None:
+                self._codes.move_to_end(query)
+            return codes
+
+    def put_codes(self, query: str, codes: List[str], version: int):
+        with self._lock:
+            if version != self.version:
+                return
+            self._codes[query] = codes
+            while len(self._codes) > self.max_entries:
+                self._codes.popitem(last=False)
+
+    def get(self, key: Tuple[str, int]) -> Optional[Tuple[List[InlineResult], str]]:
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def put(self, key: Tuple[str, int], page: Tuple[List[InlineResult], str], version: int):
+        with self._lock:
+            if version != self.version:
+                return
+            self._pages[key] = page
+            while len(self._pages) > self.max_entries:
+                self._pages.popitem(last=False)
+
+    def invalidate(self, kind: str, key: Optional[str] = None):
+        """DataManager change listener, called in the thread that made the change"""
+        with self._lock:
+            self.version += 1
+            if kind == "poster":
+                # Matching codes are unchanged, only pages showing the old poster go
+                stale = result_id(key)
+                for page_key, (results, _next_offset) in list(self._pages.items()):
+                    if any(result.id == stale for result in results):
+                        del self._pages[page_key]
+                return
+            self._codes.clear()
+            self._pages.clear()
+
+inline_cache = InlineResultCache(INLINE_CACHE_SIZE)
+data_manager.add_listener(inline_cache.invalidate)
+
+async def matching_codes(query: str) -> List[str]:
+    """Codes answering inline query, exact code match first"""
+    if not query:
+        titles = await async_data_manager.get_titles()
+        return list(titles)[:INLINE_MAX_RESULTS]
+
+    codes = []
+    if await async_data_manager.get_movie(query) is not None:
+        codes.append(query)
+    for code, _title, _score in await find_similar(query, INLINE_MAX_RESULTS):
+        if code not in codes:
+            codes.append(code)
+    return codes
+
+def result_id(code: str) -> str:
+    """Inline result id of a code, stable across queries"""
+    return hashlib.md5(code.encode()).hexdigest()
+
+def build_result(code: str, movie: Dict) -> InlineResult:
+    """Inline result sending the same content as a code lookup"""
+    caption = f"🎬 <b>{movie['title']}</b>"
+    episodes = movie.get('episodes') or ()
+    keyboard = movie_episodes_keyboard(episodes, back=False, code=code) if episodes else None
+
+    if movie.get('poster_file_id'):
+        return InlineQueryResultCachedPhoto(
+            id=result_id(code),
+            photo_file_id=movie['poster_file_id'],
+            title=movie['title'],
+            description=f"Код: {code}",
+            caption=caption,
+            reply_markup=keyboard
+        )
+    poster = movie.get('poster') or ""
+    return InlineQueryResultArticle(
+        id=result_id(code),
+        title=movie['title'],
+        description=f"Код: {code}",
+        thumbnail_url=poster if poster.startswith("http") else None,
+        input_message_content=InputTextMessageContent(message_text=caption),
+        reply_markup=keyboard
+    )
+
+@router.inline_query()
+async def inline_search(inline_query: InlineQuery, state: FSMContext):
+    """Answer @bot queries with catalog entries, paged through next_offset"""
+    # Same partners gate as every other way to the content
+    partners = await async_data_manager.get_partners()
+    if await needs_subscription(inline_query.bot, inline_query.from_user.id, state, partners):
+        await inline_query.answer(
+            [],
+            cache_time=0,
+            is_personal=True,
+            button=InlineQueryResultsButton(text=MESSAGES["inline_subscribe"], start_parameter="subscribe")
+        )
+        return
+
+    query = inline_query.query.strip()
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+
+    page = inline_cache.get((query, offset))
+    if page is None:
+        version = inline_cache.version
+        codes = inline_cache.get_codes(query)
+        if codes is None:
+            codes = await matching_codes(query)
+            inline_cache.put_codes(query, codes, version)
+        results = []
+        for code in codes[offset:offset + INLINE_PAGE_SIZE]:
+            movie = await async_data_manager.get_movie(code)
+            if movie is not None:
+                results.append(build_result(code, movie))
+        next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(codes) else ""
+        page = (results, next_offset)
+        inline_cache.put((query, offset), page, version)
+
+    results, next_offset = page
+    await inline_query.answer(
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        # Telegram must not hand results cached for a subscriber to someone else
+        is_personal=bool(partners),
+        next_offset=next_offset
+    )
@@ -1,5 +1,7 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+
+from config import EPISODES_PER_PAGE, EPISODES_PER_ROW
 
 def main_menu_keyboard() -> InlineKeyboardMarkup:
     """Main menu keyboard for users"""
@@ -47,7 +49,10 @@ def admin_menu_keyboard() -> InlineKeyboardMarkup:
     keyboard = [
         [InlineKeyboardButton(text="➕ Добавить запись", callback_data="admin_add_movie")],
         [InlineKeyboardButton(text="❌ Удалить запись", callback_data="admin_delete_movie")],
+        [InlineKeyboardButton(text="🔗 Ссылка на запись", callback_data="admin_movie_link")],
         [InlineKeyboardButton(text="🤝 Управление партнёрами", callback_data="admin_manage_partners")],
+        [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
+        [InlineKeyboardButton(text="🩺 Проверка ссылок", callback_data="admin_check_links")],
         [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_statistics")]
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -71,19 +76,40 @@ def partners_management_keyboard(partners: List[str]) -> InlineKeyboardMarkup:
     
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-def movie_episodes_keyboard(episodes: List[str]) -> InlineKeyboardMarkup:
-    """Create keyboard with episode buttons"""
+def movie_episodes_keyboard(episodes: Sequence[str], back: bool = True, code: Optional[str] = None,
+                            page: int = 0) -> InlineKeyboardMarkup:
+    """Create keyboard with a grid of episode buttons, one page of it for long series.
+    
+    Only the links of the shown page are taken from episodes, page turns
+    need the movie code for their callback data.
+    """
     keyboard = []
     
-    for i, episode_url in enumerate(episodes, 1):
-        keyboard.append([
-            InlineKeyboardButton(
-                text=f"▶ Эпизод {i}", 
-                url=episode_url
-            )
-        ])
+    pages = max(1, -(-len(episodes) // EPISODES_PER_PAGE))
+    page = min(max(page, 0), pages - 1)
+    start = page * EPISODES_PER_PAGE
+    row = []
+    for i, episode_url in enumerate(episodes[start:start + EPISODES_PER_PAGE], start + 1):
+        row.append(InlineKeyboardButton(text=f"▶ {i}", url=episode_url.strip()))
+        if len(row) == EPISODES_PER_ROW:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
     
-    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")])
+    # Telegram rejects callback data longer than 64 bytes, such codes show the first page only
+    if pages > 1 and code is not None and len(f"episodes:{code}:{pages}".encode()) <= 64:
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton(text="⬅️", callback_data=f"episodes:{code}:{page - 1}"))
+        navigation.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="noop"))
+        if page < pages - 1:
+            navigation.append(InlineKeyboardButton(text="➡️", callback_data=f"episodes:{code}:{page + 1}"))
+        keyboard.append(navigation)
+    
+    # Messages sent in inline mode live in other chats, there is no menu to go back to
+    if back:
+        keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")])
     
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
@@ -104,3 +130,23 @@ def partners_list_keyboard(partners: List[str]) -> InlineKeyboardMarkup:
     keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")])
     
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def movie_suggestions_keyboard(suggestions: List[Tuple[str, str]]) -> InlineKeyboardMarkup:
+    """Create keyboard with movies similar to a mistyped code or title"""
+    keyboard = []
+    
+    for code, title in suggestions:
+        callback_data = f"movie:{code}"
+        # Telegram rejects callback data longer than 64 bytes
+        if len(callback_data.encode()) > 64:
+            continue
+        keyboard.append([
+            InlineKeyboardButton(
+                text=f"🎬 {title} ({code})",
+                callback_data=callback_data
+            )
+        ])
+    
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")])
+    
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
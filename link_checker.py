@@ -0,0 +1,407 @@
+"""Background health check of episode links.
+
+Usage:
+    python link_checker.py            # check stale links of the catalog, print the report
+    python link_checker.py --force    # re-check every link
+
+Links are requested with HEAD (GET for hosts refusing HEAD) through one
+pooled client limited per host. Results are kept in SQLite with the
+ETag/Last-Modified of the page, so a link is only requested again once
+its result is stale, and then conditionally.
+"""
+import argparse
+import asyncio
+import html
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiogram import Bot
+
+from config import (
+    LINK_CHECK_DB_FILE,
+    LINK_CHECK_CONCURRENCY,
+    LINK_CHECK_PER_HOST,
+    LINK_CHECK_TIMEOUT,
+    LINK_CHECK_OK_TTL,
+    LINK_CHECK_BROKEN_TTL,
+    LINK_CHECK_INTERVAL,
+    MESSAGES
+)
+from data_manager import async_data_manager
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS link_checks (
+    url TEXT PRIMARY KEY,
+    -- HTTP status, NULL when the request failed with error
+    status INTEGER,
+    error TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    checked_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+USER_AGENT = "Mozilla/5.0 (compatible; episode-link-checker)"
+# Answers of hosts that do not serve HEAD, retried with a one byte GET
+HEAD_REFUSED = {403, 405, 501}
+SAVE_BATCH = 500
+MAX_REPORT_LENGTH = 4096
+MAX_REPORT_EPISODES = 10
+
+class CheckResult(NamedTuple):
+    """Outcome of one link request"""
+    status: Optional[int]
+    error: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    checked_at: float
+
+    @property
+    def ok(self) -> bool:
+        return self.status is not None and self.status < 400
+
+    @property
+    def reason(self) -> str:
+        return str(self.status) if self.status is not None else (self.error or "error")
+
+class LinkReport(NamedTuple):
+    """Summary of a check run, broken maps code -> [(episode number, reason)]"""
+    urls: int
+    checked: int
+    not_modified: int
+    cached: int
+    broken_links: int
+    broken: Dict[str, List[Tuple[int, str]]]
+    finished_at: float
+
+class LinkCheckStore:
+    """Check results in SQLite, all database work runs in one thread owning the connection"""
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="link-checks")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_file, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def _db_load(self, urls: List[str]) -> Dict[str, CheckResult]:
+        results = {}
+        for start in range(0, len(urls), SAVE_BATCH):
+            chunk = urls[start:start + SAVE_BATCH]
+            rows = self._db().execute(
+                "SELECT url, status, error, etag, last_modified, checked_at FROM link_checks "
+                f"WHERE url IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for url, *row in rows:
+                results[url] = CheckResult(*row)
+        return results
+
+    def _db_save(self, results: List[Tuple[str, CheckResult]]):
+        with self._db() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO link_checks (url, status, error, etag, last_modified, checked_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(url, *result) for url, result in results]
+            )
+
+    def _db_prune(self, deadline: float) -> int:
+        with self._db() as conn:
+            return conn.execute("DELETE FROM link_checks WHERE checked_at < ?", (deadline,)).rowcount
+
+    def _db_close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def load(self, urls: List[str]) -> Dict[str, CheckResult]:
+        """Stored results of urls that were checked before"""
+        return await self._run(self._db_load, urls)
+
+    async def save(self, results: List[Tuple[str, CheckResult]]):
+        """Store results, replacing older ones"""
+        await self._run(self._db_save, results)
+
+    async def prune(self, deadline: float) -> int:
+        """Forget results not refreshed since deadline, links gone from the catalog"""
+        return await self._run(self._db_prune, deadline)
+
+    async def close(self):
+        await self._run(self._db_close)
+
+class LinkChecker:
+    """Checks links concurrently, reusing stored results while they are fresh"""
+
+    def __init__(self, store: LinkCheckStore, concurrency: int = 100, per_host: int = 4,
+                 timeout: float = 15.0, ok_ttl: float = 3 * 86400.0, broken_ttl: float = 3600.0):
+        self.store = store
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.ok_ttl = ok_ttl
+        self.broken_ttl = broken_ttl
+        # Links checked so far in the current run and links to check
+        self.progress = [0, 0]
+        self.stats = {"checked": 0, "not_modified": 0, "cached": 0, "broken": 0}
+        # Host -> requests allowed to it at once, taken before a request's timeout starts
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+
+    def is_fresh(self, result: CheckResult, now: float) -> bool:
+        """Whether a stored result can be used without a request"""
+        return now - result.checked_at < (self.ok_ttl if result.ok else self.broken_ttl)
+
+    async def _request(self, session: aiohttp.ClientSession, method: str, url: str,
+                       headers: Dict[str, str]) -> Tuple[int, Optional[str], Optional[str]]:
+        async with session.request(method, url, headers=headers, allow_redirects=True) as response:
+            return response.status, response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+    async def check_url(self, session: aiohttp.ClientSession, url: str,
+                        previous: Optional[CheckResult] = None) -> CheckResult:
+        """Request url, conditionally when a previous ok result has validators"""
+        headers = {}
+        if previous is not None and previous.ok:
+            if previous.etag:
+                headers["If-None-Match"] = previous.etag
+            if previous.last_modified:
+                headers["If-Modified-Since"] = previous.last_modified
+        host = urlsplit(url).hostname or ""
+        slots = self._host_slots.get(host)
+        if slots is None:
+            slots = self._host_slots[host] = asyncio.Semaphore(self.per_host)
+        try:
+            # Waiting for a free connection to a busy host must not count against the timeout
+            async with slots:
+                self.stats["checked"] += 1
+                status, etag, last_modified = await self._request(session, "HEAD", url, headers)
+                if status in HEAD_REFUSED:
+                    status, etag, last_modified = await self._request(
+                        session, "GET", url, {**headers, "Range": "bytes=0-0"}
+                    )
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            return CheckResult(None, type(e).__name__, None, None, time.time())
+
+        if status == 304 and previous is not None:
+            self.stats["not_modified"] += 1
+            return previous._replace(checked_at=time.time())
+        return CheckResult(status, None, etag, last_modified, time.time())
+
+    async def check(self, urls: Iterable[str], force: bool = False) -> Dict[str, CheckResult]:
+        """Results for all urls, requesting only those without a fresh stored result"""
+        urls = list(urls)
+        previous = await self.store.load(urls)
+        now = time.time()
+        results: Dict[str, CheckResult] = {}
+        pending = []
+        for url in urls:
+            result = previous.get(url)
+            if result is not None and not force and self.is_fresh(result, now):
+                results[url] = result
+            else:
+                pending.append(url)
+        self.stats["cached"] += len(results)
+        self.progress = [0, len(pending)]
+        self._host_slots = {}
+
+        unsaved: List[Tuple[str, CheckResult]] = []
+        remaining = iter(pending)
+
+        async def worker(session: aiohttp.ClientSession):
+            # Workers share one iterator, next() never yields to the loop
+            for url in remaining:
+                result = await self.check_url(session, url, previous.get(url))
+                results[url] = result
+                unsaved.append((url, result))
+                self.progress[0] += 1
+                if not result.ok:
+                    self.stats["broken"] += 1
+                if len(unsaved) >= SAVE_BATCH:
+                    batch = unsaved[:]
+                    del unsaved[:]
+                    await self.store.save(batch)
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host, ttl_dns_cache=300)
+        # Per request: the host semaphore keeps requests from queueing for connections
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout, headers={"User-Agent": USER_AGENT}
+        ) as session:
+            await asyncio.gather(*(worker(session) for _ in range(min(self.concurrency, len(pending)))))
+
+        if unsaved:
+            await self.store.save(unsaved)
+        # Every link still in the catalog is refreshed at least once per ok_ttl
+        await self.store.prune(time.time() - 2 * max(self.ok_ttl, self.broken_ttl))
+        return results
+
+async def collect_links() -> Dict[str, List[Tuple[str, int]]]:
+    """Episode links of the catalog: url -> [(code, episode number)]"""
+    links: Dict[str, List[Tuple[str, int]]] = {}
+    for code in await async_data_manager.get_titles():
+        movie = await async_data_manager.get_movie(code)
+        if movie is None:
+            continue
+        for number, url in enumerate(movie.get("episodes") or (), 1):
+            if url.startswith(("http://", "https://")):
+                links.setdefault(url, []).append((code, number))
+    return links
+
+async def run_check(force: bool = False) -> LinkReport:
+    """Check all episode links of the catalog"""
+    global last_report
+    links = await collect_links()
+    before = dict(link_checker.stats)
+    results = await link_checker.check(links, force)
+
+    broken: Dict[str, List[Tuple[int, str]]] = {}
+    broken_links = 0
+    for url, result in results.items():
+        if result.ok:
+            continue
+        broken_links += 1
+        for code, number in links[url]:
+            broken.setdefault(code, []).append((number, result.reason))
+    for episodes in broken.values():
+        episodes.sort()
+
+    last_report = LinkReport(
+        urls=len(links),
+        checked=link_checker.stats["checked"] - before["checked"],
+        not_modified=link_checker.stats["not_modified"] - before["not_modified"],
+        cached=link_checker.stats["cached"] - before["cached"],
+        broken_links=broken_links,
+        broken=broken,
+        finished_at=time.time()
+    )
+    logger.info(
+        f"Link check finished: {last_report.urls} links, {last_report.checked} requested, "
+        f"{broken_links} broken in {len(broken)} codes"
+    )
+    return last_report
+
+def format_report(report: LinkReport, titles: Dict[str, str]) -> str:
+    """Report message fitting into one Telegram message"""
+    text = MESSAGES["links_report"].format(
+        urls=report.urls,
+        checked=report.checked,
+        not_modified=report.not_modified,
+        cached=report.cached,
+        broken_links=report.broken_links,
+        broken_codes=len(report.broken)
+    )
+    codes = sorted(report.broken)
+    for shown, code in enumerate(codes):
+        episodes = report.broken[code]
+        listed = ", ".join(f"{number} ({reason})" for number, reason in episodes[:MAX_REPORT_EPISODES])
+        if len(episodes) > MAX_REPORT_EPISODES:
+            listed += f", …+{len(episodes) - MAX_REPORT_EPISODES}"
+        line = MESSAGES["links_report_line"].format(
+            code=html.escape(code), title=html.escape(titles.get(code, "")), episodes=listed
+        )
+        more = MESSAGES["links_report_more"].format(count=len(codes) - shown)
+        if len(text) + len(line) + len(more) + 2 > MAX_REPORT_LENGTH:
+            text += "\n" + more
+            break
+        text += ("\n\n" if shown == 0 else "\n") + line
+    return text
+
+link_checker = LinkChecker(
+    LinkCheckStore(LINK_CHECK_DB_FILE),
+    concurrency=LINK_CHECK_CONCURRENCY,
+    per_host=LINK_CHECK_PER_HOST,
+    timeout=LINK_CHECK_TIMEOUT,
+    ok_ttl=LINK_CHECK_OK_TTL,
+    broken_ttl=LINK_CHECK_BROKEN_TTL
+)
+last_report: Optional[LinkReport] = None
+_task: Optional[asyncio.Task] = None
+_schedule_task: Optional[asyncio.Task] = None
+
+def is_running() -> bool:
+    """Check whether a link check is in progress"""
+    return _task is not None and not _task.done()
+
+async def _check_and_report(bot: Bot, chat_id: int):
+    try:
+        report = await run_check()
+        text = format_report(report, await async_data_manager.get_titles())
+    except Exception as e:
+        logger.error(f"Link check failed: {e}")
+        return
+    try:
+        await bot.send_message(chat_id, text)
+    except Exception as e:
+        logger.warning(f"Cannot report link check result: {e}")
+
+def start_check(bot: Bot, chat_id: int) -> bool:
+    """Start checking links in the background, the report is sent to chat_id"""
+    global _task
+    if is_running():
+        return False
+    _task = asyncio.create_task(_check_and_report(bot, chat_id))
+    return True
+
+async def _schedule_loop(interval: float):
+    global _task
+    while True:
+        await asyncio.sleep(interval)
+        if is_running():
+            continue
+        _task = asyncio.create_task(run_check())
+        try:
+            await _task
+        except Exception as e:
+            logger.error(f"Scheduled link check failed: {e}")
+
+async def start_schedule():
+    """Run checks every LINK_CHECK_INTERVAL hours (dispatcher startup hook)"""
+    global _schedule_task
+    if LINK_CHECK_INTERVAL > 0 and _schedule_task is None:
+        _schedule_task = asyncio.create_task(_schedule_loop(LINK_CHECK_INTERVAL * 3600))
+
+async def stop_schedule():
+    """Stop scheduled and running checks (dispatcher shutdown hook)"""
+    global _schedule_task
+    for task in (_schedule_task, _task):
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    _schedule_task = None
+    await link_checker.store.close()
+
+async def _main(args):
+    link_checker.concurrency = args.concurrency
+    link_checker.per_host = args.per_host
+    try:
+        report = await run_check(force=args.force)
+        print(format_report(report, await async_data_manager.get_titles()))
+    finally:
+        await link_checker.store.close()
+        async_data_manager.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Check episode links of the catalog")
+    parser.add_argument("--force", action="store_true", help="ignore stored results and request every link")
+    parser.add_argument("--concurrency", type=int, default=LINK_CHECK_CONCURRENCY)
+    parser.add_argument("--per-host", type=int, default=LINK_CHECK_PER_HOST)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    asyncio.run(_main(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,424 @@
+"""End-to-end load test of main.py against a local fake Bot API server.
+
+Usage:
+    python loadtest.py --users 2000 --concurrency 200
+    python loadtest.py --mode webhook --users 5000 --output load.json
+
+The bot runs as a separate `python main.py` process in a temporary
+directory with a synthetic catalog, talking to the fake server through
+TELEGRAM_API_SERVER. Simulated users walk /start -> check subscription ->
+search -> code -> back; the latency of a step is the time from the update
+being handed to the bot until the first reply (send or edit) in that chat.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import signal
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+from benchmark import generate_catalog, generate_partners
+from data_manager import JsonStorage
+from sqlite_storage import SqliteStorage
+
+logger = logging.getLogger(__name__)
+
+BOT_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Loadtest", "username": "loadtest_bot"}
+FIRST_USER_ID = 10 ** 9
+# Methods that show something to the user, the first one in a chat answers a step
+REPLY_METHODS = {
+    "sendMessage", "sendPhoto", "copyMessage", "editMessageText", "editMessageCaption",
+    "editMessageReplyMarkup", "editMessageMedia"
+}
+# Lift outgoing rate limits so the bot's own throughput is measured
+UNLIMITED_FLOOD = {
+    "FLOOD_GLOBAL_RATE": "1000000",
+    "FLOOD_CHAT_RATE": "1000000",
+    "FLOOD_CHAT_BURST": "1000000",
+    "FLOOD_GROUP_RATE": "1000000"
+}
+
+class FakeBotAPI:
+    """Stand-in for api.telegram.org serving getUpdates or webhook pushes"""
+
+    def __init__(self):
+        self.calls: Counter = Counter()
+        self.ready = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        # Polling: updates not yet confirmed through the getUpdates offset
+        self._updates: Deque[Dict[str, Any]] = deque()
+        self._new_updates = asyncio.Event()
+        # Webhook: updates waiting to be pushed and the bot's answers
+        self._push_queue: asyncio.Queue = asyncio.Queue()
+        self._pushers: List[asyncio.Task] = []
+        self.push_statuses: Counter = Counter()
+        self.last_message: Dict[int, int] = {}
+        self._waiters: Dict[int, asyncio.Future] = {}
+        self._http: Optional[aiohttp.ClientSession] = None
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle_method)
+        app.on_cleanup.append(self._cleanup)
+        return app
+
+    async def _cleanup(self, app: web.Application):
+        for task in self._pushers:
+            task.cancel()
+        await asyncio.gather(*self._pushers, return_exceptions=True)
+        if self._http is not None:
+            await self._http.close()
+
+    def push_update(self, update: Dict[str, Any]) -> asyncio.Future:
+        """Deliver update to the bot, the future resolves on the first reply in its chat"""
+        update["update_id"] = next(self._update_ids)
+        chat_id = (update.get("message") or update["callback_query"]["message"])["chat"]["id"]
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = waiter
+        if self._pushers:
+            self._push_queue.put_nowait(update)
+        else:
+            self._updates.append(update)
+            self._new_updates.set()
+        return waiter
+
+    def _message(self, chat_id: int, **fields) -> Dict[str, Any]:
+        message_id = next(self._message_ids)
+        self.last_message[chat_id] = message_id
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **fields
+        }
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        self.calls[method] += 1
+
+        if method == "getUpdates":
+            result = await self._get_updates(params)
+        else:
+            result = self._answer(method, params)
+            chat_id = params.get("chat_id")
+            if method in REPLY_METHODS and chat_id is not None:
+                waiter = self._waiters.pop(int(chat_id), None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(time.perf_counter())
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, params: Dict[str, str]) -> List[Dict[str, Any]]:
+        self.ready.set()
+        offset = int(params.get("offset", 0))
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params.get("timeout", 0)))
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, int(params.get("limit", 100))))
+
+    def _answer(self, method: str, params: Dict[str, str]) -> Any:
+        chat_id = int(params["chat_id"]) if str(params.get("chat_id", "")).lstrip("-").isdigit() else 0
+        if method == "getMe":
+            return BOT_USER
+        if method == "getChatMember":
+            return {"status": "member", "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "Load"}}
+        if method == "sendMessage":
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "sendPhoto":
+            message = self._message(chat_id, caption=params.get("caption"))
+            message["photo"] = [{
+                "file_id": f"photo-{message['message_id']}",
+                "file_unique_id": f"unique-{message['message_id']}",
+                "width": 320,
+                "height": 480
+            }]
+            return message
+        if method == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        if method.startswith("editMessage"):
+            if "inline_message_id" in params:
+                return True
+            return self._message(chat_id, text=params.get("text") or params.get("caption") or "")
+        if method == "setWebhook":
+            self._start_pushers(params)
+            return True
+        return True
+
+    def _start_pushers(self, params: Dict[str, str]):
+        """Push queued updates to the bot like Telegram does, max_connections at once"""
+        url = params["url"]
+        headers = {}
+        if params.get("secret_token"):
+            headers["X-Telegram-Bot-Api-Secret-Token"] = params["secret_token"]
+        connections = int(params.get("max_connections", 40))
+        self._http = aiohttp.ClientSession()
+        self._pushers = [asyncio.create_task(self._pusher(url, headers)) for _ in range(connections)]
+        self.ready.set()
+
+    async def _pusher(self, url: str, headers: Dict[str, str]):
+        while True:
+            update = await self._push_queue.get()
+            while True:
+                try:
+                    async with self._http.post(url, json=update, headers=headers) as response:
+                        self.push_statuses[response.status] += 1
+                        if response.status == 200:
+                            break
+                except aiohttp.ClientError:
+                    # Webhook server is not listening yet
+                    self.push_statuses["connection_error"] += 1
+                await asyncio.sleep(0.1)
+
+class LoadGenerator:
+    """Simulated users replaying the main user journey"""
+
+    def __init__(self, api: FakeBotAPI, codes: List[str], think_time: float, step_timeout: float,
+                 miss_ratio: float = 0.2):
+        self.api = api
+        self.codes = codes
+        self.think_time = think_time
+        self.step_timeout = step_timeout
+        self.miss_ratio = miss_ratio
+        self.latencies: Dict[str, List[float]] = {}
+        self.timeouts: Counter = Counter()
+        self.updates_sent = 0
+
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load{user_id}"}
+
+    def _text(self, user_id: int, text: str) -> Dict[str, Any]:
+        return {"message": {
+            "message_id": next(self.api._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text
+        }}
+
+    def _callback(self, user_id: int, data: str) -> Dict[str, Any]:
+        return {"callback_query": {
+            "id": f"{user_id}-{time.perf_counter_ns()}",
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": self.api.last_message.get(user_id, 1),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "..."
+            }
+        }}
+
+    async def _step(self, name: str, update: Dict[str, Any]):
+        started = time.perf_counter()
+        waiter = self.api.push_update(update)
+        self.updates_sent += 1
+        try:
+            answered = await asyncio.wait_for(waiter, self.step_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts[name] += 1
+            return
+        self.latencies.setdefault(name, []).append(answered - started)
+        if self.think_time:
+            await asyncio.sleep(random.expovariate(1 / self.think_time))
+
+    async def journey(self, user_id: int):
+        """/start, check subscription, search, enter a code, back to menu"""
+        if random.random() < self.miss_ratio:
+            code = f"missing{random.randint(1, 10 ** 6)}"
+        else:
+            code = random.choice(self.codes)
+        await self._step("start", self._text(user_id, "/start"))
+        await self._step("check_subscription", self._callback(user_id, "check_subscription"))
+        await self._step("search_content", self._callback(user_id, "search_content"))
+        await self._step("code", self._text(user_id, code))
+        await self._step("back_to_menu", self._callback(user_id, "back_to_menu"))
+
+    async def run(self, users: int, concurrency: int, ramp: float) -> float:
+        """Run every user journey, at most concurrency at once; returns wall time"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def user(index: int):
+            await asyncio.sleep(ramp * index / users)
+            async with semaphore:
+                await self.journey(FIRST_USER_ID + index)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[user(index) for index in range(users)])
+        return time.perf_counter() - started
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """Latency percentiles in milliseconds"""
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(len(samples) * q))] * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": pick(0.50),
+        "p90_ms": pick(0.90),
+        "p99_ms": pick(0.99),
+        "max_ms": samples[-1] * 1000
+    }
+
+def prepare_data_dir(directory: str, catalog_size: int, storage: str) -> List[str]:
+    """Write a synthetic catalog for the bot process, returns its codes"""
+    catalog = generate_catalog(catalog_size)
+    partners = generate_partners(3)
+    if storage == "sqlite":
+        SqliteStorage(os.path.join(directory, "catalog.db")).import_catalog(catalog, partners)
+    else:
+        JsonStorage(os.path.join(directory, "movies.json"), os.path.join(directory, "partners.json")).import_catalog(
+            catalog, partners
+        )
+    return list(catalog)
+
+async def start_bot(directory: str, api_port: int, args) -> asyncio.subprocess.Process:
+    """Run main.py in directory against the fake server"""
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_API_SERVER": f"http://127.0.0.1:{api_port}",
+        "RUN_MODE": args.mode,
+        "STORAGE_BACKEND": args.storage,
+        "WORKERS": str(args.workers),
+        "FSM_STORAGE": args.fsm_storage,
+        "SUBSCRIPTION_CHECK_ENABLED": "1" if args.check_subscriptions else "0",
+        "METRICS_ENABLED": "1" if args.metrics_port else "0",
+        "METRICS_PORT": str(args.metrics_port or 9100)
+    })
+    if not args.keep_flood_limits:
+        env.update(UNLIMITED_FLOOD)
+    if args.mode == "webhook":
+        env.update({
+            "WEBHOOK_URL": f"http://127.0.0.1:{args.webhook_port}",
+            "WEBHOOK_SECRET": "loadtest",
+            "WEBAPP_HOST": "127.0.0.1",
+            "WEBAPP_PORT": str(args.webhook_port)
+        })
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    log = open(os.path.join(directory, "bot.log"), "wb")
+    return await asyncio.create_subprocess_exec(
+        sys.executable, main_path, cwd=directory, env=env, stdout=log, stderr=log
+    )
+
+async def stop_bot(process: asyncio.subprocess.Process):
+    """Stop the bot like Ctrl+C would, killing it if shutdown hangs"""
+    if process.returncode is not None:
+        return
+    process.send_signal(signal.SIGINT)
+    try:
+        await asyncio.wait_for(process.wait(), 30)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+async def run(args) -> Dict[str, Any]:
+    api = FakeBotAPI()
+    runner = web.AppRunner(api.create_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.api_port).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        codes = prepare_data_dir(directory, args.catalog_size, args.storage)
+        process = await start_bot(directory, args.api_port, args)
+        try:
+            try:
+                await asyncio.wait_for(api.ready.wait(), 60)
+            except asyncio.TimeoutError:
+                raise RuntimeError(f"Bot did not start, see {os.path.join(directory, 'bot.log')}")
+            logger.info(f"Bot is up in {args.mode} mode, starting {args.users} users")
+
+            generator = LoadGenerator(api, codes, args.think_time, args.step_timeout)
+            duration = await generator.run(args.users, args.concurrency, args.ramp)
+        finally:
+            await stop_bot(process)
+            if args.keep_log:
+                with open(os.path.join(directory, "bot.log"), "rb") as src, open(args.keep_log, "wb") as dst:
+                    dst.write(src.read())
+    await runner.cleanup()
+
+    all_latencies = [latency for latencies in generator.latencies.values() for latency in latencies]
+    return {
+        "config": {
+            "mode": args.mode,
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "think_time": args.think_time,
+            "catalog_size": args.catalog_size,
+            "storage": args.storage,
+            "workers": args.workers,
+            "fsm_storage": args.fsm_storage,
+            "check_subscriptions": args.check_subscriptions,
+            "flood_limits": args.keep_flood_limits
+        },
+        "duration_s": duration,
+        "updates": generator.updates_sent,
+        "updates_per_second": generator.updates_sent / duration if duration else 0.0,
+        "timeouts": dict(generator.timeouts),
+        "latency": percentiles(all_latencies) if all_latencies else {},
+        "steps": {name: percentiles(latencies) for name, latencies in generator.latencies.items()},
+        "api_calls": dict(api.calls),
+        "webhook_responses": {str(status): count for status, count in api.push_statuses.items()}
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test main.py against a local fake Bot API")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    parser.add_argument("--users", type=int, default=1000, help="simulated users, one journey each")
+    parser.add_argument("--concurrency", type=int, default=100, help="users in a journey at once")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which users arrive")
+    parser.add_argument("--think-time", type=float, default=0.5, help="mean pause between steps, seconds")
+    parser.add_argument("--step-timeout", type=float, default=10.0, help="seconds to wait for a reply")
+    parser.add_argument("--catalog-size", type=int, default=10000)
+    parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--workers", type=int, default=1, help="bot worker processes (needs --storage sqlite)")
+    parser.add_argument("--fsm-storage", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument("--check-subscriptions", action="store_true", help="verify partners via getChatMember")
+    parser.add_argument("--keep-flood-limits", action="store_true", help="keep Telegram outgoing rate limits")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--webhook-port", type=int, default=8082)
+    parser.add_argument("--metrics-port", type=int, help="serve the bot's /metrics on this port during the run")
+    parser.add_argument("--keep-log", help="copy the bot process log here")
+    parser.add_argument("--output", help="write results JSON here")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    logger.info(
+        f"{results['updates']} updates in {results['duration_s']:.1f}s: "
+        f"{results['updates_per_second']:.1f} updates/s, timeouts {sum(results['timeouts'].values())}"
+    )
+    for name, stats in results["steps"].items():
+        logger.info(
+            f"{name:>20}: p50 {stats['p50_ms']:.1f}ms  p90 {stats['p90_ms']:.1f}ms  "
+            f"p99 {stats['p99_ms']:.1f}ms  max {stats['max_ms']:.1f}ms"
+        )
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
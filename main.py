@@ -2,37 +2,116 @@ import asyncio
 import logging
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
 
-from config import BOT_TOKEN
+from config import (
+    BOT_TOKEN, TELEGRAM_API_SERVER, RUN_MODE, WORKERS, FLOOD_MAX_RETRIES,
+    FSM_STORAGE, FSM_DB_FILE, FSM_CACHE_SIZE, FSM_STATE_TTL, FSM_FLUSH_INTERVAL,
+    METRICS_ENABLED, METRICS_HOST, METRICS_PORT
+)
+from data_manager import async_data_manager
+from middlewares import ApiCallCounterMiddleware, UpdateApiCallsMiddleware
+from flood_control import FloodControlMiddleware, flood_scheduler
+from throttling import ThrottlingMiddleware, user_throttle
+from tracing import setup_logging, setup_tracing
+from user_registry import user_registry
+from analytics import AnalyticsMiddleware, analytics
+from broadcast import resume_broadcast
+import link_checker
 import user_handlers
 import admin_handlers
+import inline_handlers
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configure logging, records are written by a background thread
+setup_logging(logging.INFO, '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-async def main():
-    """Main function to start the bot"""
-    # Initialize bot and dispatcher
+def create_fsm_storage():
+    """Create FSM storage selected in config"""
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    from fsm_storage import SqliteFSMStorage
+    return SqliteFSMStorage(FSM_DB_FILE, FSM_CACHE_SIZE, FSM_STATE_TTL, FSM_FLUSH_INTERVAL)
+
+def create_bot() -> Bot:
+    """Create bot with the configured API server and outgoing request middlewares"""
+    session = None
+    if TELEGRAM_API_SERVER:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER))
     bot = Bot(
         token=BOT_TOKEN,
+        session=session,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
     
-    dp = Dispatcher(storage=MemoryStorage())
+    bot.session.middleware(ApiCallCounterMiddleware())
+    bot.session.middleware(FloodControlMiddleware(flood_scheduler, FLOOD_MAX_RETRIES))
+    return bot
+
+def create_dispatcher(primary: bool = True) -> Dispatcher:
+    """Create dispatcher with routers and hooks, only the primary one runs background jobs"""
+    dp = Dispatcher(storage=create_fsm_storage())
+    # Throttle before the dispatcher's FSM middleware loads the user's state
+    dp.update.outer_middleware.unregister(dp.fsm)
+    # Throttled users still count as active
+    dp.update.outer_middleware(AnalyticsMiddleware(analytics))
+    dp.update.outer_middleware(ThrottlingMiddleware(user_throttle))
+    dp.update.outer_middleware(dp.fsm)
+    dp.update.outer_middleware(UpdateApiCallsMiddleware())
+    
+    dp.startup.register(user_registry.start)
+    dp.startup.register(analytics.start)
+    if primary:
+        dp.startup.register(resume_broadcast)
+        dp.startup.register(link_checker.start_schedule)
+    dp.shutdown.register(user_registry.stop)
+    dp.shutdown.register(analytics.stop)
+    dp.shutdown.register(link_checker.stop_schedule)
     
     # Include routers
     dp.include_router(user_handlers.router)
     dp.include_router(admin_handlers.router)
+    dp.include_router(inline_handlers.router)
+    return dp
+
+async def start_metrics(dp: Dispatcher, bot: Bot, port: int = METRICS_PORT):
+    """Serve Prometheus metrics if enabled, returns the runner to clean up"""
+    if not METRICS_ENABLED:
+        return None
+    from metrics import setup_metrics, start_metrics_server
+    setup_metrics(dp, bot)
+    return await start_metrics_server(METRICS_HOST, port)
+
+async def main():
+    """Main function to start the bot"""
+    if WORKERS > 1:
+        from workers import run_supervisor
+        await run_supervisor(WORKERS)
+        return
+    
+    # Initialize bot and dispatcher
+    bot = create_bot()
+    dp = create_dispatcher()
+    metrics_runner = await start_metrics(dp, bot)
+    setup_tracing(dp, bot)
     
-    # Start polling
     logger.info("Starting bot...")
-    await dp.start_polling(bot)
+    try:
+        if RUN_MODE == "webhook":
+            from webhook import run_webhook
+            await run_webhook(dp, bot)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await dp.storage.close()
+        # Polling closes it too, the webhook server leaves it open
+        await bot.session.close()
+        async_data_manager.shutdown()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,290 @@
+import bisect
+import inspect
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Sequence, Tuple, Union
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import TelegramObject, Update
+
+from data_manager import data_manager, async_data_manager
+from flood_control import flood_scheduler
+from middlewares import api_call_stats
+from render_cache import render_cache
+from throttling import user_throttle
+import link_checker
+from user_registry import user_registry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+class Histogram:
+    """Histogram with fixed buckets and labels"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per bucket counts..., +Inf count, sum]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        label_names = self.labelnames + ("le",)
+        for labels, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(label_names, labels + (le,))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-1]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+Samples = Iterable[Tuple[Tuple[str, ...], float]]
+
+class Gauge:
+    """Gauge read from a sync or async callback at scrape time"""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str],
+                 collect: Callable[[], Union[Samples, Awaitable[Samples]]]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    async def collect_lines(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        try:
+            samples = self.collect()
+            if inspect.isawaitable(samples):
+                samples = await samples
+            for labels, value in samples:
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        except Exception as e:
+            logger.warning(f"Cannot collect {self.name}: {e}")
+        return lines
+
+class CounterCallback(Gauge):
+    """Counter read from a callback, for totals other modules already keep"""
+
+    type = "counter"
+
+class Registry:
+    """All metrics served on /metrics"""
+
+    def __init__(self):
+        self._metrics: List[Any] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str],
+              collect: Callable[[], Union[Samples, Awaitable[Samples]]]) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, collect))
+
+    def counter_callback(self, name: str, documentation: str, labelnames: Sequence[str],
+                         collect: Callable[[], Union[Samples, Awaitable[Samples]]]) -> CounterCallback:
+        return self.register(CounterCallback(name, documentation, labelnames, collect))
+
+    async def render(self) -> str:
+        """Metrics in Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            if isinstance(metric, Gauge):
+                lines.extend(await metric.collect_lines())
+            else:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+updates_total = registry.counter("bot_updates_total", "Received updates", ["type"])
+handler_duration = registry.histogram("bot_handler_duration_seconds", "Handler run time", ["handler"])
+handler_errors = registry.counter("bot_handler_errors_total", "Handlers that raised", ["handler"])
+api_duration = registry.histogram("bot_api_request_duration_seconds", "Bot API call time", ["method"])
+api_errors = registry.counter("bot_api_errors_total", "Failed Bot API calls", ["method", "error"])
+storage_duration = registry.histogram(
+    "data_manager_operation_duration_seconds", "DataManager call time including thread pool wait", ["operation"]
+)
+
+def observe_storage(operation: str, seconds: float):
+    """AsyncDataManager operation hook"""
+    storage_duration.observe(seconds, operation)
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Dispatcher update middleware counting updates by type"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        if isinstance(event, Update):
+            updates_total.inc(event.event_type)
+        return await handler(event, data)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner event middleware timing handlers by name"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_duration.observe(time.perf_counter() - started, name)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Bot session middleware timing Bot API calls"""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            api_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            api_duration.observe(time.perf_counter() - started, name)
+
+def setup_metrics(dp: Dispatcher, bot: Bot):
+    """Install metric middlewares, gauges and counters over existing bot statistics"""
+    bot.session.middleware(ApiMetricsMiddleware())
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    # Inner middlewares on dispatcher observers also wrap handlers of included routers
+    for observer in (dp.message, dp.callback_query, dp.inline_query):
+        observer.middleware(HandlerMetricsMiddleware())
+    async_data_manager.operation_observers.append(observe_storage)
+
+    registry.counter_callback(
+        "catalog_cache_events", "Catalog file cache hits, misses and reloads", ["event"],
+        lambda: [((event,), value) for event, value in data_manager.get_cache_stats().items()]
+    )
+    registry.counter_callback(
+        "render_cache_events", "Rendered response cache hits, misses and missing code hits", ["event"],
+        lambda: [((event,), value) for event, value in render_cache.stats.items()]
+    )
+    registry.counter_callback(
+        "throttle_events", "Per-user throttling: allowed and dropped updates, evicted idle users", ["event"],
+        lambda: [((event,), value) for event, value in user_throttle.stats.items()]
+    )
+    registry.gauge(
+        "throttle_tracked_users", "Users with a partially used throttling bucket", [],
+        lambda: [((), len(user_throttle))]
+    )
+    registry.gauge(
+        "flood_queue_depth", "Bot API calls waiting for the global rate limit", ["priority"],
+        lambda: [((priority,), depth) for priority, depth in flood_scheduler.queue_depth().items()]
+    )
+    registry.counter_callback(
+        "flood_wait_seconds_total", "Time Bot API calls spent waiting for rate limits", ["priority"],
+        lambda: [
+            ((priority,), stats["wait_total"])
+            for priority, stats in flood_scheduler.stats.items() if isinstance(stats, dict)
+        ]
+    )
+    registry.gauge(
+        "bot_api_calls_per_update_max", "Most Bot API calls made while handling one update", [],
+        lambda: [((), api_call_stats["max_api_calls"])]
+    )
+    registry.counter_callback(
+        "link_check_events", "Episode link checks: requests, not modified, served from cache, broken", ["event"],
+        lambda: [((event,), value) for event, value in link_checker.link_checker.stats.items()]
+    )
+    registry.gauge(
+        "link_check_broken_links", "Broken episode links found by the last check", [],
+        lambda: [((), link_checker.last_report.broken_links)] if link_checker.last_report else []
+    )
+    registry.gauge(
+        "bot_users", "Registered bot users", [],
+        lambda: [((), user_registry.count())]
+    )
+
+    async def fsm_size():
+        storage = dp.storage
+        if hasattr(storage, "size"):
+            return [((kind,), value) for kind, value in (await storage.size()).items()]
+        # MemoryStorage keeps every record in one dict
+        return [(("cached",), len(getattr(storage, "storage", ())))]
+
+    registry.gauge("fsm_storage_records", "FSM states and data records", ["kind"], fsm_size)
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=await registry.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Serve /metrics on a separate local port"""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,51 @@
+import logging
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import TelegramObject, Update
+
+logger = logging.getLogger(__name__)
+
+# Outgoing Bot API calls made while handling the current update
+_update_api_calls: ContextVar[Optional[List[int]]] = ContextVar("update_api_calls", default=None)
+
+api_call_stats = {"updates": 0, "api_calls": 0, "max_api_calls": 0}
+
+class ApiCallCounterMiddleware(BaseRequestMiddleware):
+    """Bot session middleware counting outgoing calls for the current update"""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        counter = _update_api_calls.get()
+        if counter is not None:
+            counter[0] += 1
+        return await make_request(bot, method)
+
+class UpdateApiCallsMiddleware(BaseMiddleware):
+    """Dispatcher middleware reporting how many Bot API calls each update made"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        counter = [0]
+        token = _update_api_calls.set(counter)
+        try:
+            return await handler(event, data)
+        finally:
+            _update_api_calls.reset(token)
+            api_call_stats["updates"] += 1
+            api_call_stats["api_calls"] += counter[0]
+            api_call_stats["max_api_calls"] = max(api_call_stats["max_api_calls"], counter[0])
+            if isinstance(event, Update):
+                logger.debug(f"Update {event.update_id} made {counter[0]} Bot API calls")
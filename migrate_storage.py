@@ -0,0 +1,41 @@
+"""Copy the catalog between storage backends.
+
+Usage:
+    python migrate_storage.py import   # movies.json/partners.json -> SQLite
+    python migrate_storage.py export   # SQLite -> movies.json/partners.json
+"""
+import argparse
+import logging
+
+from config import MOVIES_FILE, PARTNERS_FILE, SQLITE_FILE, MOVIES_COMPACT_THRESHOLD
+from data_manager import JsonStorage
+from sqlite_storage import SqliteStorage
+
+logger = logging.getLogger(__name__)
+
+def migrate(source, target):
+    """Replace target catalog with a copy of source catalog"""
+    movies, partners = source.export_catalog()
+    target.import_catalog(movies, partners)
+    logger.info(f"Migrated {len(movies)} movies and {len(partners)} partners")
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy the catalog between JSON files and SQLite")
+    parser.add_argument("direction", choices=["import", "export"],
+                        help="import: JSON -> SQLite, export: SQLite -> JSON")
+    parser.add_argument("--movies", default=MOVIES_FILE)
+    parser.add_argument("--partners", default=PARTNERS_FILE)
+    parser.add_argument("--db", default=SQLITE_FILE)
+    args = parser.parse_args()
+
+    json_storage = JsonStorage(args.movies, args.partners, MOVIES_COMPACT_THRESHOLD)
+    sqlite_storage = SqliteStorage(args.db)
+
+    if args.direction == "import":
+        migrate(json_storage, sqlite_storage)
+    else:
+        migrate(sqlite_storage, json_storage)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,209 @@
+import re
+import sys
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
+
+# Episode run: literal URL, or (prefix, first, last, suffix, width) for
+# prefix + number + suffix with number going first..last, zero padded to width
+Run = Union[str, Tuple[str, int, int, str, int]]
+
+_LAST_NUMBER = re.compile(r"^(.*?)(\d+)(\D*)$")
+_RANGE_INPUT = re.compile(r"\{(\d+)\.\.(\d+)\}")
+MAX_RANGE_EPISODES = 10000
+
+def _format_number(number: int, width: int) -> str:
+    return f"{number:0{width}d}" if width else str(number)
+
+class EpisodeList(Sequence[str]):
+    """Immutable episode URL list stored as runs and expanded on access.
+
+    A series whose links differ only in the episode number, e.g.
+    https://jut.su/atelier-meister/episode-1.html .. episode-500.html,
+    is kept as one run with an interned prefix and suffix.
+    """
+    __slots__ = ("runs", "_length")
+
+    def __init__(self, runs: Iterable[Run] = ()):
+        self.runs: Tuple[Run, ...] = tuple(runs)
+        self._length = sum(1 if isinstance(run, str) else run[2] - run[1] + 1 for run in self.runs)
+
+    @classmethod
+    def from_urls(cls, urls: Iterable[str]) -> "EpisodeList":
+        """Compress URLs into runs of consecutive episode numbers"""
+        if isinstance(urls, EpisodeList):
+            return urls
+        runs: List[Run] = []
+        for url in urls:
+            match = _LAST_NUMBER.match(url)
+            if match is None:
+                runs.append(url)
+                continue
+            prefix, digits, suffix = match.groups()
+            number = int(digits)
+            last = runs[-1] if runs else None
+            if (not isinstance(last, str) and last is not None and last[0] == prefix and last[3] == suffix
+                    and last[2] + 1 == number and _format_number(number, last[4]) == digits):
+                runs[-1] = (last[0], last[1], number, last[3], last[4])
+                continue
+            if isinstance(last, str):
+                # Second link of a series: turn the literal before it into a run
+                last_match = _LAST_NUMBER.match(last)
+                if last_match is not None and last_match.group(1) == prefix and last_match.group(3) == suffix:
+                    last_digits = last_match.group(2)
+                    width = len(last_digits) if last_digits.startswith("0") and len(last_digits) > 1 else 0
+                    if int(last_digits) + 1 == number and _format_number(number, width) == digits:
+                        runs[-1] = (sys.intern(prefix), int(last_digits), number, sys.intern(suffix), width)
+                        continue
+            runs.append(url)
+        return cls(runs)
+
+    @classmethod
+    def decode(cls, data: Optional[Iterable[Any]]) -> "EpisodeList":
+        """Build from the stored form, plain URL lists included"""
+        if isinstance(data, EpisodeList):
+            return data
+        if not data:
+            return cls()
+        # Hand edited files may contain padded or empty links
+        items = [item.strip() if isinstance(item, str) else item for item in data]
+        items = [item for item in items if item]
+        if all(isinstance(item, str) for item in items):
+            return cls.from_urls(items)
+        runs: List[Run] = []
+        for item in items:
+            if isinstance(item, str):
+                runs.append(item)
+            else:
+                prefix, first, last, suffix = item[:4]
+                width = item[4] if len(item) > 4 else 0
+                runs.append((sys.intern(prefix), int(first), int(last), sys.intern(suffix), int(width)))
+        return cls(runs)
+
+    def encode(self) -> List[Any]:
+        """JSON friendly form: URL strings and [prefix, first, last, suffix(, width)] lists"""
+        encoded: List[Any] = []
+        for run in self.runs:
+            if isinstance(run, str):
+                encoded.append(run)
+            else:
+                encoded.append(list(run) if run[4] else list(run[:4]))
+        return encoded
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[str]:
+        for run in self.runs:
+            if isinstance(run, str):
+                yield run
+            else:
+                prefix, first, last, suffix, width = run
+                for number in range(first, last + 1):
+                    yield f"{prefix}{_format_number(number, width)}{suffix}"
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return self._slice(start, stop)
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("episode index out of range")
+        for run in self.runs:
+            size = 1 if isinstance(run, str) else run[2] - run[1] + 1
+            if index < size:
+                if isinstance(run, str):
+                    return run
+                return f"{run[0]}{_format_number(run[1] + index, run[4])}{run[3]}"
+            index -= size
+
+    def _slice(self, start: int, stop: int) -> List[str]:
+        """Expand only the URLs in [start, stop)"""
+        urls = []
+        offset = 0
+        for run in self.runs:
+            if offset >= stop:
+                break
+            if isinstance(run, str):
+                if offset >= start:
+                    urls.append(run)
+                offset += 1
+                continue
+            prefix, first, last, suffix, width = run
+            size = last - first + 1
+            for i in range(max(start - offset, 0), min(stop - offset, size)):
+                urls.append(f"{prefix}{_format_number(first + i, width)}{suffix}")
+            offset += size
+        return urls
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, EpisodeList):
+            return self.runs == other.runs or list(self) == list(other)
+        if isinstance(other, (list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"EpisodeList({len(self)} episodes in {len(self.runs)} runs)"
+
+class MovieRecord:
+    """Resident catalog entry, episodes kept compressed"""
+    __slots__ = ("title", "poster", "poster_file_id", "episodes")
+
+    def __init__(self, title: str, poster: str, episodes: EpisodeList, poster_file_id: Optional[str] = None):
+        self.title = title
+        self.poster = poster
+        self.episodes = episodes
+        self.poster_file_id = poster_file_id
+
+    @classmethod
+    def from_dict(cls, movie: Mapping[str, Any]) -> "MovieRecord":
+        return cls(
+            movie.get("title", ""),
+            movie.get("poster") or "",
+            EpisodeList.decode(movie.get("episodes")),
+            movie.get("poster_file_id") or None
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Movie in the DataManager API shape, episodes as a lazy EpisodeList"""
+        movie = {"title": self.title, "poster": self.poster, "episodes": self.episodes}
+        if self.poster_file_id:
+            movie["poster_file_id"] = self.poster_file_id
+        return movie
+
+    def to_json(self) -> Dict[str, Any]:
+        """Movie as stored in movies.json and the journal"""
+        movie = {"title": self.title, "poster": self.poster, "episodes": self.episodes.encode()}
+        if self.poster_file_id:
+            movie["poster_file_id"] = self.poster_file_id
+        return movie
+
+def parse_episodes(text: str) -> EpisodeList:
+    """Parse admin input: links separated by commas or new lines.
+
+    A link may contain one {first..last} range, e.g.
+    https://jut.su/atelier-meister/episode-{1..24}.html; {01..24} pads
+    numbers with zeros.
+    """
+    runs: List[Run] = []
+    links: List[str] = []
+    for item in re.split(r"[,\n]", text):
+        item = item.strip()
+        if not item:
+            continue
+        match = _RANGE_INPUT.search(item)
+        if match is None:
+            links.append(item)
+            continue
+        first_digits, last_digits = match.groups()
+        first, last = int(first_digits), int(last_digits)
+        if last < first or last - first >= MAX_RANGE_EPISODES:
+            raise ValueError(match.group(0))
+        width = len(first_digits) if first_digits.startswith("0") and len(first_digits) > 1 else 0
+        runs.extend(EpisodeList.from_urls(links).runs)
+        links = []
+        runs.append((sys.intern(item[:match.start()]), first, last, sys.intern(item[match.end():]), width))
+    runs.extend(EpisodeList.from_urls(links).runs)
+    return EpisodeList(runs)
@@ -0,0 +1,244 @@
+import html
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+from aiogram.types import InlineKeyboardMarkup
+
+from config import MESSAGES, RENDER_CACHE_SIZE, MISSING_CACHE_SIZE
+from keyboards import (
+    main_menu_keyboard,
+    back_to_menu_keyboard,
+    movie_episodes_keyboard,
+    movie_suggestions_keyboard,
+    partners_list_keyboard,
+    partners_subscription_keyboard
+)
+from data_manager import data_manager, async_data_manager
+from search_index import find_similar
+
+# Telegram limit of a media caption, in UTF-16 code units after entity parsing
+CAPTION_LIMIT = 1024
+_TAG = re.compile(r"<[^>]*>")
+
+def caption_length(text: str) -> int:
+    """Length of HTML formatted text as Telegram counts it against CAPTION_LIMIT"""
+    visible = html.unescape(_TAG.sub("", text))
+    return len(visible.encode("utf-16-le")) // 2
+
+class Screen(NamedTuple):
+    """Rendered message: text with its keyboard"""
+    text: str
+    reply_markup: InlineKeyboardMarkup
+
+class MovieScreen(NamedTuple):
+    """Rendered code lookup response, episodes is the separate keyboard message"""
+    caption: str
+    poster: Optional[str]
+    poster_is_file_id: bool
+    episodes: Screen
+    text: str
+    # Episode links for rendering other keyboard pages
+    episode_list: Sequence[str]
+    # Whether caption and text may be sent as a photo caption
+    caption_fits: bool
+    text_fits: bool
+
+def render_movie(code: str, movie: Dict[str, Any]) -> MovieScreen:
+    """Render movie record into ready to send response"""
+    episodes = movie.get('episodes') or ()
+    if episodes:
+        episodes_screen = Screen("🎞️ Выберите эпизод:", movie_episodes_keyboard(episodes, code=code))
+    else:
+        episodes_screen = Screen("📺 Эпизоды скоро будут добавлены!", back_to_menu_keyboard())
+
+    file_id = movie.get('poster_file_id')
+    caption = f"🎬 <b>{movie['title']}</b>"
+    text = f"{caption}\n\n{episodes_screen.text}"
+    return MovieScreen(
+        caption=caption,
+        poster=file_id or movie.get('poster') or None,
+        poster_is_file_id=bool(file_id),
+        episodes=episodes_screen,
+        # Caption and episodes note combined for single message delivery
+        text=text,
+        episode_list=episodes,
+        caption_fits=caption_length(caption) <= CAPTION_LIMIT,
+        text_fits=caption_length(text) <= CAPTION_LIMIT
+    )
+
+def _partners_text(partners: List[str]) -> str:
+    """Numbered partners list without revealing channel names"""
+    return "\n".join([f"Партнёр {i}" for i, partner in enumerate(partners, 1)])
+
+def _partners_list_screen(partners: List[str]) -> Screen:
+    """Partners screen with channel links"""
+    if partners:
+        return Screen("👥 <b>Наши партнёры:</b>", partners_list_keyboard(partners))
+    return Screen(MESSAGES["no_partners"], back_to_menu_keyboard())
+
+SCREEN_BUILDERS: Dict[str, Callable[[List[str]], Screen]] = {
+    "start_with_partners": lambda partners: Screen(
+        MESSAGES["start_with_partners"].format(partners=_partners_text(partners)),
+        partners_subscription_keyboard(partners)
+    ),
+    "subscribe_first": lambda partners: Screen(
+        MESSAGES["subscribe_first"].format(partners=_partners_text(partners)),
+        partners_subscription_keyboard(partners)
+    ),
+    "partners_list": _partners_list_screen,
+    "welcome": lambda partners: Screen(MESSAGES["welcome"], main_menu_keyboard()),
+    "main_menu": lambda partners: Screen(MESSAGES["main_menu"], main_menu_keyboard()),
+    "help": lambda partners: Screen(MESSAGES["help_message"], back_to_menu_keyboard()),
+    "enter_code": lambda partners: Screen(MESSAGES["enter_code"], back_to_menu_keyboard()),
+    "code_not_found": lambda partners: Screen(MESSAGES["code_not_found"], back_to_menu_keyboard())
+}
+
+class RenderCache:
+    """Bounded LRUs of rendered movie responses and of missing codes, plus singleton screens.
+
+    Invalidation comes from DataManager threads while the event loop reads,
+    so every access to the dictionaries holds the lock.
+    """
+
+    def __init__(self, max_movies: int = 1000, max_missing: int = 10000):
+        self.max_movies = max_movies
+        self.max_missing = max_missing
+        self._movies: "OrderedDict[str, MovieScreen]" = OrderedDict()
+        # Codes without a movie -> their not found response once rendered
+        self._missing: "OrderedDict[str, Optional[Screen]]" = OrderedDict()
+        self._screens: Dict[str, Screen] = {}
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so renders started before it are not stored
+        self.version = 0
+        self.stats = {"hits": 0, "misses": 0, "missing_hits": 0}
+
+    def get_movie(self, code: str) -> Optional[MovieScreen]:
+        """Get rendered movie response"""
+        with self._lock:
+            screen = self._movies.get(code)
+            if screen is None:
+                self.stats["misses"] += 1
+                return None
+            self._movies.move_to_end(code)
+            self.stats["hits"] += 1
+            return screen
+
+    def has_movie(self, code: str) -> bool:
+        """Whether movie response is cached, without counting it as a lookup"""
+        return code in self._movies
+
+    def put_movie(self, code: str, screen: MovieScreen, version: int):
+        """Store rendered movie response unless the catalog changed meanwhile"""
+        with self._lock:
+            if version != self.version:
+                return
+            self._movies[code] = screen
+            self._movies.move_to_end(code)
+            while len(self._movies) > self.max_movies:
+                self._movies.popitem(last=False)
+
+    def is_missing(self, code: str) -> bool:
+        """Whether code is known to have no movie"""
+        with self._lock:
+            if code not in self._missing:
+                return False
+            self._missing.move_to_end(code)
+            self.stats["missing_hits"] += 1
+            return True
+
+    def get_missing(self, code: str) -> Optional[Screen]:
+        """Get rendered not found response of a missing code"""
+        with self._lock:
+            return self._missing.get(code)
+
+    def put_missing(self, code: str, screen: Optional[Screen], version: int):
+        """Remember missing code with its response unless the catalog changed meanwhile"""
+        with self._lock:
+            if version != self.version or self.max_missing <= 0:
+                return
+            self._missing[code] = screen
+            self._missing.move_to_end(code)
+            while len(self._missing) > self.max_missing:
+                self._missing.popitem(last=False)
+
+    def get_screen(self, name: str) -> Optional[Screen]:
+        """Get rendered singleton screen"""
+        with self._lock:
+            screen = self._screens.get(name)
+            self.stats["hits" if screen is not None else "misses"] += 1
+            return screen
+
+    def put_screen(self, name: str, screen: Screen, version: int):
+        """Store rendered singleton screen unless the catalog changed meanwhile"""
+        with self._lock:
+            if version == self.version:
+                self._screens[name] = screen
+
+    def invalidate(self, kind: str, key: Optional[str] = None):
+        """DataManager change listener, called in the thread that made the change"""
+        with self._lock:
+            if kind == "poster":
+                # Titles and other codes are unaffected, renders in flight may finish
+                self._movies.pop(key, None)
+                return
+            self.version += 1
+            if kind == "movie":
+                self._movies.pop(key, None)
+                # New titles change suggestions of other missing codes too
+                self._missing.clear()
+            elif kind == "partners":
+                self._screens.clear()
+            else:
+                self._movies.clear()
+                self._missing.clear()
+                self._screens.clear()
+
+render_cache = RenderCache(RENDER_CACHE_SIZE, MISSING_CACHE_SIZE)
+data_manager.add_listener(render_cache.invalidate)
+
+async def movie_screen(code: str) -> Optional[MovieScreen]:
+    """Get rendered response for movie code, None if there is no such movie"""
+    screen = render_cache.get_movie(code)
+    if screen is not None:
+        return screen
+    if render_cache.is_missing(code):
+        return None
+
+    version = render_cache.version
+    movie = await async_data_manager.get_movie(code)
+    if movie is None:
+        render_cache.put_missing(code, None, version)
+        return None
+    screen = render_movie(code, movie)
+    render_cache.put_movie(code, screen, version)
+    return screen
+
+async def code_not_found_screen(code: str) -> Screen:
+    """Get response to a code without movie: similar titles if there are any"""
+    screen = render_cache.get_missing(code)
+    if screen is not None:
+        return screen
+
+    version = render_cache.version
+    suggestions = await find_similar(code)
+    if suggestions:
+        keyboard = movie_suggestions_keyboard([(found, title) for found, title, score in suggestions])
+        screen = Screen(MESSAGES["code_suggestions"], keyboard)
+    else:
+        screen = await get_screen("code_not_found")
+    render_cache.put_missing(code, screen, version)
+    return screen
+
+async def get_screen(name: str) -> Screen:
+    """Get rendered singleton screen by name from SCREEN_BUILDERS"""
+    screen = render_cache.get_screen(name)
+    if screen is not None:
+        return screen
+
+    version = render_cache.version
+    partners = await async_data_manager.get_partners()
+    screen = SCREEN_BUILDERS[name](partners)
+    render_cache.put_screen(name, screen, version)
+    return screen
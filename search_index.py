@@ -0,0 +1,212 @@
+import asyncio
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from itertools import islice
+from typing import Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from config import SEARCH_SUGGESTIONS, SEARCH_MIN_SCORE
+from data_manager import data_manager
+
+_NON_WORD = re.compile(r"[^\w]+")
+# Titles sharing trigrams with a query that are counted before exact scoring
+CANDIDATE_BUDGET = 500
+# Titles indexed by a build between giving other threads the interpreter
+BUILD_CHUNK = 5000
+
+# Trigrams of one indexed title or code; tuples of strings drop out of garbage
+# collector tracking, so a large index does not slow down full collections
+Grams = Tuple[str, ...]
+Entry = Tuple[str, Grams, Grams]
+
+def normalize(text: str) -> str:
+    """Lowercase text and collapse everything except letters and digits"""
+    return _NON_WORD.sub(" ", text.lower().replace("ё", "е")).strip()
+
+def trigrams(text: str) -> FrozenSet[str]:
+    """Trigrams of every word, padded so short words and word starts count"""
+    grams = set()
+    for word in normalize(text).split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+def _dice(a: FrozenSet[str], b: Grams) -> float:
+    if not a or not b:
+        return 0.0
+    return 2 * len(a.intersection(b)) / (len(a) + len(b))
+
+class TitleIndex:
+    """Trigram index over movie titles and codes for typo tolerant lookup"""
+
+    def __init__(self):
+        self._postings: Dict[str, Set[str]] = defaultdict(set)
+        # code -> (title, title trigrams, code trigrams)
+        self._entries: Dict[str, Entry] = {}
+        self._lock = threading.Lock()
+        self.built = False
+        # Edits made while a build runs, code -> new title or None if removed
+        self._pending: Optional[Dict[str, Optional[str]]] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def building(self) -> bool:
+        return self._pending is not None
+
+    def begin_build(self):
+        """Start recording edits, call before the catalog is read by build()"""
+        with self._lock:
+            if self._pending is None:
+                self._pending = {}
+
+    def build(self, load_titles: Callable[[], Dict[str, str]]):
+        """Index the whole catalog into new tables and swap them in.
+
+        The lock is held only for the swap, searches and edits go on
+        meanwhile; edits recorded since begin_build() are replayed on top.
+        """
+        self.begin_build()
+        try:
+            postings: Dict[str, Set[str]] = defaultdict(set)
+            entries: Dict[str, Entry] = {}
+            for number, (code, title) in enumerate(load_titles().items(), 1):
+                self._add(code, title, postings, entries)
+                if number % BUILD_CHUNK == 0:
+                    # Hand the interpreter to the event loop between chunks
+                    time.sleep(0)
+            with self._lock:
+                for code, title in self._pending.items():
+                    self._remove(code, postings, entries)
+                    if title is not None:
+                        self._add(code, title, postings, entries)
+                self._postings, self._entries = postings, entries
+                self.built = True
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def add(self, code: str, title: str):
+        """Index or re-index one movie"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending[code] = title
+            self._remove(code, self._postings, self._entries)
+            self._add(code, title, self._postings, self._entries)
+
+    def remove(self, code: str):
+        """Drop one movie from the index"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending[code] = None
+            self._remove(code, self._postings, self._entries)
+
+    @staticmethod
+    def _add(code: str, title: str, postings: Dict[str, Set[str]],
+             entries: Dict[str, Entry]):
+        title_grams = trigrams(title)
+        code_grams = trigrams(code)
+        entries[code] = (title, tuple(title_grams), tuple(code_grams))
+        for gram in title_grams | code_grams:
+            postings[gram].add(code)
+
+    @staticmethod
+    def _remove(code: str, postings: Dict[str, Set[str]],
+                entries: Dict[str, Entry]):
+        entry = entries.pop(code, None)
+        if entry is None:
+            return
+        for gram in entry[1] + entry[2]:
+            codes = postings.get(gram)
+            if codes is not None:
+                codes.discard(code)
+                if not codes:
+                    del postings[gram]
+
+    def search(self, query: str, limit: int = 5, min_score: float = 0.3) -> List[Tuple[str, str, float]]:
+        """Closest movies to query as (code, title, score), best first"""
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+
+        with self._lock:
+            postings = sorted(
+                (self._postings[gram] for gram in query_grams if gram in self._postings), key=len
+            )
+            if not postings:
+                return []
+            shared: Counter = Counter()
+            if len(postings[0]) <= CANDIDATE_BUDGET:
+                # Count shared trigrams, rarest first, until the budget is spent;
+                # common trigrams add little to the ranking, scores are exact below
+                counted = 0
+                for codes in postings:
+                    if counted + len(codes) > CANDIDATE_BUDGET and shared:
+                        break
+                    shared.update(codes)
+                    counted += len(codes)
+            else:
+                # Only common trigrams: narrow a bounded sample of the rarest posting
+                # down to titles having the others too, then count within it
+                pool = set(islice(postings[0], 4 * CANDIDATE_BUDGET))
+                for codes in postings[1:]:
+                    if len(pool) <= CANDIDATE_BUDGET:
+                        break
+                    narrowed = pool & codes
+                    if not narrowed:
+                        break
+                    pool = narrowed
+                if len(pool) > CANDIDATE_BUDGET:
+                    pool = set(islice(pool, CANDIDATE_BUDGET))
+                for codes in postings:
+                    shared.update(pool & codes)
+
+            # Only the best overlaps can reach the score threshold
+            results = []
+            for code, _ in shared.most_common(limit * 10):
+                title, title_grams, code_grams = self._entries[code]
+                score = max(_dice(query_grams, title_grams), _dice(query_grams, code_grams))
+                if score >= min_score:
+                    results.append((code, title, score))
+
+        results.sort(key=lambda result: result[2], reverse=True)
+        return results[:limit]
+
+title_index = TitleIndex()
+
+def _on_catalog_change(kind: str, key: Optional[str]):
+    """Keep the index in sync with DataManager edits"""
+    if kind != "movie" or not (title_index.built or title_index.building):
+        return
+    movie = data_manager.get_movie(key)
+    if movie is None:
+        title_index.remove(key)
+    else:
+        title_index.add(key, movie.get("title", ""))
+
+data_manager.add_listener(_on_catalog_change)
+
+# Build of the index in progress, shared by all searches waiting for it
+_building: Optional[asyncio.Future] = None
+
+async def _build_index():
+    # Edits are recorded from here on, before the executor gets to read the catalog
+    title_index.begin_build()
+    await asyncio.get_running_loop().run_in_executor(None, title_index.build, data_manager.get_titles)
+
+async def find_similar(query: str, limit: int = SEARCH_SUGGESTIONS) -> List[Tuple[str, str, float]]:
+    """Search the title index, building it from the catalog off the event loop on first use"""
+    global _building
+    if not title_index.built:
+        if _building is None:
+            _building = asyncio.ensure_future(_build_index())
+
+            def done(_):
+                global _building
+                _building = None
+            _building.add_done_callback(done)
+        # Shield so one cancelled caller does not cancel the build for the others
+        await asyncio.shield(_building)
+    return title_index.search(query, limit, SEARCH_MIN_SCORE)
@@ -0,0 +1,196 @@
+import sqlite3
+import threading
+from typing import Dict, List, Any, Optional, Sequence, Tuple
+
+from movie_records import EpisodeList
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS movies (
+    code TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    poster TEXT NOT NULL DEFAULT '',
+    poster_file_id TEXT
+) WITHOUT ROWID;
+
+-- One row per episode run: a literal url, or url as prefix of
+-- url + number + suffix for numbers first_number..last_number padded to width
+CREATE TABLE IF NOT EXISTS episodes (
+    code TEXT NOT NULL REFERENCES movies(code) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    first_number INTEGER,
+    last_number INTEGER,
+    suffix TEXT,
+    width INTEGER,
+    PRIMARY KEY (code, position)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS partners (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE
+);
+"""
+
+RUN_COLUMNS = (("first_number", "INTEGER"), ("last_number", "INTEGER"), ("suffix", "TEXT"), ("width", "INTEGER"))
+
+def _run_from_row(url: str, first_number: Optional[int], last_number: Optional[int],
+                  suffix: Optional[str], width: Optional[int]):
+    """Episode run stored in one episodes row"""
+    if first_number is None:
+        return url
+    return (url, first_number, last_number, suffix or "", width or 0)
+
+class SqliteStorage:
+    """Storage backend keeping movies and partners in a SQLite database (WAL mode)"""
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        # One connection per thread, sqlite3 connections must not be shared
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(movies)")}
+            if "poster_file_id" not in columns:
+                conn.execute("ALTER TABLE movies ADD COLUMN poster_file_id TEXT")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(episodes)")}
+            for column, column_type in RUN_COLUMNS:
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE episodes ADD COLUMN {column} {column_type}")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Get connection for the current thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def get_cache_stats(self) -> Dict[str, int]:
+        """Get catalog cache counters (SQLite relies on its own page cache)"""
+        return {}
+
+    # Movie methods
+    def get_movie(self, code: str) -> Optional[Dict[str, Any]]:
+        """Get movie by code"""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT title, poster, poster_file_id FROM movies WHERE code = ?", (code,)
+        ).fetchone()
+        if row is None:
+            return None
+        runs = conn.execute(
+            "SELECT url, first_number, last_number, suffix, width FROM episodes WHERE code = ? ORDER BY position",
+            (code,)
+        ).fetchall()
+        return self._movie_dict(row[0], row[1], row[2], EpisodeList(_run_from_row(*run) for run in runs))
+
+    def _movie_dict(self, title: str, poster: str, poster_file_id: Optional[str],
+                    episodes: EpisodeList) -> Dict[str, Any]:
+        """Build movie record in the same shape as movies.json"""
+        movie = {
+            "title": title,
+            "poster": poster,
+            "episodes": episodes
+        }
+        if poster_file_id:
+            movie["poster_file_id"] = poster_file_id
+        return movie
+
+    def add_movie(self, code: str, title: str, poster: str, episodes: Sequence[str]):
+        """Add new movie"""
+        movie = {"title": title, "poster": poster, "episodes": episodes}
+        with self._connect() as conn:
+            # Keep the uploaded poster file_id while the poster itself is unchanged
+            row = conn.execute(
+                "SELECT poster_file_id FROM movies WHERE code = ? AND poster = ?", (code, poster)
+            ).fetchone()
+            if row is not None and row[0]:
+                movie["poster_file_id"] = row[0]
+            self._insert_movie(conn, code, movie)
+
+    def set_poster_file_id(self, code: str, file_id: Optional[str]):
+        """Remember Telegram file_id of movie poster, None clears it"""
+        with self._connect() as conn:
+            conn.execute("UPDATE movies SET poster_file_id = ? WHERE code = ?", (file_id, code))
+
+    def _insert_movie(self, conn: sqlite3.Connection, code: str, movie: Dict[str, Any]):
+        """Insert or replace movie with its episodes"""
+        conn.execute("DELETE FROM episodes WHERE code = ?", (code,))
+        conn.execute(
+            "INSERT OR REPLACE INTO movies (code, title, poster, poster_file_id) VALUES (?, ?, ?, ?)",
+            (code, movie.get("title", ""), movie.get("poster") or "", movie.get("poster_file_id"))
+        )
+        runs = EpisodeList.decode(movie.get("episodes")).runs
+        conn.executemany(
+            "INSERT INTO episodes (code, position, url, first_number, last_number, suffix, width) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (code, i, run, None, None, None, None) if isinstance(run, str) else (code, i, *run)
+                for i, run in enumerate(runs)
+            ]
+        )
+
+    def delete_movie(self, code: str) -> bool:
+        """Delete movie by code"""
+        with self._connect() as conn:
+            cursor = conn.execute("DELETE FROM movies WHERE code = ?", (code,))
+            return cursor.rowcount > 0
+
+    def get_movies_count(self) -> int:
+        """Get total number of movies"""
+        return self._connect().execute("SELECT COUNT(*) FROM movies").fetchone()[0]
+
+    def get_titles(self) -> Dict[str, str]:
+        """Get titles of all movies by code"""
+        return dict(self._connect().execute("SELECT code, title FROM movies"))
+
+    # Partner methods
+    def get_partners(self) -> List[str]:
+        """Get all partners"""
+        rows = self._connect().execute("SELECT name FROM partners ORDER BY id").fetchall()
+        return [name for (name,) in rows]
+
+    def add_partner(self, partner: str):
+        """Add new partner"""
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO partners (name) VALUES (?)", (partner,))
+
+    def delete_partner(self, partner: str) -> bool:
+        """Delete partner"""
+        with self._connect() as conn:
+            cursor = conn.execute("DELETE FROM partners WHERE name = ?", (partner,))
+            return cursor.rowcount > 0
+
+    def get_partners_count(self) -> int:
+        """Get total number of partners"""
+        return self._connect().execute("SELECT COUNT(*) FROM partners").fetchone()[0]
+
+    # Migration methods
+    def export_catalog(self) -> Tuple[Dict[str, Any], List[str]]:
+        """Get full copies of movies and partners"""
+        conn = self._connect()
+        runs: Dict[str, List[Any]] = {}
+        for code, *run in conn.execute(
+            "SELECT code, url, first_number, last_number, suffix, width FROM episodes ORDER BY code, position"
+        ):
+            runs.setdefault(code, []).append(_run_from_row(*run))
+        movies = {
+            code: self._movie_dict(title, poster, poster_file_id, EpisodeList(runs.get(code, ())))
+            for code, title, poster, poster_file_id in conn.execute(
+                "SELECT code, title, poster, poster_file_id FROM movies ORDER BY code"
+            )
+        }
+        return movies, self.get_partners()
+
+    def import_catalog(self, movies: Dict[str, Any], partners: List[str]):
+        """Replace all stored movies and partners"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM episodes")
+            conn.execute("DELETE FROM movies")
+            conn.execute("DELETE FROM partners")
+            for code, movie in movies.items():
+                self._insert_movie(conn, code, movie)
+            conn.executemany("INSERT OR IGNORE INTO partners (name) VALUES (?)", [(p,) for p in partners])
@@ -16,5 +16,11 @@ class AdminStates(StatesGroup):
     # Deleting movie state
     waiting_for_delete_code = State()
     
+    # Deep link state
+    waiting_for_link_code = State()
+    
     # Partner management states
     waiting_for_partner_link = State()
+    
+    # Broadcast state
+    waiting_for_broadcast_message = State()
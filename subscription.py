@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.dispatcher.flags import get_flag
+from aiogram.enums import ChatMemberStatus
+from aiogram.exceptions import TelegramAPIError
+from aiogram.fsm.context import FSMContext
+from aiogram.types import CallbackQuery, TelegramObject
+
+from config import (
+    SUBSCRIPTION_CHECK_ENABLED,
+    SUBSCRIPTION_CHECK_TIMEOUT,
+    SUBSCRIPTION_POSITIVE_TTL,
+    SUBSCRIPTION_NEGATIVE_TTL,
+    SUBSCRIPTION_CACHE_SIZE
+)
+from states import UserStates
+from data_manager import data_manager, async_data_manager
+from render_cache import get_screen
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBED_STATUSES = {
+    ChatMemberStatus.CREATOR,
+    ChatMemberStatus.ADMINISTRATOR,
+    ChatMemberStatus.MEMBER
+}
+
+def partner_chat_id(partner: str) -> str:
+    """Get chat id for getChatMember from stored partner link"""
+    return partner.split("?", 1)[0]
+
+class SubscriptionVerifier:
+    """Checks partner subscriptions with concurrent getChatMember calls and a per-user cache"""
+
+    def __init__(self, enabled: bool = True, timeout: float = 3.0, positive_ttl: float = 300.0,
+                 negative_ttl: float = 15.0, max_entries: int = 100_000):
+        self.enabled = enabled
+        self.timeout = timeout
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        # user_id -> (expires_at, subscribed)
+        self._cache: Dict[int, Tuple[float, bool]] = {}
+
+    def invalidate(self, user_id: Optional[int] = None):
+        """Forget cached result for one user or for everyone"""
+        if user_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(user_id, None)
+
+    async def is_subscribed(self, bot: Bot, user_id: int, partners: List[str]) -> bool:
+        """Check that user is subscribed to all partners"""
+        if not self.enabled or not partners:
+            return True
+
+        cached = self._cache.get(user_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        results = await asyncio.gather(*[
+            self._check_partner(bot, user_id, partner) for partner in partners
+        ])
+        subscribed = all(results)
+
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        if len(self._cache) >= self.max_entries:
+            # Drop the oldest entry, dicts keep insertion order
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[user_id] = (time.monotonic() + ttl, subscribed)
+        return subscribed
+
+    async def _check_partner(self, bot: Bot, user_id: int, partner: str) -> bool:
+        """Check membership in one partner chat"""
+        try:
+            member = await asyncio.wait_for(
+                bot.get_chat_member(chat_id=partner_chat_id(partner), user_id=user_id),
+                timeout=self.timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Subscription check for {partner} timed out")
+            return False
+        except TelegramAPIError as e:
+            # Bot is not admin there or the link is not a chat: nothing to verify
+            logger.warning(f"Cannot verify subscription to {partner}: {e}")
+            return True
+
+        if member.status in SUBSCRIBED_STATUSES:
+            return True
+        return member.status == ChatMemberStatus.RESTRICTED and bool(getattr(member, "is_member", False))
+
+async def needs_subscription(bot: Bot, user_id: int, state: FSMContext, partners: List[str]) -> bool:
+    """Check whether user must pass the partners gate first"""
+    if not partners:
+        return False
+    if not subscription_verifier.enabled:
+        return await state.get_state() == UserStates.needs_subscription
+    return not await subscription_verifier.is_subscribed(bot, user_id, partners)
+
+class SubscriptionMiddleware(BaseMiddleware):
+    """Shows the partners gate instead of handlers flagged with subscription=True"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        if not get_flag(data, "subscription") or not isinstance(event, CallbackQuery):
+            return await handler(event, data)
+
+        partners = await async_data_manager.get_partners()
+        if not await needs_subscription(data["bot"], event.from_user.id, data["state"], partners):
+            return await handler(event, data)
+
+        if event.message:
+            screen = await get_screen("subscribe_first")
+            await event.message.edit_text(screen.text, reply_markup=screen.reply_markup)
+        await event.answer()
+
+subscription_verifier = SubscriptionVerifier(
+    enabled=SUBSCRIPTION_CHECK_ENABLED,
+    timeout=SUBSCRIPTION_CHECK_TIMEOUT,
+    positive_ttl=SUBSCRIPTION_POSITIVE_TTL,
+    negative_ttl=SUBSCRIPTION_NEGATIVE_TTL,
+    max_entries=SUBSCRIPTION_CACHE_SIZE
+)
+
+def _on_catalog_change(kind: str, key: Optional[str]):
+    """Partner list changes make every cached result stale"""
+    if kind == "partners":
+        subscription_verifier.invalidate()
+
+data_manager.add_listener(_on_catalog_change)
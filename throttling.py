@@ -0,0 +1,75 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import TelegramObject, Update, User
+
+from config import THROTTLE_RATE, THROTTLE_BURST, THROTTLE_EVICT_INTERVAL
+
+class UserThrottle:
+    """Per-user rate limit kept as one float per recently active user.
+
+    Generic cell rate algorithm: a user's theoretical arrival time moves one
+    interval forward per allowed update, and an update arriving more than
+    burst - 1 intervals before it is rejected. Users whose time has passed
+    have a full bucket and are dropped by the periodic eviction.
+    """
+
+    def __init__(self, rate: float = 2.0, burst: int = 10, evict_interval: float = 60.0):
+        self.enabled = rate > 0
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.tolerance = max(burst - 1, 0) * self.interval
+        self.evict_interval = evict_interval
+        # user_id -> theoretical arrival time (time.monotonic)
+        self._arrivals: Dict[int, float] = {}
+        self._next_eviction = time.monotonic() + evict_interval
+        self.stats = {"allowed": 0, "dropped": 0, "evicted": 0}
+
+    def allow(self, user_id: int) -> bool:
+        """Account an update from user, False if it is over the limit"""
+        now = time.monotonic()
+        if now >= self._next_eviction:
+            self.evict(now)
+        arrival = self._arrivals.get(user_id, now)
+        if arrival < now:
+            arrival = now
+        if arrival - now > self.tolerance:
+            self.stats["dropped"] += 1
+            return False
+        self._arrivals[user_id] = arrival + self.interval
+        self.stats["allowed"] += 1
+        return True
+
+    def evict(self, now: float):
+        """Forget users whose bucket has refilled"""
+        idle = [user_id for user_id, arrival in self._arrivals.items() if arrival <= now]
+        for user_id in idle:
+            del self._arrivals[user_id]
+        self.stats["evicted"] += len(idle)
+        self._next_eviction = now + self.evict_interval
+
+    def __len__(self) -> int:
+        return len(self._arrivals)
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Drops messages and button presses of users over their rate, before FSM state is loaded"""
+
+    def __init__(self, throttle: UserThrottle):
+        self.throttle = throttle
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        # Inline queries are left alone, clients send one per keystroke
+        user: User = data.get("event_from_user")
+        if (self.throttle.enabled and user is not None and isinstance(event, Update)
+                and (event.message is not None or event.callback_query is not None)
+                and not self.throttle.allow(user.id)):
+            return UNHANDLED
+        return await handler(event, data)
+
+user_throttle = UserThrottle(THROTTLE_RATE, THROTTLE_BURST, THROTTLE_EVICT_INTERVAL)
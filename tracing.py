@@ -0,0 +1,269 @@
+"""Per-update tracing and non-blocking log output.
+
+Every update gets a trace id and a list of spans: dispatcher middlewares,
+the handler, DataManager calls and outgoing Bot API requests, each with its
+start and duration relative to the update. A share of updates chosen up
+front, and any update slower than the threshold, is written as one JSON line.
+
+Log records and traces are handed to a queue and written by a background
+thread, so a slow disk or terminal never stalls the event loop.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import TelegramObject, Update, User
+
+from config import TRACE_SAMPLE_RATE, TRACE_SLOW_MS, TRACE_FILE, TRACE_FILE_MAX_BYTES, TRACE_FILE_BACKUPS
+from data_manager import async_data_manager
+
+logger = logging.getLogger(__name__)
+# Receives finished traces as dicts, never propagates to the root logger
+trace_logger = logging.getLogger("trace")
+trace_logger.propagate = False
+trace_logger.setLevel(logging.INFO)
+
+class _RecordQueueHandler(QueueHandler):
+    """Queue handler leaving formatting to the writer thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, ensure_ascii=False, separators=(",", ":"))
+
+def _start_listener(target: logging.Logger, handler: logging.Handler, queue_handler_class=QueueHandler):
+    """Route records of target through a queue to handler in a background thread"""
+    log_queue = queue.SimpleQueue()
+    target.addHandler(queue_handler_class(log_queue))
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    # Writes out what is still queued on exit
+    atexit.register(listener.stop)
+
+def setup_logging(level: int, fmt: str):
+    """Configure the root logger to write to stderr from a background thread"""
+    root = logging.getLogger()
+    if any(isinstance(handler, QueueHandler) for handler in root.handlers):
+        return
+    root.setLevel(level)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(fmt))
+    # The queue handler formats only the message, time and level are added by the writer
+    _start_listener(root, handler)
+
+class Trace:
+    """Spans recorded while one update is handled"""
+
+    __slots__ = ("trace_id", "update", "sampled", "started", "timestamp", "spans")
+
+    def __init__(self, update: Update, sampled: bool):
+        self.trace_id = f"{random.getrandbits(64):016x}"
+        self.update = update
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.timestamp = time.time()
+        # (kind, name, start, end) in time.perf_counter seconds
+        self.spans: List[Tuple[str, str, float, float]] = []
+
+    def to_dict(self, duration: float, user: Optional[User], error: Optional[BaseException]) -> Dict[str, Any]:
+        trace = {
+            "trace_id": self.trace_id,
+            "update_id": self.update.update_id,
+            "event": self.update.event_type,
+            "user_id": user.id if user is not None else None,
+            "timestamp": round(self.timestamp, 3),
+            "duration_ms": round(duration * 1000, 3),
+            "sampled": self.sampled,
+            "spans": [
+                {
+                    "kind": kind,
+                    "name": name,
+                    "start_ms": round((start - self.started) * 1000, 3),
+                    "duration_ms": round((end - start) * 1000, 3)
+                }
+                for kind, name, start, end in sorted(self.spans, key=lambda span: span[2])
+            ]
+        }
+        if error is not None:
+            trace["error"] = type(error).__name__
+        return trace
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+def current_trace_id() -> Optional[str]:
+    """Trace id of the update being handled, None outside of a trace"""
+    trace = _current_trace.get()
+    return trace.trace_id if trace is not None else None
+
+@contextmanager
+def span(kind: str, name: str) -> Iterator[None]:
+    """Record the enclosed block as a span of the current trace"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((kind, name, started, time.perf_counter()))
+
+def record_span(kind: str, name: str, seconds: float):
+    """Record a span that has just finished and took seconds"""
+    trace = _current_trace.get()
+    if trace is not None:
+        ended = time.perf_counter()
+        trace.spans.append((kind, name, ended - seconds, ended))
+
+class Tracer:
+    """Decides which updates are traced and which traces are written"""
+
+    def __init__(self, sample_rate: float = 0.01, slow_ms: float = 1000.0):
+        self.sample_rate = sample_rate
+        self.slow = slow_ms / 1000
+        # With a slow threshold every update is recorded, written only if sampled or slow
+        self.enabled = sample_rate > 0 or slow_ms > 0
+        self.stats = {"traced": 0, "sampled": 0, "slow": 0}
+
+    def start(self, update: Update) -> Optional[Trace]:
+        """New trace for update, None if it is not going to be written in any case"""
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not sampled and self.slow <= 0:
+            return None
+        self.stats["traced"] += 1
+        return Trace(update, sampled)
+
+    def finish(self, trace: Trace, user: Optional[User], error: Optional[BaseException]):
+        """Queue trace for writing if it was sampled or turned out slow"""
+        duration = time.perf_counter() - trace.started
+        slow = 0 < self.slow <= duration
+        if not (trace.sampled or slow):
+            return
+        self.stats["sampled" if trace.sampled else "slow"] += 1
+        trace_logger.info(trace.to_dict(duration, user, error))
+
+class TracingMiddleware(BaseMiddleware):
+    """Outermost dispatcher middleware opening a trace per update"""
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        trace = self.tracer.start(event) if isinstance(event, Update) else None
+        if trace is None:
+            return await handler(event, data)
+        token = _current_trace.set(trace)
+        error = None
+        try:
+            return await handler(event, data)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _current_trace.reset(token)
+            # Inner middlewares fill data, the user is known by now
+            self.tracer.finish(trace, data.get("event_from_user"), error)
+
+class TracedMiddleware(BaseMiddleware):
+    """Records a dispatcher middleware, including what it wraps, as a span"""
+
+    def __init__(self, middleware: Callable[..., Awaitable[Any]]):
+        self.middleware = middleware
+        self.name = type(middleware).__name__
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        with span("middleware", self.name):
+            return await self.middleware(handler, event, data)
+
+class HandlerTracingMiddleware(BaseMiddleware):
+    """Inner event middleware recording handlers by name"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        with span("handler", name):
+            return await handler(event, data)
+
+class ApiTracingMiddleware(BaseRequestMiddleware):
+    """Bot session middleware recording Bot API calls"""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        with span("bot_api", method.__api_method__):
+            return await make_request(bot, method)
+
+def _record_storage(operation: str, seconds: float):
+    """AsyncDataManager operation hook"""
+    record_span("storage", operation, seconds)
+
+tracer = Tracer(TRACE_SAMPLE_RATE, TRACE_SLOW_MS)
+_trace_file: Optional[str] = None
+
+def worker_trace_file(index: int) -> str:
+    """Trace file of a worker process, workers must not rotate one file together"""
+    root, ext = os.path.splitext(TRACE_FILE)
+    return f"{root}-{index}{ext}"
+
+def setup_tracing(dp: Dispatcher, bot: Bot, trace_file: str = TRACE_FILE):
+    """Install tracing middlewares around everything registered so far"""
+    global _trace_file
+    if not tracer.enabled:
+        return
+    if _trace_file is None:
+        handler = RotatingFileHandler(
+            trace_file, maxBytes=TRACE_FILE_MAX_BYTES, backupCount=TRACE_FILE_BACKUPS,
+            encoding="utf-8", delay=True
+        )
+        handler.setFormatter(_JsonFormatter())
+        _start_listener(trace_logger, handler, _RecordQueueHandler)
+        _trace_file = trace_file
+
+    # The trace is opened first, every other update middleware becomes a span inside it
+    middlewares = list(dp.update.outer_middleware)
+    for middleware in middlewares:
+        dp.update.outer_middleware.unregister(middleware)
+    dp.update.outer_middleware(TracingMiddleware(tracer))
+    for middleware in middlewares:
+        dp.update.outer_middleware(TracedMiddleware(middleware))
+    for observer in (dp.message, dp.callback_query, dp.inline_query):
+        observer.middleware(HandlerTracingMiddleware())
+    # Registered last, so the span is the request itself without flood control waits
+    bot.session.middleware(ApiTracingMiddleware())
+    async_data_manager.operation_observers.append(_record_storage)
+    logger.info(
+        f"Tracing {tracer.sample_rate:.2%} of updates and updates slower than "
+        f"{tracer.slow * 1000:g} ms to {trace_file}"
+    )
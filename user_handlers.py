@@ -1,232 +1,280 @@
+import logging
+from typing import Optional, Tuple
+
 from aiogram import Router, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import Message, CallbackQuery
-from aiogram.filters import CommandStart
+from aiogram.filters import CommandObject, CommandStart
 from aiogram.fsm.context import FSMContext
 
-from config import MESSAGES
+from config import MESSAGES, SINGLE_MESSAGE_DELIVERY
 from states import UserStates
-from keyboards import (
-    main_menu_keyboard, 
-    subscription_check_keyboard, 
-    back_to_menu_keyboard,
-    movie_episodes_keyboard,
-    partners_list_keyboard,
-    partners_subscription_keyboard
-)
-from data_manager import data_manager
+from data_manager import async_data_manager
+from user_registry import user_registry
+from analytics import analytics
+from render_cache import MovieScreen, movie_screen, code_not_found_screen, get_screen
+from keyboards import movie_episodes_keyboard
+from subscription import SubscriptionMiddleware, subscription_verifier
+from deep_links import payload_codes
+
+logger = logging.getLogger(__name__)
 
 router = Router()
+router.callback_query.middleware(SubscriptionMiddleware())
+
+async def deep_link_movie(payload: Optional[str]) -> Tuple[Optional[str], Optional[MovieScreen]]:
+    """Code and rendered movie a /start payload points to"""
+    for code in payload_codes(payload) if payload else []:
+        movie = await movie_screen(code)
+        if movie is not None:
+            return code, movie
+    return None, None
 
 @router.message(CommandStart())
-async def start_command(message: Message, state: FSMContext):
-    """Handle /start command"""
+async def start_command(message: Message, state: FSMContext, command: CommandObject):
+    """Handle /start command, /start <payload> deep links open a code right away"""
     await state.clear()
+    user_registry.add(message.from_user.id)
     
-    partners = data_manager.get_partners()
+    code, movie = await deep_link_movie(command.args)
+    partners = await async_data_manager.get_partners()
     
-    if partners:
+    subscribed = subscription_verifier.enabled and await subscription_verifier.is_subscribed(
+        message.bot, message.from_user.id, partners
+    )
+    
+    if partners and not subscribed:
         # Set state that user needs subscription
         await state.set_state(UserStates.needs_subscription)
-        
-        # Format partners list with numbers
-        partners_text = "\n".join([f"Партнёр {i}" for i, partner in enumerate(partners, 1)])
-        text = f"""📢 Чтобы пользоваться ботом, подпишись на всех партнёров:
-
-{partners_text}
-
-После подписки нажми кнопку "✅ Проверить подписку\""""
-        keyboard = partners_subscription_keyboard(partners)
+        if movie is not None:
+            # Shown as soon as the subscription check passes
+            await state.update_data(pending_code=code)
+        screen = await get_screen("start_with_partners")
+    elif movie is not None:
+        await send_movie(message, code, movie)
+        return
     else:
-        # No partners, show main menu
-        text = "🎬 Добро пожаловать! Выберите действие из меню:"
-        keyboard = main_menu_keyboard()
+        # No partners or already subscribed, show main menu
+        screen = await get_screen("welcome")
     
-    await message.answer(text, reply_markup=keyboard)
+    await message.answer(screen.text, reply_markup=screen.reply_markup)
 
 @router.callback_query(F.data == "check_subscription")
 async def check_subscription(callback: CallbackQuery, state: FSMContext):
-    """Handle subscription check (simplified)"""
+    """Handle subscription check"""
+    # The user asked for a fresh check, do not trust the cached answer
+    subscription_verifier.invalidate(callback.from_user.id)
+    partners = await async_data_manager.get_partners()
+    if not await subscription_verifier.is_subscribed(callback.bot, callback.from_user.id, partners):
+        await callback.answer(MESSAGES["not_subscribed"], show_alert=True)
+        return
+    
+    code = (await state.get_data()).get("pending_code")
     await state.clear()
-    text = "🎬 Добро пожаловать! Выберите действие из меню:"
-    keyboard = main_menu_keyboard()
+    
+    # Deep link visitors land on the content they came for
+    movie = await movie_screen(code) if code else None
+    if movie is not None and callback.message:
+        await send_movie(callback.message, code, movie)
+        await callback.answer()
+        return
+    
+    screen = await get_screen("welcome")
     
     if callback.message:
-        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.message.edit_text(screen.text, reply_markup=screen.reply_markup)
     await callback.answer()
 
-@router.callback_query(F.data == "search_content")
+@router.callback_query(F.data == "search_content", flags={"subscription": True})
 async def search_content(callback: CallbackQuery, state: FSMContext):
     """Start content search"""
-    current_state = await state.get_state()
-    
-    # Check if user needs subscription
-    if current_state == UserStates.needs_subscription:
-        partners = data_manager.get_partners()
-        if partners:
-            partners_text = "\n".join([f"Партнёр {i}" for i, partner in enumerate(partners, 1)])
-            text = f"""📢 Сначала подпишись на всех партнёров:
-
-{partners_text}
-
-После подписки нажми кнопку "✅ Проверить подписку\""""
-            keyboard = partners_subscription_keyboard(partners)
-            if callback.message:
-                await callback.message.edit_text(text, reply_markup=keyboard)
-            await callback.answer()
-            return
-    
     await state.set_state(UserStates.waiting_for_code)
     
-    text = MESSAGES["enter_code"]
-    keyboard = back_to_menu_keyboard()
+    screen = await get_screen("enter_code")
     
     if callback.message:
-        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.message.edit_text(screen.text, reply_markup=screen.reply_markup)
     await callback.answer()
 
+async def send_movie(message: Message, code: str, movie: MovieScreen):
+    """Send code lookup response in the configured delivery mode"""
+    analytics.record_lookup(code)
+    # Too long for a photo caption, poster and text go separately
+    if SINGLE_MESSAGE_DELIVERY and (movie.text_fits or not movie.poster):
+        await send_movie_single(message, code, movie)
+    else:
+        await send_movie_separate(message, code, movie)
+
+async def send_movie_single(message: Message, code: str, movie: MovieScreen):
+    """Send poster, caption and episodes keyboard in one message"""
+    if movie.poster:
+        try:
+            sent = await message.answer_photo(
+                photo=movie.poster,
+                caption=movie.text,
+                reply_markup=movie.episodes.reply_markup
+            )
+        except Exception as e:
+            await forget_poster_file_id(code, movie, e)
+        else:
+            await remember_poster_file_id(code, movie, sent)
+            return
+    
+    # No poster or it failed, still a single text message
+    await message.answer(movie.text, reply_markup=movie.episodes.reply_markup)
+
+async def send_movie_separate(message: Message, code: str, movie: MovieScreen):
+    """Send poster with caption, then episodes keyboard as a separate message"""
+    if movie.poster and not movie.caption_fits:
+        # Caption over the limit, poster without it followed by the caption as text
+        try:
+            sent = await message.answer_photo(photo=movie.poster)
+        except Exception as e:
+            await forget_poster_file_id(code, movie, e)
+        else:
+            await remember_poster_file_id(code, movie, sent)
+        await message.answer(movie.caption)
+    elif movie.poster:
+        try:
+            sent = await message.answer_photo(
+                photo=movie.poster,
+                caption=movie.caption
+            )
+        except Exception as e:
+            await forget_poster_file_id(code, movie, e)
+            # If poster fails, send as text
+            await message.answer(movie.caption)
+        else:
+            await remember_poster_file_id(code, movie, sent)
+    else:
+        await message.answer(movie.caption)
+    
+    # Episodes keyboard, or a note that they will be added soon
+    await message.answer(movie.episodes.text, reply_markup=movie.episodes.reply_markup)
+
+async def remember_poster_file_id(code: str, movie: MovieScreen, sent: Message):
+    """Store file_id Telegram assigned to a poster sent by URL.
+
+    The photo is already delivered, a storage failure is only logged.
+    """
+    if movie.poster_is_file_id or not sent.photo:
+        return
+    try:
+        await async_data_manager.set_poster_file_id(code, sent.photo[-1].file_id)
+    except Exception as e:
+        logger.error(f"Failed to store poster file_id of {code}: {e}")
+
+# Bad Request descriptions of a file_id Telegram will never accept again
+BAD_FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier", "file reference", "type of file mismatch")
+
+def is_bad_file_id(error: Exception) -> bool:
+    """Whether sending a photo failed because of its file identifier"""
+    return isinstance(error, TelegramBadRequest) and any(
+        marker in error.message.lower() for marker in BAD_FILE_ID_ERRORS
+    )
+
+async def forget_poster_file_id(code: str, movie: MovieScreen, error: Exception):
+    """Stale file_id, next lookup goes back to the original poster.
+
+    Timeouts, flood waits and other errors keep the file_id, it is still valid.
+    """
+    if not (movie.poster_is_file_id and is_bad_file_id(error)):
+        return
+    try:
+        await async_data_manager.set_poster_file_id(code, None)
+    except Exception as e:
+        logger.error(f"Failed to forget poster file_id of {code}: {e}")
+
 @router.message(UserStates.waiting_for_code)
 async def process_search_code(message: Message, state: FSMContext):
     """Process entered movie code"""
     if not message.text:
         return
     code = message.text.strip()
-    movie = data_manager.get_movie(code)
+    movie = await movie_screen(code)
     
     if movie:
-        # Movie found, show details
-        text = f"🎬 <b>{movie['title']}</b>"
-        
-        # Send poster if available
-        if movie.get('poster'):
-            try:
-                await message.answer_photo(
-                    photo=movie['poster'],
-                    caption=text
-                )
-            except Exception:
-                # If poster fails, send as text
-                await message.answer(text)
-        else:
-            await message.answer(text)
-        
-        # Send episodes if available
-        if movie.get('episodes'):
-            episodes = [ep.strip() for ep in movie['episodes'] if ep.strip()]
-            if episodes:
-                keyboard = movie_episodes_keyboard(episodes)
-                await message.answer(
-                    "🎞️ Выберите эпизод:",
-                    reply_markup=keyboard
-                )
-            else:
-                keyboard = back_to_menu_keyboard()
-                await message.answer(
-                    "📺 Эпизоды скоро будут добавлены!",
-                    reply_markup=keyboard
-                )
-        else:
-            keyboard = back_to_menu_keyboard()
-            await message.answer(
-                "📺 Эпизоды скоро будут добавлены!",
-                reply_markup=keyboard
-            )
+        await send_movie(message, code, movie)
         
         await state.clear()
     else:
-        # Movie not found
-        text = MESSAGES["code_not_found"]
-        keyboard = back_to_menu_keyboard()
-        
-        await message.answer(text, reply_markup=keyboard)
+        # Movie not found, offer similar titles if there are any
+        analytics.record_miss(code)
+        screen = await code_not_found_screen(code)
+        await message.answer(screen.text, reply_markup=screen.reply_markup)
 
-@router.callback_query(F.data == "show_partners")
-async def show_partners(callback: CallbackQuery, state: FSMContext):
-    """Show partners list"""
-    current_state = await state.get_state()
-    
-    # Check if user needs subscription
-    if current_state == UserStates.needs_subscription:
-        partners = data_manager.get_partners()
-        if partners:
-            partners_text = "\n".join([f"Партнёр {i}" for i, partner in enumerate(partners, 1)])
-            text = f"""📢 Сначала подпишись на всех партнёров:
-
-{partners_text}
-
-После подписки нажми кнопку "✅ Проверить подписку\""""
-            keyboard = partners_subscription_keyboard(partners)
-            if callback.message:
-                await callback.message.edit_text(text, reply_markup=keyboard)
-            await callback.answer()
-            return
+@router.callback_query(F.data.startswith("movie:"), flags={"subscription": True})
+async def show_suggested_movie(callback: CallbackQuery, state: FSMContext):
+    """Show movie picked from search suggestions"""
+    code = callback.data.split(":", 1)[1]
+    movie = await movie_screen(code)
     
-    partners = data_manager.get_partners()
+    if movie is None:
+        await callback.answer(MESSAGES["code_not_found"], show_alert=True)
+        return
     
-    if partners:
-        text = "👥 <b>Наши партнёры:</b>"
-        keyboard = partners_list_keyboard(partners)
-    else:
-        text = MESSAGES["no_partners"]
-        keyboard = back_to_menu_keyboard()
+    if callback.message:
+        await send_movie(callback.message, code, movie)
+    
+    await state.clear()
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("episodes:"))
+async def turn_episodes_page(callback: CallbackQuery):
+    """Show another page of the episodes keyboard in the same message"""
+    code, _, page = callback.data[len("episodes:"):].rpartition(":")
+    movie = await movie_screen(code)
+    
+    if movie is None or not page.isdigit():
+        await callback.answer(MESSAGES["code_not_found"], show_alert=True)
+        return
+    
+    # Messages sent in inline mode have no menu to go back to
+    keyboard = movie_episodes_keyboard(
+        movie.episode_list, back=callback.inline_message_id is None, code=code, page=int(page)
+    )
+    try:
+        if callback.message:
+            await callback.message.edit_reply_markup(reply_markup=keyboard)
+        elif callback.inline_message_id:
+            await callback.bot.edit_message_reply_markup(
+                inline_message_id=callback.inline_message_id, reply_markup=keyboard
+            )
+    except TelegramBadRequest:
+        # Same page tapped twice, the message is not modified
+        pass
+    await callback.answer()
+
+@router.callback_query(F.data == "noop")
+async def noop_button(callback: CallbackQuery):
+    """Buttons that only show information, e.g. the page counter"""
+    await callback.answer()
+
+@router.callback_query(F.data == "show_partners", flags={"subscription": True})
+async def show_partners(callback: CallbackQuery, state: FSMContext):
+    """Show partners list"""
+    screen = await get_screen("partners_list")
     
     if callback.message:
-        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.message.edit_text(screen.text, reply_markup=screen.reply_markup)
     await callback.answer()
 
-@router.callback_query(F.data == "show_help")
+@router.callback_query(F.data == "show_help", flags={"subscription": True})
 async def show_help(callback: CallbackQuery, state: FSMContext):
     """Show help message"""
-    current_state = await state.get_state()
-    
-    # Check if user needs subscription
-    if current_state == UserStates.needs_subscription:
-        partners = data_manager.get_partners()
-        if partners:
-            partners_text = "\n".join([f"Партнёр {i}" for i, partner in enumerate(partners, 1)])
-            text = f"""📢 Сначала подпишись на всех партнёров:
-
-{partners_text}
-
-После подписки нажми кнопку "✅ Проверить подписку\""""
-            keyboard = partners_subscription_keyboard(partners)
-            if callback.message:
-                await callback.message.edit_text(text, reply_markup=keyboard)
-            await callback.answer()
-            return
-    
-    text = MESSAGES["help_message"]
-    keyboard = back_to_menu_keyboard()
+    screen = await get_screen("help")
     
     if callback.message:
-        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.message.edit_text(screen.text, reply_markup=screen.reply_markup)
     await callback.answer()
 
-@router.callback_query(F.data == "back_to_menu")
+@router.callback_query(F.data == "back_to_menu", flags={"subscription": True})
 async def back_to_menu(callback: CallbackQuery, state: FSMContext):
     """Return to main menu"""
-    current_state = await state.get_state()
-    
-    # Check if user needs subscription
-    if current_state == UserStates.needs_subscription:
-        partners = data_manager.get_partners()
-        if partners:
-            partners_text = "\n".join([f"Партнёр {i}" for i, partner in enumerate(partners, 1)])
-            text = f"""📢 Сначала подпишись на всех партнёров:
-
-{partners_text}
-
-После подписки нажми кнопку "✅ Проверить подписку\""""
-            keyboard = partners_subscription_keyboard(partners)
-            if callback.message:
-                await callback.message.edit_text(text, reply_markup=keyboard)
-            await callback.answer()
-            return
-    
     await state.clear()
     
-    text = "🎬 Главное меню. Выберите действие:"
-    keyboard = main_menu_keyboard()
+    screen = await get_screen("main_menu")
     
     if callback.message:
-        await callback.message.edit_text(text, reply_markup=keyboard)
-    await callback.answer()
\ No newline at end of file
+        await callback.message.edit_text(screen.text, reply_markup=screen.reply_markup)
+    await callback.answer()
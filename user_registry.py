@@ -0,0 +1,146 @@
+import array
+import asyncio
+import logging
+import os
+import sys
+from typing import List, Optional, Set
+
+from config import USERS_FILE, USERS_FLUSH_INTERVAL, WORKERS
+
+logger = logging.getLogger(__name__)
+
+class UserRegistry:
+    """Set of bot users persisted as an append-only file of int64 ids.
+
+    New users are buffered and appended in batches. A removed user is
+    appended as its negated id; compact() rewrites the file without them.
+
+    A shared registry has other processes appending to the same file: their
+    records are picked up on every flush and the file is never rewritten.
+    """
+
+    def __init__(self, users_file: str, flush_interval: float = 5.0, shared: bool = False):
+        self.users_file = users_file
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self._users: Set[int] = set()
+        self._pending = array.array("q")
+        self._removed_records = 0
+        # Bytes of the file already applied
+        self._offset = 0
+        self._flush_task: Optional[asyncio.Task] = None
+        self._load()
+
+    def _load(self):
+        """Read ids from file, dropping a torn tail"""
+        records = array.array("q")
+        try:
+            with open(self.users_file, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return
+        usable = len(raw) - len(raw) % records.itemsize
+        if usable != len(raw) and not self.shared:
+            # In a shared file the tail may be another process' append in progress
+            logger.warning(f"Dropping damaged tail of {self.users_file}")
+            os.truncate(self.users_file, usable)
+        self._apply(raw[:usable])
+
+    def refresh(self):
+        """Apply records appended by other processes since the last read"""
+        try:
+            with open(self.users_file, "rb") as f:
+                f.seek(self._offset)
+                raw = f.read()
+        except FileNotFoundError:
+            return
+        self._apply(raw[:len(raw) - len(raw) % self._pending.itemsize])
+
+    def _apply(self, raw: bytes):
+        """Apply whole records read at the current offset"""
+        records = array.array("q")
+        records.frombytes(raw)
+        if sys.byteorder != "little":
+            records.byteswap()
+        self._offset += len(raw)
+
+        for user_id in records:
+            if user_id >= 0:
+                self._users.add(user_id)
+            else:
+                self._users.discard(-user_id)
+                self._removed_records += 1
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._users
+
+    def count(self) -> int:
+        """Number of registered users"""
+        return len(self._users)
+
+    def add(self, user_id: int):
+        """Register user, written to disk on the next flush"""
+        if user_id not in self._users:
+            self._users.add(user_id)
+            self._pending.append(user_id)
+
+    def remove(self, user_id: int):
+        """Unregister user, e.g. after they blocked the bot"""
+        if user_id in self._users:
+            self._users.discard(user_id)
+            self._pending.append(-user_id)
+            self._removed_records += 1
+
+    def sorted_ids(self, after: int = -1) -> List[int]:
+        """Registered ids in ascending order, only those greater than after"""
+        return sorted(user_id for user_id in self._users if user_id > after)
+
+    def flush(self):
+        """Append buffered changes to the file"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, array.array("q")
+        if sys.byteorder != "little":
+            pending.byteswap()
+        with open(self.users_file, "ab") as f:
+            f.write(pending.tobytes())
+        if self._removed_records > len(self._users) and not self.shared:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the file with current users only"""
+        records = array.array("q", sorted(self._users))
+        if sys.byteorder != "little":
+            records.byteswap()
+        tmp_path = self.users_file + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.users_file)
+        self._removed_records = 0
+        self._offset = len(records) * records.itemsize
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if self.shared:
+                    self.refresh()
+            except OSError as e:
+                logger.error(f"Failed to save users: {e}")
+
+    async def start(self):
+        """Start periodic flushing (dispatcher startup hook)"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stop periodic flushing and save the rest (dispatcher shutdown hook)"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        self.flush()
+
+user_registry = UserRegistry(USERS_FILE, USERS_FLUSH_INTERVAL, shared=WORKERS > 1)
@@ -0,0 +1,130 @@
+import asyncio
+import hmac
+import logging
+from typing import List
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from config import (
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBAPP_HOST,
+    WEBAPP_PORT,
+    WEBHOOK_CONCURRENCY,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_DRAIN_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class BoundedUpdateProcessor:
+    """Queue of incoming updates processed by a fixed number of workers"""
+
+    def __init__(self, dp: Dispatcher, bot: Bot, concurrency: int = 64, queue_size: int = 1000):
+        self.dp = dp
+        self.bot = bot
+        self.concurrency = concurrency
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.accepting = False
+        self._workers: List[asyncio.Task] = []
+
+    async def start(self):
+        """Start worker tasks"""
+        self.accepting = True
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    def submit(self, update: Update) -> bool:
+        """Queue update without waiting, False when the queue is full or closed"""
+        if not self.accepting:
+            return False
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def put(self, update: Update):
+        """Queue update, waiting while the queue is full"""
+        await self.queue.put(update)
+
+    async def _worker(self):
+        """Process queued updates one at a time"""
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Failed to process update {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def drain(self, timeout: float = 30.0):
+        """Stop accepting updates and wait for queued ones to finish"""
+        self.accepting = False
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutdown with {self.queue.qsize()} updates still queued")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+async def handle_update(request: web.Request) -> web.Response:
+    """Webhook endpoint: validate, queue and answer immediately"""
+    processor: BoundedUpdateProcessor = request.app["processor"]
+    secret: str = request.app["secret"]
+
+    if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+        return web.Response(status=401)
+
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": processor.bot})
+    except ValueError:
+        return web.Response(status=400)
+
+    if not processor.submit(update):
+        # Telegram redelivers the update later, this is our backpressure
+        return web.Response(status=503)
+    return web.Response(status=200)
+
+def create_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    """Create aiohttp application serving the webhook"""
+    app = web.Application()
+    app["processor"] = BoundedUpdateProcessor(dp, bot, WEBHOOK_CONCURRENCY, WEBHOOK_QUEUE_SIZE)
+    app["secret"] = WEBHOOK_SECRET
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+
+    async def on_startup(app: web.Application):
+        await dp.emit_startup(bot=bot)
+        await app["processor"].start()
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=app["secret"],
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"Webhook set to {WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH}")
+
+    async def on_shutdown(app: web.Application):
+        await app["processor"].drain(WEBHOOK_DRAIN_TIMEOUT)
+        await dp.emit_shutdown(bot=bot)
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Serve the webhook until cancelled, then drain queued updates"""
+    runner = web.AppRunner(create_app(dp, bot))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    logger.info(f"Listening for webhook updates on {WEBAPP_HOST}:{WEBAPP_PORT}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
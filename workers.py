@@ -0,0 +1,298 @@
+"""Multi-process mode: a supervisor receives updates and shards them to workers.
+
+Updates are routed by chat id, so FSM state, flood limits and caches of a
+chat always live in the same worker process. Workers share the SQLite
+catalog; a worker that changes it reports the change over its socket and
+the supervisor relays it to the others, which drop what they cached.
+
+Protocol: one JSON object per line. A worker sends {"ready": index} once
+it can take updates, then the supervisor sends {"update": <raw update>};
+{"change": [kind, key]} goes both ways.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import signal
+import socket
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.types import Update
+
+from config import (
+    BOT_TOKEN,
+    TELEGRAM_API_SERVER,
+    RUN_MODE,
+    STORAGE_BACKEND,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBAPP_HOST,
+    WEBAPP_PORT,
+    WEBHOOK_CONCURRENCY,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_DRAIN_TIMEOUT,
+    WORKERS,
+    WORKER_STOP_TIMEOUT,
+    METRICS_PORT
+)
+from webhook import SECRET_HEADER, BoundedUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Workers start from a clean interpreter, never from a fork of the running loop
+_context = multiprocessing.get_context("spawn")
+
+MAX_LINE_SIZE = 2 ** 20
+POLLING_TIMEOUT = 30
+RESTART_DELAY = 1.0
+
+def _encode(message: Dict[str, Any]) -> bytes:
+    return json.dumps(message, ensure_ascii=False).encode() + b"\n"
+
+def shard_for(update: Dict[str, Any], workers: int) -> int:
+    """Worker index of a raw update: by chat id, by user id for updates without a chat"""
+    for field, event in update.items():
+        if field == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        owner = chat or event.get("from") or event.get("user")
+        if owner and isinstance(owner.get("id"), int):
+            return owner["id"] % workers
+    return 0
+
+# Worker process
+def _worker_main(index: int, sock: socket.socket):
+    """Worker process entry point"""
+    # Ctrl+C reaches the whole process group, workers stop when the supervisor says so
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_worker(index, sock))
+
+async def run_worker(index: int, sock: socket.socket):
+    """Process updates sent by the supervisor until it closes the connection"""
+    from main import create_bot, create_dispatcher, start_metrics
+    from data_manager import data_manager, async_data_manager
+    from tracing import setup_tracing, worker_trace_file
+    from analytics import analytics
+
+    analytics.use_worker_files(index, WORKERS)
+    bot = create_bot()
+    dp = create_dispatcher(primary=index == 0)
+    metrics_runner = await start_metrics(dp, bot, METRICS_PORT + index)
+    setup_tracing(dp, bot, worker_trace_file(index))
+    reader, writer = await asyncio.open_connection(sock=sock, limit=MAX_LINE_SIZE)
+    loop = asyncio.get_running_loop()
+
+    def report_change(kind: str, key: Optional[str]):
+        # Called in a DataManager thread right after the change is stored
+        loop.call_soon_threadsafe(writer.write, _encode({"change": [kind, key]}))
+
+    data_manager.add_listener(report_change, local_only=True)
+
+    processor = BoundedUpdateProcessor(dp, bot, WEBHOOK_CONCURRENCY, WEBHOOK_QUEUE_SIZE)
+    await dp.emit_startup(bot=bot)
+    await processor.start()
+    writer.write(_encode({"ready": index}))
+    logger.info(f"Worker {index} started")
+    try:
+        while line := await reader.readline():
+            message = json.loads(line)
+            if "change" in message:
+                await async_data_manager.notify_external(*message["change"])
+                continue
+            try:
+                update = Update.model_validate(message["update"], context={"bot": bot})
+            except ValueError as e:
+                logger.error(f"Worker {index} got an invalid update: {e}")
+                continue
+            await processor.put(update)
+    finally:
+        await processor.drain(WEBHOOK_DRAIN_TIMEOUT)
+        await dp.emit_shutdown(bot=bot)
+        writer.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await dp.storage.close()
+        await bot.session.close()
+        async_data_manager.shutdown()
+        logger.info(f"Worker {index} stopped")
+
+# Supervisor
+class WorkerHandle:
+    """Supervisor side of one worker process"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        # Set while the worker accepts lines
+        self.connected = asyncio.Event()
+
+    async def start(self) -> asyncio.StreamReader:
+        """Spawn the worker process and wait until it is ready, returns the stream of its messages"""
+        parent_sock, child_sock = socket.socketpair()
+        self.process = _context.Process(
+            target=_worker_main, args=(self.index, child_sock), name=f"worker-{self.index}"
+        )
+        self.process.start()
+        child_sock.close()
+        reader, self.writer = await asyncio.open_connection(sock=parent_sock, limit=MAX_LINE_SIZE)
+        # Nothing but EOF comes before the ready line, the watcher handles a worker failing here
+        await reader.readline()
+        self.connected.set()
+        return reader
+
+    async def send(self, line: bytes):
+        """Send a line, waiting for a restart if the worker died"""
+        while True:
+            await self.connected.wait()
+            writer = self.writer
+            try:
+                writer.write(line)
+                await writer.drain()
+                return
+            except ConnectionError:
+                if self.writer is writer:
+                    self.connected.clear()
+
+    def relay(self, line: bytes):
+        """Send a short line without waiting, dropped while the worker is down"""
+        if self.connected.is_set():
+            self.writer.write(line)
+
+    async def join(self, timeout: float) -> Optional[int]:
+        """Wait for the process to exit, killing it after timeout"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.process.join, timeout)
+        if self.process.is_alive():
+            logger.warning(f"Worker {self.index} did not stop in {timeout}s, killing it")
+            self.process.kill()
+            await loop.run_in_executor(None, self.process.join)
+        return self.process.exitcode
+
+class Supervisor:
+    """Runs worker processes and feeds them updates sharded by chat"""
+
+    def __init__(self, workers: int):
+        self.workers: List[WorkerHandle] = [WorkerHandle(index) for index in range(workers)]
+        self.stopping = False
+        self._watchers: List[asyncio.Task] = []
+
+    async def start(self):
+        """Start all workers and wait until they are ready"""
+        await asyncio.gather(*(self._start_worker(worker) for worker in self.workers))
+        logger.info(f"Started {len(self.workers)} workers")
+
+    async def _start_worker(self, worker: WorkerHandle):
+        reader = await worker.start()
+        self._watchers.append(asyncio.create_task(self._watch(worker, reader)))
+
+    async def _watch(self, worker: WorkerHandle, reader: asyncio.StreamReader):
+        """Relay catalog changes of a worker to the others, restart it when it dies"""
+        while line := await reader.readline():
+            for other in self.workers:
+                if other is not worker:
+                    other.relay(line)
+        worker.connected.clear()
+        exitcode = await worker.join(WORKER_STOP_TIMEOUT)
+        if self.stopping:
+            return
+        logger.error(f"Worker {worker.index} exited with code {exitcode}, restarting")
+        await asyncio.sleep(RESTART_DELAY)
+        if not self.stopping:
+            await self._start_worker(worker)
+
+    async def dispatch(self, update: Dict[str, Any]):
+        """Send raw update to the worker owning its chat"""
+        worker = self.workers[shard_for(update, len(self.workers))]
+        await worker.send(_encode({"update": update}))
+
+    async def stop(self):
+        """Close worker connections and wait for them to finish queued updates"""
+        self.stopping = True
+        for worker in self.workers:
+            if worker.connected.is_set():
+                worker.connected.clear()
+                worker.writer.close()
+        await asyncio.gather(*self._watchers, return_exceptions=True)
+
+    async def _call(self, session: aiohttp.ClientSession, method: str, **params) -> Dict[str, Any]:
+        """Call Bot API method without parsing the result into aiogram types"""
+        api = TelegramAPIServer.from_base(TELEGRAM_API_SERVER) if TELEGRAM_API_SERVER else PRODUCTION
+        data = {name: str(value) for name, value in params.items() if value is not None}
+        try:
+            async with session.post(api.api_url(BOT_TOKEN, method), data=data) as response:
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            return {"ok": False, "description": str(e)}
+
+    async def poll(self):
+        """Long-poll getUpdates and dispatch raw updates, parsing is left to the workers"""
+        offset = None
+        errors = 0
+        timeout = aiohttp.ClientTimeout(total=POLLING_TIMEOUT + 10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                result = await self._call(session, "getUpdates", offset=offset, timeout=POLLING_TIMEOUT)
+                if not result.get("ok"):
+                    errors += 1
+                    delay = (result.get("parameters") or {}).get("retry_after") or min(2 ** errors, 30)
+                    logger.error(f"getUpdates failed: {result.get('description')}, retrying in {delay}s")
+                    await asyncio.sleep(delay)
+                    continue
+                errors = 0
+                for update in result["result"]:
+                    await self.dispatch(update)
+                    offset = update["update_id"] + 1
+
+    async def _handle_update(self, request: web.Request) -> web.Response:
+        """Webhook endpoint, answers once the owning worker accepted the update"""
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET):
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update, dict):
+            return web.Response(status=400)
+        await self.dispatch(update)
+        return web.Response(status=200)
+
+    async def serve_webhook(self):
+        """Serve the webhook until cancelled"""
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self._handle_update)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+        await site.start()
+        url = WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+        async with aiohttp.ClientSession() as session:
+            result = await self._call(session, "setWebhook", url=url, secret_token=WEBHOOK_SECRET)
+        if not result.get("ok"):
+            logger.error(f"setWebhook failed: {result.get('description')}")
+        logger.info(f"Listening for webhook updates on {WEBAPP_HOST}:{WEBAPP_PORT}, webhook set to {url}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+async def run_supervisor(workers: int):
+    """Run the bot as a supervisor with the given number of worker processes"""
+    if STORAGE_BACKEND != "sqlite":
+        raise RuntimeError(
+            "WORKERS > 1 needs the shared catalog: set STORAGE_BACKEND=sqlite (see migrate_storage.py)"
+        )
+    supervisor = Supervisor(workers)
+    await supervisor.start()
+    try:
+        if RUN_MODE == "webhook":
+            await supervisor.serve_webhook()
+        else:
+            await supervisor.poll()
+    finally:
+        await supervisor.stop()